@@ -1,55 +1,67 @@
 # %%
 # imports
+import os
 import numpy as np
-import pandas as pd
-from utils import midi2frequency, array2fluid_dataset
-import json
+from adaptive_grid import adaptive_parameter_table
+from fluid_dataset import write_fluid_dataset
+from param_grid import ParamGrid, GRID_PATH, CSV_PATH, open_dataset
+from instrumentation import StageMetrics, metrics_path
+
+# timing and memory, see instrumentation.py
+metrics = StageMetrics("01")
 
 # %%
 # create ranges for each parameter
 pitch_steps = 51
 harm_ratio_steps = 51
 mod_idx_steps = 51
-pitches = np.linspace(38, 86, pitch_steps)
-freqs = midi2frequency(pitches)  # x
-ratios = np.linspace(0, 1, harm_ratio_steps) * 10  # y
-indices = np.linspace(0, 1, mod_idx_steps) * 10  # z
 sr = 48000
 dur = 1
+# set to True to sample the parameter space adaptively instead of with the dense grid:
+# start from a coarse grid and only refine the cells where the (analytic) spectral
+# centroid and spread are far from linear, see adaptive_grid.py
+adaptive = False
+# set to True to also write the dense grid to ../data/fm_synth_params.csv (the later stages
+# only need the grid spec)
+export_csv = False
 
-# make into 3D mesh
-freqs, ratios, indices = np.meshgrid(freqs, ratios, indices)  # y, x, z!
-print(freqs.shape, ratios.shape, indices.shape)
+# the dense grid as an implicit table: row i = y * X * Z + x * Z + z, with pitches from
+# midi 38 to 86 along x, harmonicity ratios along y and modulation indices along z, all
+# computed from the row index (see param_grid.py)
+grid = ParamGrid(pitch_steps, harm_ratio_steps, mod_idx_steps)
+print(grid.shape)
 
 # %%
-# Create a dictionary where each key-value pair corresponds to a column in the dataframe
-data = {
-    "x": np.tile(np.repeat(np.arange(pitch_steps), mod_idx_steps), harm_ratio_steps),
-    "y": np.repeat(np.arange(harm_ratio_steps), pitch_steps * mod_idx_steps),
-    "z": np.tile(np.arange(mod_idx_steps), harm_ratio_steps * pitch_steps),
-    "freq": freqs.flatten(),
-    "harm_ratio": ratios.flatten(),
-    "mod_index": indices.flatten()
-}
-
-# Create the dataframe
-df = pd.DataFrame(data)
+# the table of x, y, z, freq, harm_ratio and mod_index, for the exports below
+if adaptive:
+    # x, y, z are then coordinates on the finest lattice of 49 steps per axis
+    with metrics.phase("analysis"):
+        df = adaptive_parameter_table(coarse_steps=7, max_depth=3, tolerance=0.1)
+else:
+    df = grid.table()
 df.head()
 
 # %%
-# save to disk
-df.to_csv("../data/fm_synth_params.csv", index=True)
+# save to disk: the spec of the grid (a few bytes), which stages 02-06 read, or the table of
+# the adaptive samples, which they read when there is no grid spec
+with metrics.phase("serialization"):
+    if adaptive:
+        df.to_csv(CSV_PATH, index=True)
+        if os.path.exists(GRID_PATH):
+            os.remove(GRID_PATH)
+    else:
+        grid.save(GRID_PATH)
+        if export_csv:
+            grid.export_csv(CSV_PATH)
 
 # %%
 # export fm params as fluid dataset
 df_params_fm = df[["freq", "harm_ratio", "mod_index"]]
 # convert to numpy array
 df_params_fm = df_params_fm.values
-# save as fluid dataset
-df_params_fm_dict = array2fluid_dataset(df_params_fm)
-# save to json
-with open("../data/fm_params.json", "w") as f:
-    json.dump(df_params_fm_dict, f)
+# save as fluid dataset (streamed to json)
+with metrics.phase("serialization"):
+    write_fluid_dataset("../data/fm_params.json", df_params_fm)
 
 # %%
 # get scaled x y z for colors
@@ -65,12 +77,16 @@ alpha = np.repeat(0.2, len(x))
 colors = np.stack((x, y, z, alpha), axis=-1)
 
 # %%
-# save to disk
-np.save("../data/colors.npy", colors)
-# save the colors array
-colors_dict = array2fluid_dataset(colors)
-# save to json
-with open("../data/colors.json", "w") as f:
-    json.dump(colors_dict, f)
+# save the colors array as a fluid dataset, with ../data/colors.npy as its binary sidecar
+with metrics.phase("serialization"):
+    write_fluid_dataset("../data/colors.json", colors, sidecar=True)
 
 # %%
+# render all synths once into the shared render cache, stages 02-05 read
+# their audio from here (05 uses the first 0.25 s of each render)
+with metrics.phase("render", items=len(df)):
+    fm_synth_ds = open_dataset(GRID_PATH, CSV_PATH, sr=sr, dur=dur,
+                               cache_dir="../data/render_cache")
+print(fm_synth_ds.audio.shape)
+# the report is named after the parameter file this run wrote
+metrics.write(metrics_path(CSV_PATH if adaptive else GRID_PATH))
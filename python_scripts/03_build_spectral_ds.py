@@ -1,66 +1,105 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 from tqdm import tqdm
-from pytimbre.waveform import Waveform
-from pytimbre.spectral.spectra import SpectrumByFFT
-import pandas as pd
-from utils import FmSynthDataset
-import json
+from spectral_features import SPECTRAL_FEATURES, batch_spectral_descriptors
+from param_grid import open_dataset
+from dispatch import map_chunks
+from checkpoint import ResultShards
+from columnar import ColumnStore
+from instrumentation import StageMetrics, metrics_path
+from equivalence import EquivalenceClasses
+from sharding import current_shard, dataset_key, ShardRun
 
-# create the dataset
+# dataset settings
 sr = 48000
 dur = 1
+# the parameter grid spec of stage 01, or its table after adaptive sampling (see param_grid.py)
+grid_path = "../data/fm_synth_params.grid.json"
 csv_path = "../data/fm_synth_params.csv"
-fm_synth_ds = FmSynthDataset(csv_path, sr=sr, dur=dur)
+cache_dir = "../data/render_cache"  # shared renders, see render_cache.py
+chunk_size = 64  # items per worker task
+# finished chunks are checkpointed here, rerun the script to resume
+shards_dir = "../data/fm_synth_spectral_features.shards"
+# rows that render the same signal (e.g. a harm_ratio or mod_index of 0, which leave
+# a sine) are analysed once and their results copied to the others (see equivalence.py)
+memoize = True
 
 
-def extract_features(i, synths, sr):
-    y, freq, ratio, index = synths[i]
-    wfm = Waveform(y, sr, 0.0)
-    spectrum = SpectrumByFFT(wfm, 4096)
-    timbre = {
-        "index": i,
-        "freq": freq,
-        "harm_ratio": ratio,
-        "mod_index": index,
-        "spectral_centroid": spectrum.spectral_centroid,
-        "spectral_crest": spectrum.spectral_crest,
-        "spectral_decrease": spectrum.spectral_decrease,
-        "spectral_energy": spectrum.spectral_energy,
-        "spectral_flatness": spectrum.spectral_flatness,
-        "spectral_kurtosis": spectrum.spectral_kurtosis,
-        "spectral_roll_off": spectrum.spectral_roll_off,
-        "spectral_skewness": spectrum.spectral_skewness,
-        "spectral_slope": spectrum.spectral_slope,
-        "spectral_spread": spectrum.spectral_spread,
-        "inharmonicity": spectrum.inharmonicity
-    }
-    return timbre
+def extract_features(indices, synths, sr):
+    # one batched rFFT and array reductions for a whole chunk, same descriptors as
+    # pytimbre's SpectrumByFFT(Waveform(y, sr, 0.0), 4096)
+    # (run spectral_features.py to compare them with pytimbre)
+    y, freq, ratio, index = synths.get_batch(indices)
+    descriptors = batch_spectral_descriptors(y, sr, fft_size=4096)
+    timbres = []
+    for row, i in enumerate(indices):
+        timbre = {
+            "index": int(i),
+            "freq": freq[row],
+            "harm_ratio": ratio[row],
+            "mod_index": index[row],
+        }
+        for name in SPECTRAL_FEATURES:
+            timbre[name] = descriptors[name][row]
+        timbres.append(timbre)
+    return timbres
 
 
 if __name__ == '__main__':
-    executor = ProcessPoolExecutor()
-    jobs = [executor.submit(extract_features, idx, fm_synth_ds, sr)
-            for idx in range(len(fm_synth_ds))]
-    results = []
-    for job in tqdm(as_completed(jobs), total=len(jobs)):
-        results.append(job.result())
+    # timing, item latencies, worker utilization and memory, see instrumentation.py
+    metrics = StageMetrics("03")
+    # with --shard i/n (or SYNTHMAPS_SHARD=i/n) only process this node's share of the rows,
+    # to merge with the other nodes' shards later (see sharding.py)
+    shard = current_shard()
+    with metrics.phase("setup"):
+        if shard is None:
+            fm_synth_ds = open_dataset(
+                grid_path, csv_path, sr=sr, dur=dur, cache_dir=cache_dir)
+            # skip the indices that a previous run of the same table and settings already
+            # checkpointed
+            shards = ResultShards(shards_dir, key=dataset_key(fm_synth_ds))
+            todo = shards.remaining(len(fm_synth_ds))
+        else:
+            full_ds = open_dataset(grid_path, csv_path, sr=sr, dur=dur)
+            # the cost of the batched analysis is the same for every row
+            run = ShardRun(shards_dir, full_ds, shard, "table")
+            fm_synth_ds = run.dataset(cache_dir)
+            shards = ResultShards(run.directory)
+            todo = run.remaining(shards)
+        # only the first row of each class of identical renders is analysed
+        classes = (EquivalenceClasses.from_dataset(fm_synth_ds) if memoize
+                   else EquivalenceClasses.singletons(len(fm_synth_ds)))
+        representatives = classes.representatives_of(todo)
+        # its results are copied to the other rows of the class that are still to do
+        pending = np.zeros(len(fm_synth_ds), dtype=bool)
+        pending[todo] = True
+    # workers get the parameter table through shared memory once,
+    # then receive chunks of indices
+    # the analysis phase includes the checkpoint writes, which are also timed as serialization
+    with tqdm(total=len(fm_synth_ds), initial=len(fm_synth_ds) - len(todo)) as pbar, \
+            metrics.phase("analysis"):
+        for indices, chunk_results in map_chunks(
+                extract_features, fm_synth_ds, sr, indices=representatives, chunk_size=chunk_size,
+                batched=True, metrics=metrics):
+            chunk_results = classes.fan_out_records(chunk_results, fm_synth_ds, pending)
+            if shard is not None:
+                chunk_results = run.to_table_rows(chunk_results)
+            with metrics.phase("serialization"):
+                shards.write(chunk_results)
+            pbar.update(len(chunk_results))
     print("Finished extracting features")
-
-    # save to json
-    json_object = json.dumps(results, indent=4)
-    outfile_path = "../data/fm_synth_spectral_features.json"
-    with open(outfile_path, "w") as outfile:
-        outfile.write(json_object)
-    print("Features saved to json")
-
-    # save as csv
-    # read perceptual features from json
-    with open(outfile_path, "r") as f:
-        data = json.load(f)
-    df_perceptual = pd.DataFrame(data)
-    df_perceptual.set_index("index", inplace=True)
-    # order by index
-    df_perceptual.sort_index(inplace=True)
-    df_perceptual.to_csv(
-        "../data/fm_synth_spectral_features.csv", index=True)
-    print("Features saved to csv")
+    if shard is None:
+        # assemble the checkpointed shards into one typed column per feature, in index order
+        with metrics.phase("serialization"):
+            ColumnStore.from_shards(
+                shards, "../data/fm_synth_spectral_features.columns", len(fm_synth_ds))
+            # the checkpoints are only needed to resume an unfinished run
+            shards.clear()
+        print("Features saved to ../data/fm_synth_spectral_features.columns")
+        metrics.write(metrics_path("../data/fm_synth_spectral_features.columns"))
+        # CSV/JSON versions can be exported from the store when needed, e.g.
+        # python columnar.py ../data/fm_synth_spectral_features.columns --csv ../data/fm_synth_spectral_features.csv
+    else:
+        run.finish()
+        metrics.write(metrics_path(run.directory))
+        print(f"Shard saved to {run.directory}, merge all shards with")
+        print(f"python sharding.py merge {shards_dir} ../data/fm_synth_spectral_features.columns")
@@ -1,22 +1,57 @@
 # %%
 # imports
+import os
+import sys
 import numpy as np
+from numpy.lib.format import open_memmap
 import torch
+from torch.utils.data import DataLoader, Subset
 from torchaudio.functional import amplitude_to_DB
 from torchaudio.transforms import MelSpectrogram
 from tqdm import tqdm
-from utils import FmSynthDataset
+from param_grid import open_dataset
+from dispatch import available_cpus
+from instrumentation import StageMetrics, metrics_path
+from equivalence import EquivalenceClasses
+from sharding import current_shard, ShardRun
+
+# %%
+# timing, item latencies and memory, see instrumentation.py
+metrics = StageMetrics("04")
 
 # %%
 # create the dataset
 sr = 48000
 dur = 1
+# the parameter grid spec of stage 01, or its table after adaptive sampling (see param_grid.py)
+grid_path = "../data/fm_synth_params.grid.json"
 csv_path = "../data/fm_synth_params.csv"
-fm_synth_ds = FmSynthDataset(csv_path, sr=sr, dur=dur)
+cache_dir = "../data/render_cache"  # shared renders, see render_cache.py
+# with --shard i/n (or SYNTHMAPS_SHARD=i/n) only render this node's share of the rows,
+# to merge with the other nodes' shards later (see sharding.py)
+shard = current_shard()
+shards_dir = "../data/fm_synth_mel_spectrograms_mean.shards"
+if shard is None:
+    fm_synth_ds = open_dataset(
+        grid_path, csv_path, sr=sr, dur=dur, cache_dir=cache_dir)
+else:
+    run = ShardRun(shards_dir, open_dataset(grid_path, csv_path, sr=sr, dur=dur), shard, "array")
+    fm_synth_ds = run.dataset(cache_dir)
+# rows that render the same signal (e.g. a harm_ratio or mod_index of 0, which leave
+# a sine) are analysed once and their spectrograms copied to the others (see equivalence.py)
+memoize = True
+classes = (EquivalenceClasses.from_dataset(fm_synth_ds) if memoize
+           else EquivalenceClasses.singletons(len(fm_synth_ds)))
+representatives = classes.representatives
 
 # %%
 # render all mel spectrograms - mean
 n_mels = 200
+batch_size = 64  # renders per mel spectrogram call
+# DataLoader processes preparing the next batches (they re-run this script
+# unless processes are forked, so only use them on Linux)
+num_workers = 2 if sys.platform == "linux" else 0
+intra_op_threads = available_cpus()  # torch threads for the FFTs
 mel_spec = MelSpectrogram(
     sample_rate=48000,
     n_fft=4096,
@@ -28,20 +63,44 @@ mel_spec = MelSpectrogram(
     norm="slaney",
     mel_scale="slaney")
 
-all_mel = np.zeros((len(fm_synth_ds), n_mels))
+torch.set_num_threads(intra_op_threads)
+loader = DataLoader(Subset(fm_synth_ds, representatives), batch_size=batch_size,
+                    num_workers=num_workers, prefetch_factor=4 if num_workers > 0 else None)
+# write each batch straight to disk
+# (a shard writes the rows of its dataset, in the same order)
+if shard is None:
+    outfile_path = "../data/fm_synth_mel_spectrograms_mean.npy"
+else:
+    outfile_path = os.path.join(run.directory, "values.npy")
+all_mel = open_memmap(outfile_path, mode="w+",
+                      dtype=np.float32, shape=(len(fm_synth_ds), n_mels))
 
-for i in tqdm(range(len(fm_synth_ds))):
-    y, freq, ratio, index = fm_synth_ds[i]
-    mel = mel_spec(torch.tensor(y, dtype=torch.float32))
-    mel_avg = mel.mean(dim=1, keepdim=True)
-    mel_avg_db = amplitude_to_DB(
-        mel_avg, multiplier=10, amin=1e-5, db_multiplier=20, top_db=80)
-    all_mel[i] = mel_avg_db.numpy().T
+start = 0
+with torch.inference_mode():
+    # waiting for the loader is timed as render
+    for y, freq, ratio, index in tqdm(metrics.iterate(loader, "render"), total=len(loader)):
+        with metrics.phase("analysis", items=len(y)):
+            mel = mel_spec(y.to(torch.float32))  # (B, n_mels, frames)
+            # (B, 1, n_mels, 1) so that top_db is applied per item
+            mel_avg = mel.mean(dim=2, keepdim=True).unsqueeze(1)
+            mel_avg_db = amplitude_to_DB(
+                mel_avg, multiplier=10, amin=1e-5, db_multiplier=20, top_db=80)
+        with metrics.phase("serialization"):
+            # the batch holds representatives[start:start + len(y)]
+            rows, positions = classes.fan_out(representatives[start:start + len(y)])
+            all_mel[rows] = mel_avg_db[:, 0, :, 0].numpy()[positions]
+        start += len(y)
 
 # %%
-# save all_mel to disk - mean
+# flush all_mel to disk - mean
+with metrics.phase("serialization"):
+    all_mel.flush()
 print(all_mel.shape)
-np.save("../data/fm_synth_mel_spectrograms_mean.npy", all_mel)
-print("Saved fm_synth_mel_spectrograms_mean.npy")
+print(f"Saved {outfile_path}")
+metrics.write(metrics_path(outfile_path))
+if shard is not None:
+    run.finish()
+    print("Merge all shards with")
+    print(f"python sharding.py merge {shards_dir} ../data/fm_synth_mel_spectrograms_mean.npy")
 
 # %%
@@ -1,24 +1,54 @@
 # %%
 # imports
-import numpy as np
-from utils import FmSynthDataset
+import os
+from param_grid import open_dataset
+from embeddings import write_embeddings
+from instrumentation import StageMetrics, metrics_path
+from equivalence import EquivalenceClasses
+from sharding import current_shard, ShardRun
 from frechet_audio_distance import FrechetAudioDistance
-from tqdm import tqdm
 
 # %%
 # create the dataset
 sr = 48000
 dur = 0.25  # we use 0.25 seconds for the embeddings
+# the parameter grid spec of stage 01, or its table after adaptive sampling (see param_grid.py)
+grid_path = "../data/fm_synth_params.grid.json"
 csv_path = "../data/fm_synth_params.csv"
-fm_synth_ds = FmSynthDataset(csv_path, sr=sr, dur=dur)
-test_fm = fm_synth_ds[0][0]
+cache_dir = "../data/render_cache"  # shared renders, see render_cache.py
+# with --shard i/n (or SYNTHMAPS_SHARD=i/n) only embed this node's share of the rows,
+# to merge with the other nodes' shards later (see sharding.py)
+shard = current_shard()
+if shard is None:
+    fm_synth_ds = open_dataset(
+        grid_path, csv_path, sr=sr, dur=dur, cache_dir=cache_dir)
+else:
+    full_ds = open_dataset(grid_path, csv_path, sr=sr, dur=dur)
+    runs = {model: ShardRun(f"../data/fm_synth_{model}_embeddings.shards", full_ds, shard, "array")
+            for model in ["encodec", "clap"]}
+    # both models embed the same rows
+    fm_synth_ds = runs["encodec"].dataset(cache_dir)
+# rows that render the same signal (e.g. a harm_ratio or mod_index of 0, which leave
+# a sine) are embedded once and their embeddings copied to the others (see equivalence.py)
+memoize = True
+classes = EquivalenceClasses.from_dataset(fm_synth_ds) if memoize else None
 
-# %%
-# render all synths
-all_y = np.zeros((len(fm_synth_ds), test_fm.shape[0]))
-for i in tqdm(range(len(fm_synth_ds))):
-    y, freq, ratio, index = fm_synth_ds[i]
-    all_y[i] = y
+
+def output_path(model):
+    # the final .npy, or the values of this node's shard
+    if shard is None:
+        return f"../data/fm_synth_{model}_embeddings.npy"
+    return os.path.join(runs[model].directory, "values.npy")
+
+
+def finish(model):
+    if shard is not None:
+        runs[model].finish()
+        print(f"Merge all shards with python sharding.py merge ../data/fm_synth_{model}_embeddings.shards "
+              f"../data/fm_synth_{model}_embeddings.npy")
+# renders are streamed to the models in batches of this size
+# (see embeddings.py, where a StandInModel can also be used to run this offline)
+batch_size = 64
 
 # %%
 # use encodec
@@ -31,19 +61,16 @@ frechet = FrechetAudioDistance(
 )
 
 # %%
-# iterate all_y one by one and render embeddings - ENCODEC
-test_embs = frechet.get_embeddings([test_fm], sr)
-all_embs = np.zeros((len(fm_synth_ds), test_embs.shape[0], test_embs.shape[1]))
-for i in tqdm(range(len(fm_synth_ds))):
-    synth = all_y[i]
-    embs = frechet.get_embeddings([synth], sr)
-    all_embs[i] = embs
-
-# %%
-# save all_embs to disk - ENCODEC
+# render embeddings batch by batch, straight to disk - ENCODEC
+# (with timing, item latencies and memory, see instrumentation.py)
+metrics = StageMetrics("05 encodec")
+all_embs = write_embeddings(
+    frechet, fm_synth_ds, output_path("encodec"), batch_size=batch_size,
+    metrics=metrics, classes=classes)
 print(all_embs.shape)
-np.save("../data/fm_synth_encodec_embeddings.npy", all_embs)
-print("Saved fm_synth_encodec_embeddings.npy")
+print(f"Saved {output_path('encodec')}")
+metrics.write(metrics_path(output_path("encodec")))
+finish("encodec")
 
 # %%
 # use clap
@@ -55,16 +82,13 @@ frechet = FrechetAudioDistance(
 )
 
 # %%
-# iterate all_y one by one and render embeddings - CLAP
-test_embs = frechet.get_embeddings([test_fm], sr)
-all_embs = np.zeros((len(fm_synth_ds), test_embs.shape[-1]))
-for i in tqdm(range(len(fm_synth_ds))):
-    synth = all_y[i]
-    embs = frechet.get_embeddings([synth], sr)
-    all_embs[i] = embs
-
-# %%
-# save all_embs to disk - CLAP
+# render embeddings batch by batch, straight to disk - CLAP
+# (with timing, item latencies and memory, see instrumentation.py)
+metrics = StageMetrics("05 clap")
+all_embs = write_embeddings(
+    frechet, fm_synth_ds, output_path("clap"), batch_size=batch_size,
+    metrics=metrics, classes=classes)
 print(all_embs.shape)
-np.save("../data/fm_synth_clap_embeddings.npy", all_embs)
-print("Saved fm_synth_clap_embeddings.npy")
+print(f"Saved {output_path('clap')}")
+metrics.write(metrics_path(output_path("clap")))
+finish("clap")
@@ -5,14 +5,34 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import MinMaxScaler
-from utils import frequency2midi, array2fluid_dataset
-import json
+from utils import frequency2midi
+from fluid_dataset import write_fluid_dataset
+from columnar import load_table
+from param_grid import load_parameter_table
+from streaming_pca import StreamingPCA
+from raster_scatter import raster_scatter
+from instrumentation import StageMetrics
+
+# project the embeddings and mel spectrograms out of core (see streaming_pca.py): they are
+# memory-mapped and streamed in blocks of rows instead of loaded for the exact PCA
+out_of_core = True
+
+# draw the points of the scatter plots as one binned image (see raster_scatter.py) instead
+# of one marker at a time
+raster = True
+scatter = raster_scatter if raster else plt.scatter
+
+# time the loading, projection, plotting and saving of every map (see instrumentation.py)
+metrics = StageMetrics("06")
 
 # %%
 # create a 2D scatter plot of the PCA-d synth parameters
 
 # read dataset
-df_params = pd.read_csv("../data/fm_synth_params.csv", index_col=0)
+with metrics.phase("load"):
+    # the grid spec of stage 01, or its table after adaptive sampling
+    df_params = load_parameter_table("../data/fm_synth_params.grid.json",
+                                     fallback_csv="../data/fm_synth_params.csv")
 # get the freq column
 freq = df_params["freq"].values
 # translate to midi
@@ -31,10 +51,11 @@ df_params_3d = scaler.transform(df_params_3d)
 
 # create PCA
 pca = PCA(n_components=2, whiten=True, random_state=42)
-# fit PCA
-pca.fit(df_params_3d)
-# transform
-df_params_2d = pca.transform(df_params_3d)
+with metrics.phase("pca"):
+    # fit PCA
+    pca.fit(df_params_3d)
+    # transform
+    df_params_2d = pca.transform(df_params_3d)
 
 # get scaled x y z for colors
 x = df_params.x.values
@@ -50,7 +71,8 @@ colors = np.stack((x, y, z, alpha), axis=-1)
 
 # create scatter plot with small dots and color by x, y, z as RGB
 plt.figure(dpi=300)
-plt.scatter(df_params_2d[:, 0], df_params_2d[:, 1], s=1, c=colors)
+with metrics.phase("plot"):
+    scatter(df_params_2d[:, 0], df_params_2d[:, 1], s=1, c=colors)
 fontsize = 18
 plt.xlabel("PCA – 1st component", fontsize=fontsize)
 plt.ylabel("PCA – 2nd component", fontsize=fontsize)
@@ -58,24 +80,23 @@ plt.title(
     f"PCA of FM synth parameters\nexplained variance ratio: {np.round(pca.explained_variance_ratio_.sum(), 2)}", fontsize=fontsize)
 
 # save figure as png
-plt.savefig("../figures/pca_params.png", format="png")
+with metrics.phase("plot"):
+    plt.savefig("../figures/pca_params.png", format="png")
 
-# save the colors array
-colors_dict = array2fluid_dataset(colors)
-with open("../data/colors.json", "w") as f:
-    json.dump(colors_dict, f)
-# save the pca plot as a fluid dataset
-pca_params = array2fluid_dataset(df_params_2d)
-with open("../data/pca_params.json", "w") as f:
-    json.dump(pca_params, f)
+with metrics.phase("serialization"):
+    # save the colors array
+    write_fluid_dataset("../data/colors.json", colors)
+    # save the pca plot as a fluid dataset
+    write_fluid_dataset("../data/pca_params.json", df_params_2d)
 
 
 # %%
 # create a 2D scatter plot of the PCA-d perceptual features
 
 # read dataset
-df_perceptual = pd.read_csv(
-    "../data/fm_synth_perceptual_features.csv", index_col=0)
+with metrics.phase("load"):
+    df_perceptual = load_table("../data/fm_synth_perceptual_features.columns",
+                               fallback_csv="../data/fm_synth_perceptual_features.csv")
 # extract perceptual features
 df_perceptual_7d = df_perceptual[[
     "hardness", "depth", "brightness", "roughness", "warmth", "sharpness", "boominess"]]
@@ -113,14 +134,16 @@ df_perceptual_7d_filtered_scaled = pd.DataFrame(
 
 # create PCA
 pca = PCA(n_components=2, whiten=True, random_state=42)
-# fit PCA
-pca.fit(df_perceptual_7d_filtered_scaled)
-# transform
-df_perceptual_2d = pca.transform(df_perceptual_7d_filtered_scaled)
+with metrics.phase("pca"):
+    # fit PCA
+    pca.fit(df_perceptual_7d_filtered_scaled)
+    # transform
+    df_perceptual_2d = pca.transform(df_perceptual_7d_filtered_scaled)
 
 # create scatter plot with small dots
 plt.figure(dpi=300)
-plt.scatter(df_perceptual_2d[:, 0], df_perceptual_2d[:, 1], s=1, c=colors)
+with metrics.phase("plot"):
+    scatter(df_perceptual_2d[:, 0], df_perceptual_2d[:, 1], s=1, c=colors)
 fontsize = 18
 plt.xlabel("PCA – 1st component", fontsize=fontsize)
 plt.ylabel("PCA – 2nd component", fontsize=fontsize)
@@ -128,20 +151,21 @@ plt.title(
     f"PCA of FM synth perceptual features\nexplained variance ratio: {np.round(pca.explained_variance_ratio_.sum(), 2)}", fontsize=fontsize)
 
 # save figure as png
-plt.savefig("../figures/pca_perceptual.png", format="png")
+with metrics.phase("plot"):
+    plt.savefig("../figures/pca_perceptual.png", format="png")
 
 # save the pca plot as a fluid dataset
-pca_perceptual = array2fluid_dataset(df_perceptual_2d)
-with open("../data/pca_perceptual.json", "w") as f:
-    json.dump(pca_perceptual, f)
+with metrics.phase("serialization"):
+    write_fluid_dataset("../data/pca_perceptual.json", df_perceptual_2d)
 
 
 # %%
 # create a 2D scatter plot of the PCA-d spectral features
 
 # read dataset
-df_spectral = pd.read_csv(
-    "../data/fm_synth_spectral_features.csv", index_col=0)
+with metrics.phase("load"):
+    df_spectral = load_table("../data/fm_synth_spectral_features.columns",
+                             fallback_csv="../data/fm_synth_spectral_features.csv")
 
 # extract spectral features
 df_spectral_11d = df_spectral[[
@@ -176,14 +200,16 @@ df_spectral_11d_scaled = pd.DataFrame(
 
 # create PCA
 pca = PCA(n_components=2, whiten=True, random_state=42)
-# fit PCA
-pca.fit(df_spectral_11d_scaled)
-# transform
-df_spectral_2d = pca.transform(df_spectral_11d_scaled)
+with metrics.phase("pca"):
+    # fit PCA
+    pca.fit(df_spectral_11d_scaled)
+    # transform
+    df_spectral_2d = pca.transform(df_spectral_11d_scaled)
 
 # create scatter plot with small dots
 plt.figure(dpi=300)
-plt.scatter(df_spectral_2d[:, 0], df_spectral_2d[:, 1], s=1, c=colors)
+with metrics.phase("plot"):
+    scatter(df_spectral_2d[:, 0], df_spectral_2d[:, 1], s=1, c=colors)
 fontsize = 18
 plt.xlabel("PCA – 1st component", fontsize=fontsize)
 plt.ylabel("PCA – 2nd component", fontsize=fontsize)
@@ -191,30 +217,37 @@ plt.title(
     f"PCA of FM synth spectral features\nexplained variance ratio: {np.round(pca.explained_variance_ratio_.sum(), 2)}", fontsize=fontsize)
 
 # save figure as png
-plt.savefig("../figures/pca_spectral.png", format="png")
+with metrics.phase("plot"):
+    plt.savefig("../figures/pca_spectral.png", format="png")
 
 # save the pca plot as a fluid dataset
-pca_spectral = array2fluid_dataset(df_spectral_2d)
-with open("../data/pca_spectral.json", "w") as f:
-    json.dump(pca_spectral, f)
+with metrics.phase("serialization"):
+    write_fluid_dataset("../data/pca_spectral.json", df_spectral_2d)
 
 
 # %%
 # create pca plot for embeddings - ENCODEC
 # read embeddings
-embeddings = np.load("../data/fm_synth_encodec_embeddings.npy")
+with metrics.phase("load"):
+    embeddings = np.load("../data/fm_synth_encodec_embeddings.npy",
+                         mmap_mode="r" if out_of_core else None)
 embeddings_2d = embeddings.reshape((embeddings.shape[0], -1))
 
 # create PCA
-pca = PCA(n_components=2, whiten=True, random_state=42)
-# fit PCA
-pca.fit(embeddings_2d)
-# transform
-embeddings_2d_pca = pca.transform(embeddings_2d)
+if out_of_core:
+    pca = StreamingPCA(n_components=2, whiten=True, random_state=42)
+else:
+    pca = PCA(n_components=2, whiten=True, random_state=42)
+with metrics.phase("pca"):
+    # fit PCA
+    pca.fit(embeddings_2d)
+    # transform
+    embeddings_2d_pca = pca.transform(embeddings_2d)
 
 # create scatter plot with small dots
 plt.figure(dpi=300)
-plt.scatter(embeddings_2d_pca[:, 0], embeddings_2d_pca[:, 1], s=1, c=colors)
+with metrics.phase("plot"):
+    scatter(embeddings_2d_pca[:, 0], embeddings_2d_pca[:, 1], s=1, c=colors)
 fontsize = 18
 plt.xlabel("PCA – 1st component", fontsize=fontsize)
 plt.ylabel("PCA – 2nd component", fontsize=fontsize)
@@ -222,28 +255,35 @@ plt.title(
     f"PCA of FM synth EnCodec embeddings\nexplained variance ratio: {np.round(pca.explained_variance_ratio_.sum(), 2)}", fontsize=fontsize)
 
 # save figure as png
-plt.savefig("../figures/pca_encodec.png", format="png")
+with metrics.phase("plot"):
+    plt.savefig("../figures/pca_encodec.png", format="png")
 
 # save the pca plot as a fluid dataset
-pca_embeddings = array2fluid_dataset(embeddings_2d_pca)
-with open("../data/pca_encodec.json", "w") as f:
-    json.dump(pca_embeddings, f)
+with metrics.phase("serialization"):
+    write_fluid_dataset("../data/pca_encodec.json", embeddings_2d_pca)
 
 # %%
 # create pca plot for embeddings - CLAP
 # read embeddings
-embeddings = np.load("../data/fm_synth_clap_embeddings.npy")
+with metrics.phase("load"):
+    embeddings = np.load("../data/fm_synth_clap_embeddings.npy",
+                         mmap_mode="r" if out_of_core else None)
 
 # create PCA
-pca = PCA(n_components=2, whiten=True, random_state=42)
-# fit PCA
-pca.fit(embeddings)
-# transform
-embeddings_2d_pca = pca.transform(embeddings)
+if out_of_core:
+    pca = StreamingPCA(n_components=2, whiten=True, random_state=42)
+else:
+    pca = PCA(n_components=2, whiten=True, random_state=42)
+with metrics.phase("pca"):
+    # fit PCA
+    pca.fit(embeddings)
+    # transform
+    embeddings_2d_pca = pca.transform(embeddings)
 
 # create scatter plot with small dots
 plt.figure(dpi=300)
-plt.scatter(embeddings_2d_pca[:, 0], embeddings_2d_pca[:, 1], s=1, c=colors)
+with metrics.phase("plot"):
+    scatter(embeddings_2d_pca[:, 0], embeddings_2d_pca[:, 1], s=1, c=colors)
 fontsize = 18
 plt.xlabel("PCA – 1st component", fontsize=fontsize)
 plt.ylabel("PCA – 2nd component", fontsize=fontsize)
@@ -251,29 +291,36 @@ plt.title(
     f"PCA of FM synth CLAP embeddings\nexplained variance ratio: {np.round(pca.explained_variance_ratio_.sum(), 2)}", fontsize=fontsize)
 
 # save figure as png
-plt.savefig("../figures/pca_clap.png", format="png")
+with metrics.phase("plot"):
+    plt.savefig("../figures/pca_clap.png", format="png")
 
 # save the pca plot as a fluid dataset
-pca_embeddings = array2fluid_dataset(embeddings_2d_pca)
-with open("../data/pca_clap.json", "w") as f:
-    json.dump(pca_embeddings, f)
+with metrics.phase("serialization"):
+    write_fluid_dataset("../data/pca_clap.json", embeddings_2d_pca)
 
 
 # %%
 # create pca plot for mel spectrograms - mean
 # read mel spectrograms
-mel_spectrograms = np.load("../data/fm_synth_mel_spectrograms_mean.npy")
+with metrics.phase("load"):
+    mel_spectrograms = np.load("../data/fm_synth_mel_spectrograms_mean.npy",
+                               mmap_mode="r" if out_of_core else None)
 
 # create PCA
-pca = PCA(n_components=2, whiten=True, random_state=42)
-# fit PCA
-pca.fit(mel_spectrograms)
-# transform
-mel_spectrograms_2d_pca = pca.transform(mel_spectrograms)
+if out_of_core:
+    pca = StreamingPCA(n_components=2, whiten=True, random_state=42)
+else:
+    pca = PCA(n_components=2, whiten=True, random_state=42)
+with metrics.phase("pca"):
+    # fit PCA
+    pca.fit(mel_spectrograms)
+    # transform
+    mel_spectrograms_2d_pca = pca.transform(mel_spectrograms)
 
 # create scatter plot with small dots
 plt.figure(dpi=300)
-plt.scatter(mel_spectrograms_2d_pca[:, 0],
+with metrics.phase("plot"):
+    scatter(mel_spectrograms_2d_pca[:, 0],
             mel_spectrograms_2d_pca[:, 1], s=1, c=colors)
 fontsize = 18
 plt.xlabel("PCA – 1st component", fontsize=fontsize)
@@ -282,11 +329,13 @@ plt.title(
     f"PCA of FM synth mel spectrograms (mean)\nexplained variance ratio: {np.round(pca.explained_variance_ratio_.sum(), 2)}", fontsize=fontsize)
 
 # save figure as png
-plt.savefig("../figures/pca_mels_mean.png", format="png")
+with metrics.phase("plot"):
+    plt.savefig("../figures/pca_mels_mean.png", format="png")
 
 # save the pca plot as a fluid dataset
-pca_mels = array2fluid_dataset(mel_spectrograms_2d_pca)
-with open("../data/pca_mels_mean.json", "w") as f:
-    json.dump(pca_mels, f)
+with metrics.phase("serialization"):
+    write_fluid_dataset("../data/pca_mels_mean.json", mel_spectrograms_2d_pca)
 
 # %%
+# save the metrics report
+metrics.write("../data/pca_plots.metrics.json")
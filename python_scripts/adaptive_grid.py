@@ -0,0 +1,169 @@
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from utils import midi2frequency
+from fm_spectrum import analytic_pressure_spectrum
+from spectral_features import spectrum_frequencies, spectral_descriptors
+from param_grid import PITCH_RANGE, HARM_RATIO_RANGE, MOD_INDEX_RANGE
+
+
+# the corners of a unit cell as lattice offsets
+_CORNERS = np.array(list(itertools.product((0, 1), repeat=3)))
+
+
+def lattice_parameters(
+        coords: np.ndarray,
+        steps: int,
+) -> tuple:
+    """
+    Get the synth parameters of points on a lattice of the parameter space with steps points
+    per axis, the same values as a dense grid of 01_build_fm_synth_params.py with that many
+    steps has.
+
+    Args:
+        coords (np.ndarray): The (N, 3) integer lattice coordinates (pitch, ratio, index).
+        steps (int): The number of lattice points per axis.
+
+    Returns:
+        tuple: The freq, harm_ratio and mod_index arrays (N,).
+    """
+    pitches = np.linspace(*PITCH_RANGE, steps)
+    ratios = np.linspace(0, 1, steps) * HARM_RATIO_RANGE[1]
+    indices = np.linspace(0, 1, steps) * MOD_INDEX_RANGE[1]
+    return midi2frequency(pitches[coords[:, 0]]), ratios[coords[:, 1]], indices[coords[:, 2]]
+
+
+def centroid_spread_feature(
+        freq: np.ndarray,
+        harm_ratio: np.ndarray,
+        mod_index: np.ndarray,
+        sr: int = 48000,
+        dur: float = 1,
+        block_rows: int = 4096,
+) -> np.ndarray:
+    """
+    The default feature of adaptive_parameter_table: the spectral centroid and spread of
+    stage 03 in octaves (log2 Hz), computed analytically (see
+    fm_spectrum.analytic_pressure_spectrum), so no audio is rendered.
+
+    Args:
+        freq (np.ndarray): The carrier frequencies (N,).
+        harm_ratio (np.ndarray): The harmonicity ratios (N,).
+        mod_index (np.ndarray): The modulation indices (N,).
+        sr (int, optional): The sample rate. Defaults to 48000.
+        dur (float, optional): The duration of the tones in seconds. Defaults to 1.
+        block_rows (int, optional): The number of tones computed at a time. Defaults to 4096.
+
+    Returns:
+        np.ndarray: The (N, 2) features.
+    """
+    frequencies = spectrum_frequencies(sr, 4096)
+    features = np.zeros((len(freq), 2))
+    for start in range(0, len(freq), block_rows):
+        stop = min(start + block_rows, len(freq))
+        pressures = analytic_pressure_spectrum(
+            sr, freq[start:stop], harm_ratio[start:stop], mod_index[start:stop], dur)
+        descriptors = spectral_descriptors(frequencies, pressures)
+        features[start:stop, 0] = descriptors["spectral_centroid"]
+        features[start:stop, 1] = descriptors["spectral_spread"]
+    return np.log2(features)
+
+
+def adaptive_parameter_table(
+        coarse_steps: int = 7,
+        max_depth: int = 3,
+        tolerance: float = 0.1,
+        feature=centroid_spread_feature,
+) -> pd.DataFrame:
+    """
+    Sample the parameter space adaptively instead of with a dense grid. Starting from a
+    coarse grid, the feature is evaluated at the center of every cell and compared with the
+    mean of its 8 corners. Where this interpolation error (the RMS difference of the feature
+    vectors) is larger than tolerance, the cell is split into 8, up to max_depth times. So
+    regions where the sound changes smoothly keep the coarse spacing, and only the regions
+    with more detail get the resolution of the finest lattice, which has
+    (coarse_steps - 1) * 2 ** max_depth + 1 points per axis.
+
+    Args:
+        coarse_steps (int, optional): The number of points per axis of the coarse grid. Defaults to 7.
+        max_depth (int, optional): The number of times a cell can be split. Defaults to 3.
+        tolerance (float, optional): The largest interpolation error of a cell that is not
+            split (in octaves for centroid_spread_feature). Defaults to 0.1.
+        feature (callable, optional): A function of (freq, harm_ratio, mod_index) arrays
+            returning an (N, D) feature array. Defaults to centroid_spread_feature.
+
+    Returns:
+        pd.DataFrame: The parameter table in the format of 01_build_fm_synth_params.py, with
+            x, y, z as the coordinates on the finest lattice (x for pitch, y for harmonicity
+            ratio, z for modulation index), in the same order as the dense grid.
+    """
+    steps = (coarse_steps - 1) * 2 ** max_depth + 1
+    size = 2 ** max_depth
+    # the row of each evaluated lattice point in features, -1 if not evaluated yet
+    lookup = np.full((steps, steps, steps), -1, dtype=np.int64)
+    coords = np.zeros((0, 3), dtype=np.int64)
+    features = None
+
+    def evaluate(points):
+        nonlocal coords, features
+        points = np.unique(points, axis=0)
+        points = points[lookup[points[:, 0], points[:, 1], points[:, 2]] < 0]
+        if len(points) == 0:
+            return
+        lookup[points[:, 0], points[:, 1], points[:, 2]] = len(coords) + np.arange(len(points))
+        new_features = feature(*lattice_parameters(points, steps))
+        coords = np.concatenate([coords, points])
+        features = new_features if features is None else np.concatenate([features, new_features])
+
+    # the coarse grid and its cells (as their lowest corners)
+    axis = np.arange(0, steps, size)
+    evaluate(np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), -1).reshape(-1, 3))
+    cells = np.stack(np.meshgrid(axis[:-1], axis[:-1], axis[:-1], indexing="ij"), -1).reshape(-1, 3)
+    for _ in range(max_depth):
+        # the centers are points of the split cells, so they are not evaluated in vain
+        centers = cells + size // 2
+        evaluate(centers)
+        corners = cells[:, None, :] + _CORNERS[None] * size
+        corner_features = features[lookup[corners[..., 0], corners[..., 1], corners[..., 2]]]
+        center_features = features[lookup[centers[:, 0], centers[:, 1], centers[:, 2]]]
+        error = np.sqrt(np.mean((center_features - corner_features.mean(axis=1)) ** 2, axis=-1))
+        # cells with an undefined error (e.g. a silent corner) are split too
+        cells = cells[~(error <= tolerance)]
+        if len(cells) == 0:
+            break
+        size //= 2
+        cells = (cells[:, None, :] + _CORNERS[None] * size).reshape(-1, 3)
+        # the 27 points of each split cell
+        evaluate((cells[:, None, :] + _CORNERS[None] * size).reshape(-1, 3))
+
+    # same row order as the dense grid: y, then x, then z
+    coords = coords[np.lexsort((coords[:, 2], coords[:, 0], coords[:, 1]))]
+    freq, harm_ratio, mod_index = lattice_parameters(coords, steps)
+    return pd.DataFrame({
+        "x": coords[:, 0],
+        "y": coords[:, 1],
+        "z": coords[:, 2],
+        "freq": freq,
+        "harm_ratio": harm_ratio,
+        "mod_index": mod_index,
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sample the FM parameter space adaptively and save it as a parameter table.")
+    parser.add_argument("--coarse-steps", type=int, default=7,
+                        help="the number of points per axis of the coarse grid")
+    parser.add_argument("--max-depth", type=int, default=3,
+                        help="the number of times a cell can be split")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="the largest interpolation error (in octaves of centroid and spread) of a cell that is not split")
+    parser.add_argument("--out", default="../data/fm_synth_params_adaptive.csv",
+                        help="the parameter table to write")
+    args = parser.parse_args()
+    df = adaptive_parameter_table(args.coarse_steps, args.max_depth, args.tolerance)
+    steps = (args.coarse_steps - 1) * 2 ** args.max_depth + 1
+    print(f"{len(df)} points instead of {steps ** 3} for the dense {steps}^3 grid")
+    df.to_csv(args.out, index=True)
+    print(f"Saved {args.out}")
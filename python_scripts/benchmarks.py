@@ -0,0 +1,331 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+from param_grid import ParamGrid
+
+# the dense grid of 01_build_fm_synth_params.py, which the benchmarks sample rows from
+GRID_STEPS = 51
+SR = 48000
+DUR = 1
+SEED = 42
+
+
+def grid_subset(
+        num: int,
+        seed: int = SEED,
+) -> tuple:
+    """
+    Get the parameters of a fixed random subset of the rows of the dense grid.
+
+    Args:
+        num (int): The number of rows.
+        seed (int, optional): The seed of the subset. Defaults to SEED.
+
+    Returns:
+        tuple: The freq, harm_ratio and mod_index arrays (num,).
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(GRID_STEPS ** 3, num, replace=False))
+    return ParamGrid(GRID_STEPS, GRID_STEPS, GRID_STEPS).params(rows)
+
+
+def _dataset(num):
+    from utils import FmSynthDataset
+    return FmSynthDataset.from_arrays(*grid_subset(num), sr=SR, dur=DUR)
+
+
+# each benchmark sets up its inputs and returns the number of items one run processes and
+# a function that runs it; only the run is timed
+
+
+def bench_phasor():
+    from utils import phasor
+    freq, _, _ = grid_subset(64)
+    def run():
+        for f in freq:
+            phasor(SR * DUR, SR, f[None])
+    return len(freq), run
+
+
+def bench_phasor_vectorized():
+    from utils import phasor_vectorized
+    freq, _, _ = grid_subset(64)
+    def run():
+        for f in freq:
+            phasor_vectorized(SR * DUR, SR, f[None])
+    return len(freq), run
+
+
+def bench_sinewave():
+    from utils import sinewave
+    freq, _, _ = grid_subset(64)
+    def run():
+        for f in freq:
+            sinewave(SR * DUR, SR, f[None])
+    return len(freq), run
+
+
+def bench_fm_synth_gen():
+    from utils import fm_synth_gen
+    params = np.stack(grid_subset(64), axis=-1)
+    def run():
+        for freq, harm_ratio, mod_index in params:
+            fm_synth_gen(SR * DUR, SR, freq[None], harm_ratio[None], mod_index[None])
+    return len(params), run
+
+
+def bench_fm_synth_gen_batch():
+    from utils import fm_synth_gen_batch
+    params = grid_subset(64)
+    def run():
+        fm_synth_gen_batch(SR * DUR, SR, *params)
+    return len(params[0]), run
+
+
+def bench_fm_synth_gen_batch_vectorized():
+    from utils import fm_synth_gen_batch
+    params = grid_subset(64)
+    def run():
+        fm_synth_gen_batch(SR * DUR, SR, *params, vectorized=True)
+    return len(params[0]), run
+
+
+def bench_dataset_getitem():
+    ds = _dataset(64)
+    def run():
+        for i in range(len(ds)):
+            ds[i]
+    return len(ds), run
+
+
+def bench_perceptual_features():
+    # extract_features of stage 02, item by item as its workers run it
+    stage = importlib.import_module("02_build_perceptual_ds")
+    ds = _dataset(4)
+    def run():
+        for i in range(len(ds)):
+            stage.extract_features(i, ds, SR)
+    return len(ds), run
+
+
+def bench_spectral_features():
+    # extract_features of stage 03, one chunk as its workers run it
+    stage = importlib.import_module("03_build_spectral_ds")
+    ds = _dataset(64)
+    def run():
+        stage.extract_features(np.arange(len(ds)), ds, SR)
+    return len(ds), run
+
+
+def bench_mel_spectrograms():
+    # one batch of the stage 04 mel pass, with its settings
+    import torch
+    from torchaudio.functional import amplitude_to_DB
+    from torchaudio.transforms import MelSpectrogram
+    y = torch.from_numpy(_dataset(64).get_batch(np.arange(64))[0]).to(torch.float32)
+    mel_spec = MelSpectrogram(sample_rate=SR, n_fft=4096, f_min=20, f_max=10000, pad=1,
+                              n_mels=200, power=2, norm="slaney", mel_scale="slaney")
+    def run():
+        with torch.inference_mode():
+            mel_avg = mel_spec(y).mean(dim=2, keepdim=True).unsqueeze(1)
+            amplitude_to_DB(mel_avg, multiplier=10, amin=1e-5, db_multiplier=20, top_db=80)
+    return len(y), run
+
+
+def bench_fluid_export_dict():
+    # array2fluid_dataset and json.dump, as stages 01 and 06 exported before streaming
+    from utils import array2fluid_dataset
+    array = np.random.default_rng(SEED).normal(size=(GRID_STEPS ** 3, 2))
+    path = os.path.join(tempfile.mkdtemp(), "map.json")
+    def run():
+        with open(path, "w") as f:
+            json.dump(array2fluid_dataset(array), f)
+    return len(array), run
+
+
+def bench_fluid_export_streamed():
+    from fluid_dataset import write_fluid_dataset
+    array = np.random.default_rng(SEED).normal(size=(GRID_STEPS ** 3, 2))
+    path = os.path.join(tempfile.mkdtemp(), "map.json")
+    def run():
+        write_fluid_dataset(path, array)
+    return len(array), run
+
+
+def _feature_matrix(num_rows, num_cols):
+    # a matrix with a decaying spectrum, like the mel spectrograms and embeddings
+    rng = np.random.default_rng(SEED)
+    scales = 1 / np.arange(1, num_cols + 1)
+    return ((rng.normal(size=(num_rows, num_cols)) * scales) @
+            np.linalg.qr(rng.normal(size=(num_cols, num_cols)))[0]).astype(np.float32)
+
+
+def bench_pca_fit():
+    # the stage 06 PCA of a (N, 200) matrix, the size of the mel spectrograms
+    from sklearn.decomposition import PCA
+    X = _feature_matrix(20000, 200)
+    def run():
+        PCA(n_components=2, whiten=True, random_state=42).fit_transform(X)
+    return len(X), run
+
+
+def bench_streaming_pca_fit():
+    from streaming_pca import StreamingPCA
+    X = _feature_matrix(20000, 200)
+    def run():
+        StreamingPCA(n_components=2, whiten=True, random_state=42).fit_transform(X)
+    return len(X), run
+
+
+BENCHMARKS = {
+    "phasor": bench_phasor,
+    "phasor_vectorized": bench_phasor_vectorized,
+    "sinewave": bench_sinewave,
+    "fm_synth_gen": bench_fm_synth_gen,
+    "fm_synth_gen_batch": bench_fm_synth_gen_batch,
+    "fm_synth_gen_batch_vectorized": bench_fm_synth_gen_batch_vectorized,
+    "dataset_getitem": bench_dataset_getitem,
+    "perceptual_features": bench_perceptual_features,
+    "spectral_features": bench_spectral_features,
+    "mel_spectrograms": bench_mel_spectrograms,
+    "fluid_export_dict": bench_fluid_export_dict,
+    "fluid_export_streamed": bench_fluid_export_streamed,
+    "pca_fit": bench_pca_fit,
+    "streaming_pca_fit": bench_streaming_pca_fit,
+}
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def _run(name, repeats):
+    num_items, run = BENCHMARKS[name]()
+    setup_rss = _peak_rss_mb()
+    # the first run compiles and warms up caches
+    run()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {
+        "items": num_items,
+        "seconds": min(times),
+        "items_per_second": num_items / min(times),
+        "peak_rss_mb": _peak_rss_mb(),
+        "setup_rss_mb": setup_rss,
+    }
+
+
+def run_benchmark(
+        name: str,
+        repeats: int = 3,
+) -> dict:
+    """
+    Run a benchmark in a fresh process, so its peak memory is its own.
+
+    Args:
+        name (str): The name of the benchmark, one of BENCHMARKS.
+        repeats (int, optional): The number of timed runs, after one warm-up run. Defaults to 3.
+
+    Returns:
+        dict: The items per run, the seconds of the fastest run, the items per second, the
+            peak resident memory of the process in MB and its peak before the first run
+            (after the imports and the setup), or the error if it failed.
+    """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        try:
+            return pool.submit(_run, name, repeats).result()
+        except Exception as error:
+            return {"error": f"{type(error).__name__}: {error}"}
+
+
+def check_regressions(
+        results: dict,
+        baseline: dict,
+        tolerance: float = 0.2,
+) -> dict:
+    """
+    Add regression thresholds from a baseline to the results: a benchmark regressed if it
+    processes fewer items per second than (1 - tolerance) times the baseline, or uses more
+    peak memory than (1 + tolerance) times the baseline.
+
+    Args:
+        results (dict): The results of run_benchmark by name.
+        baseline (dict): Earlier results by name (e.g. the "results" of a saved report).
+        tolerance (float, optional): The allowed relative change. Defaults to 0.2.
+
+    Returns:
+        dict: The results, each with min_items_per_second, max_peak_rss_mb and passed if
+            the baseline has it.
+    """
+    for name, result in results.items():
+        reference = baseline.get(name, {})
+        if "error" in result or "items_per_second" not in reference:
+            continue
+        result["min_items_per_second"] = reference["items_per_second"] * (1 - tolerance)
+        result["max_peak_rss_mb"] = reference["peak_rss_mb"] * (1 + tolerance)
+        result["passed"] = bool(
+            result["items_per_second"] >= result["min_items_per_second"] and
+            result["peak_rss_mb"] <= result["max_peak_rss_mb"])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths of the pipeline on a fixed subset of the parameter grid.")
+    parser.add_argument("names", nargs="*",
+                        help=f"the benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="the number of timed runs per benchmark")
+    parser.add_argument("--baseline", default=None,
+                        help="a saved report to check the results against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="the allowed relative slowdown or memory increase against the baseline")
+    parser.add_argument("--out", default="../data/benchmarks.json",
+                        help="the report to write")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = run_benchmark(name, args.repeats)
+        result = results[name]
+        if "error" in result:
+            print(f"{name}: {result['error']}")
+        else:
+            print(f"{name}: {result['items_per_second']:.1f} items/s, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            check_regressions(results, json.load(f)["results"], args.tolerance)
+    report = {
+        "grid_steps": GRID_STEPS,
+        "seed": SEED,
+        "sr": SR,
+        "dur": DUR,
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpus": os.cpu_count()},
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {args.out}")
+    regressed = [name for name, result in results.items() if result.get("passed") is False]
+    if regressed:
+        print(f"Regressed: {', '.join(regressed)}")
+        sys.exit(1)
@@ -0,0 +1,166 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+def records2columns(records: list) -> dict:
+    """
+    Convert a list of results (dicts with the same keys) to typed column arrays.
+
+    Args:
+        records (list): The results.
+
+    Returns:
+        dict: The keys mapped to NumPy arrays of their values.
+    """
+    return {key: np.asarray([record[key] for record in records])
+            for key in records[0]}
+
+
+class ResultShards:
+    """
+    Append-only checkpoint for per-item results (dicts with an "index" key). Every call to
+    write stores one new shard, an .npz file holding one typed array per result key, which only
+    appears under its final name once it is fully on disk, so a crash never leaves a
+    half-written shard behind. Runs can resume by skipping the indices that are already stored,
+    and the stored results can be read at any time (even while a run is still writing) as a
+    consistent partial result. Once a run is complete, ColumnStore.from_shards assembles the
+    shards into the final table, and clear removes them.
+
+    Given a key (e.g. sharding.dataset_key of the dataset), the directory records it when it is
+    created, and refuses to resume a run with a different key, so results of another parameter
+    table, sample rate or duration are never mixed in.
+    """
+
+    def __init__(self, directory: str, key: str = None):
+        """
+        Args:
+            directory (str): The directory to hold the shards. Created if it does not exist.
+            key (str, optional): The key of the run, see above. Defaults to None, which does
+                not check it.
+
+        Raises:
+            ValueError: If the directory holds shards of a run with another (or without a) key.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.num_written = 0
+        if key is not None:
+            self._check_key(key)
+
+    def _key_path(self) -> str:
+        return os.path.join(self.directory, "key.json")
+
+    def _check_key(self, key: str) -> None:
+        path = self._key_path()
+        if os.path.exists(path):
+            with open(path) as f:
+                previous = json.load(f)["key"]
+        else:
+            previous = None if self.shard_paths() else key
+        if previous != key:
+            raise ValueError(
+                f"{self.directory} holds results of a different run ({previous}, not {key}), "
+                "remove it to start over")
+        if not os.path.exists(path):
+            with open(path + ".tmp", "w") as f:
+                json.dump({"key": key}, f)
+            os.replace(path + ".tmp", path)
+
+    def shard_paths(self) -> list:
+        """
+        List the complete shards.
+
+        Returns:
+            list: The paths of the shard files, sorted by name.
+        """
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(".npz"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def clear(self) -> None:
+        """
+        Remove the stored shards and the key, and the directory if nothing else is in it.
+        """
+        for path in self.shard_paths() + [self._key_path()]:
+            if os.path.exists(path):
+                os.remove(path)
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            # e.g. the shard_<i>_of_<n> directories of a sharded run (see sharding.py)
+            pass
+
+    def write(self, records: list) -> None:
+        """
+        Store a list of results as a new shard.
+
+        Args:
+            records (list): The results, each a dict with an "index" key.
+        """
+        if len(records) == 0:
+            return
+        columns = records2columns(records)
+        name = f"{columns['index'].min():09d}_{os.getpid()}_{self.num_written}.npz"
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **columns)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.num_written += 1
+
+    def iter_shards(self):
+        """
+        Iterate over the stored shards.
+
+        Yields:
+            dict: The column arrays of the next shard.
+        """
+        for path in self.shard_paths():
+            with np.load(path) as shard:
+                yield {key: shard[key] for key in shard.files}
+
+    def completed(self) -> np.ndarray:
+        """
+        Get the indices that are already stored.
+
+        Returns:
+            np.ndarray: The sorted unique indices.
+        """
+        indices = []
+        for path in self.shard_paths():
+            with np.load(path) as shard:
+                indices.append(shard["index"])
+        if len(indices) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(indices))
+
+    def remaining(self, num_items: int) -> np.ndarray:
+        """
+        Get the indices of a run over num_items items that are not stored yet.
+
+        Args:
+            num_items (int): The total number of items in the run.
+
+        Returns:
+            np.ndarray: The sorted indices still to process.
+        """
+        return np.setdiff1d(np.arange(num_items), self.completed())
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Read all stored results as a DataFrame indexed (and sorted) by "index". If an index
+        was stored twice, the first one is kept.
+
+        Returns:
+            pd.DataFrame: The results so far.
+        """
+        frames = [pd.DataFrame(columns) for columns in self.iter_shards()]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        df = df.drop_duplicates("index").set_index("index")
+        return df.sort_index()
@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+import pandas as pd
+
+
+class ColumnStore:
+    """
+    A table stored as one typed .npy file per column in a directory, with row i holding the
+    result for index i. Columns are read back as memory maps, so the store can be larger than
+    memory, and CSV/JSON versions are only derived from it on demand (see export_csv and
+    export_json).
+    """
+
+    def __init__(self, directory: str):
+        """
+        Open an existing store.
+
+        Args:
+            directory (str): The directory of the store.
+        """
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.num_items = meta["num_items"]
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in meta["columns"]}
+
+    @classmethod
+    def create(cls, directory: str, num_items: int, dtypes: dict):
+        """
+        Create an empty store with preallocated columns.
+
+        Args:
+            directory (str): The directory of the store. Must not exist yet.
+            num_items (int): The number of rows.
+            dtypes (dict): The column names mapped to their dtypes, in column order.
+
+        Returns:
+            ColumnStore: The new store.
+        """
+        os.makedirs(directory)
+        for name, dtype in dtypes.items():
+            open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+",
+                        dtype=dtype, shape=(num_items,))
+        meta = {"num_items": num_items,
+                "columns": [[name, np.dtype(dtype).str] for name, dtype in dtypes.items()]}
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return cls(directory)
+
+    @classmethod
+    def from_shards(cls, shards, directory: str, num_items: int):
+        """
+        Assemble the shards of a finished run into a store, streaming one shard at a time.
+        The store is built next to its final location and only moved there once complete.
+
+        Args:
+            shards (ResultShards): The checkpointed results.
+            directory (str): The directory of the store. Replaced if it exists.
+            num_items (int): The number of rows. Every index below it must be in the shards.
+
+        Returns:
+            ColumnStore: The assembled store.
+        """
+        tmp_directory = directory + ".tmp"
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        store = None
+        written = np.zeros(num_items, dtype=bool)
+        for columns in shards.iter_shards():
+            if store is None:
+                dtypes = {name: values.dtype for name, values in columns.items()}
+                store = cls.create(tmp_directory, num_items, dtypes)
+            store.write(columns["index"], columns)
+            written[columns["index"]] = True
+        if store is None or not written.all():
+            raise ValueError(
+                f"{num_items - written.sum()} of {num_items} indices are missing from {shards.directory}")
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+        return cls(directory)
+
+    def __len__(self):
+        return self.num_items
+
+    @property
+    def columns(self) -> list:
+        return list(self.dtypes)
+
+    def column(self, name: str, mode: str = "r") -> np.ndarray:
+        """
+        Open a column as a memory map.
+
+        Args:
+            name (str): The column name.
+            mode (str, optional): The memory map mode. Defaults to "r".
+
+        Returns:
+            np.ndarray: The column.
+        """
+        return np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode=mode)
+
+    def write(self, indices: np.ndarray, columns: dict) -> None:
+        """
+        Write values at the given row indices.
+
+        Args:
+            indices (np.ndarray): The row indices.
+            columns (dict): The column names mapped to value arrays aligned with indices.
+        """
+        for name, values in columns.items():
+            column = self.column(name, mode="r+")
+            column[indices] = values
+            column.flush()
+
+    def to_frame(self, columns: list = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        """
+        Read (a range of rows of) the store as a DataFrame indexed by "index".
+
+        Args:
+            columns (list, optional): The columns to read. Defaults to None, which means all of them.
+            start (int, optional): The first row. Defaults to 0.
+            stop (int, optional): The end row (exclusive). Defaults to None, which means all rows.
+
+        Returns:
+            pd.DataFrame: The table.
+        """
+        if columns is None:
+            columns = [name for name in self.columns if name != "index"]
+        df = pd.DataFrame({name: np.asarray(self.column(name)[start:stop])
+                           for name in columns})
+        df.index = pd.Index(np.arange(start, start + len(df)), name="index")
+        return df
+
+    def iter_frames(self, chunk_rows: int = 65536):
+        """
+        Iterate over the store in row chunks.
+
+        Args:
+            chunk_rows (int, optional): The number of rows per chunk. Defaults to 65536.
+
+        Yields:
+            pd.DataFrame: The next chunk of rows.
+        """
+        for start in range(0, self.num_items, chunk_rows):
+            yield self.to_frame(start=start, stop=min(start + chunk_rows, self.num_items))
+
+    def export_csv(self, path: str, chunk_rows: int = 65536) -> None:
+        """
+        Write the store as a CSV file (in the format the pipeline used to write), chunk by chunk.
+
+        Args:
+            path (str): The path of the CSV file.
+            chunk_rows (int, optional): The number of rows per chunk. Defaults to 65536.
+        """
+        for i, df in enumerate(self.iter_frames(chunk_rows)):
+            df.to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=True)
+
+    def export_json(self, path: str, chunk_rows: int = 65536) -> None:
+        """
+        Write the store as a JSON list of records (in the format the pipeline used to write),
+        chunk by chunk.
+
+        Args:
+            path (str): The path of the JSON file.
+            chunk_rows (int, optional): The number of rows per chunk. Defaults to 65536.
+        """
+        with open(path, "w") as f:
+            f.write("[")
+            for i, df in enumerate(self.iter_frames(chunk_rows)):
+                records = json.dumps(df.reset_index().to_dict(orient="records"))
+                if i > 0:
+                    f.write(",")
+                f.write(records[1:-1])
+            f.write("]")
+
+
+def load_table(directory: str, fallback_csv: str = None) -> pd.DataFrame:
+    """
+    Load a feature table from its ColumnStore, or from a CSV export if there is no store
+    (e.g. when using the data from the Zenodo record).
+
+    Args:
+        directory (str): The directory of the store.
+        fallback_csv (str, optional): The CSV file to read if the store does not exist. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The table, indexed by "index".
+    """
+    if os.path.isdir(directory) or fallback_csv is None:
+        return ColumnStore(directory).to_frame()
+    return pd.read_csv(fallback_csv, index_col=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a ColumnStore as CSV and/or JSON.")
+    parser.add_argument("store", help="the directory of the store")
+    parser.add_argument("--csv", help="path of the CSV file to write")
+    parser.add_argument("--json", help="path of the JSON file to write")
+    args = parser.parse_args()
+    store = ColumnStore(args.store)
+    if args.csv is not None:
+        store.export_csv(args.csv)
+        print(f"Saved {args.csv}")
+    if args.json is not None:
+        store.export_json(args.json)
+        print(f"Saved {args.json}")
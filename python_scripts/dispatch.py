@@ -0,0 +1,208 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from multiprocessing import shared_memory
+import os
+import time
+import numpy as np
+from utils import FmSynthDataset, warmup
+
+
+class SharedArray:
+    """
+    A NumPy array placed in shared memory once by the main process. Workers attach to it
+    through its (picklable) handle, so the data itself never goes through IPC.
+    """
+
+    def __init__(self, array: np.ndarray):
+        """
+        Args:
+            array (np.ndarray): The array to copy into shared memory.
+        """
+        array = np.ascontiguousarray(array)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(array.shape, dtype=array.dtype,
+                                buffer=self.shm.buf)
+        self.array[...] = array
+        self.handle = (self.shm.name, array.shape, array.dtype.str)
+
+    def close(self):
+        """
+        Release and remove the shared memory block.
+        """
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_shared_array(handle: tuple) -> tuple:
+    """
+    Attach to a SharedArray from another process.
+
+    Args:
+        handle (tuple): The handle of the SharedArray.
+
+    Returns:
+        tuple: The array view and the SharedMemory object (keep a reference to it while using the array).
+    """
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf), shm
+
+
+def available_cpus() -> int:
+    """
+    Get the number of CPUs a stage may use: the SYNTHMAPS_CPUS environment variable if it is
+    set (run_pipeline.py sets it when it runs stages side by side), otherwise all of them.
+
+    Returns:
+        int: The number of CPUs.
+    """
+    return int(os.environ.get("SYNTHMAPS_CPUS", os.cpu_count()))
+
+
+# per-worker state, set by _init_worker
+_worker_dataset = None
+_worker_shm = None
+
+
+def _init_worker(params_handle, sr, dur, audio_path):
+    global _worker_dataset, _worker_shm
+    warmup()
+    if isinstance(params_handle, dict):
+        # the spec of a ParamGrid, which computes the parameters itself
+        from param_grid import ParamGrid
+        _worker_dataset = FmSynthDataset.from_grid(
+            ParamGrid.from_spec(params_handle), sr=sr, dur=dur)
+    else:
+        params, _worker_shm = attach_shared_array(params_handle)
+        _worker_dataset = FmSynthDataset.from_arrays(
+            params[0], params[1], params[2], sr=sr, dur=dur)
+    if audio_path is not None:
+        from render_cache import open_render
+        _worker_dataset.audio = open_render(audio_path, _worker_dataset.samples)
+        _worker_dataset.audio_path = audio_path
+
+
+def _run_chunk(fn, chunk, args, batched):
+    if batched:
+        return fn(_chunk_indices(chunk), _worker_dataset, *args)
+    if isinstance(chunk, tuple):
+        chunk = range(*chunk)
+    return [fn(int(i), _worker_dataset, *args) for i in chunk]
+
+
+def _run_chunk_timed(fn, chunk, args, batched):
+    # _run_chunk, also returning when and how long the worker ran it
+    start, cpu = time.time(), time.process_time()
+    item_seconds = None
+    if batched:
+        results = _run_chunk(fn, chunk, args, batched)
+    else:
+        results, item_seconds = [], []
+        for i in (range(*chunk) if isinstance(chunk, tuple) else chunk):
+            item_start = time.perf_counter()
+            results.append(fn(int(i), _worker_dataset, *args))
+            item_seconds.append(time.perf_counter() - item_start)
+    timing = {"pid": os.getpid(), "start": start, "end": time.time(),
+              "cpu_seconds": time.process_time() - cpu, "items": len(results),
+              "item_seconds": item_seconds}
+    return results, timing
+
+
+def _iter_chunks(indices, num_items, chunk_size):
+    if indices is None:
+        # contiguous ranges are sent as (start, stop)
+        for start in range(0, num_items, chunk_size):
+            yield (start, min(start + chunk_size, num_items))
+    else:
+        indices = np.asarray(indices, dtype=np.int64)
+        for start in range(0, len(indices), chunk_size):
+            yield indices[start:start + chunk_size]
+
+
+def map_chunks(
+        fn,
+        dataset: FmSynthDataset,
+        *args,
+        indices: np.ndarray = None,
+        chunk_size: int = 64,
+        max_workers: int = None,
+        batched: bool = False,
+        metrics=None,
+):
+    """
+    Apply fn(i, dataset, *args) to dataset items in a pool of worker processes. The parameter
+    table is placed in shared memory once (or, for a grid dataset, its spec is sent), and each
+    worker builds its own dataset from it in its initializer (cached renders are shared through the render cache file). Work is then
+    submitted as chunks of indices, with at most two chunks in flight per worker, so neither
+    IPC volume nor the number of pending futures grows with the dataset size.
+
+    Args:
+        fn (callable): A picklable (module-level) function taking (i, dataset, *args).
+        dataset (FmSynthDataset): The dataset to process.
+        *args: Extra arguments passed to fn, sent once per chunk.
+        indices (np.ndarray, optional): The indices to process. Defaults to None, which means all of them.
+        chunk_size (int, optional): The number of items per task. Defaults to 64.
+        max_workers (int, optional): The number of worker processes. Defaults to None, which means available_cpus().
+        batched (bool, optional): Call fn(indices, dataset, *args) once per chunk instead, with
+            the indices of the chunk as an array, returning the list of results for them.
+            Defaults to False.
+        metrics (StageMetrics, optional): Record the busy time of the workers, the latency of
+            each item, the number of chunks in flight and the time results take to come back
+            under the name of fn (see instrumentation.py). Defaults to None.
+
+    Yields:
+        tuple: The indices of a finished chunk and the list of fn results for them, in completion order.
+    """
+    if max_workers is None:
+        max_workers = available_cpus()
+    num_items = len(dataset) if indices is None else len(indices)
+    chunks = _iter_chunks(indices, num_items, chunk_size)
+    if dataset.grid is None:
+        shared_params = SharedArray(np.stack([dataset.freq, dataset.harm_ratio, dataset.mod_index]))
+        params_handle = shared_params.handle
+    else:
+        # a grid dataset is sent as its spec, a few bytes
+        shared_params = nullcontext()
+        params_handle = dataset.grid.to_spec()
+    with shared_params, ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(params_handle, dataset.sr, dataset.dur, dataset.audio_path)) as executor:
+        pool = None if metrics is None else metrics.pool(fn.__name__, max_workers)
+        run = _run_chunk if pool is None else _run_chunk_timed
+        pending = {}
+        for chunk in chunks:
+            pending[executor.submit(run, fn, chunk, args, batched)] = chunk
+            if pool is not None:
+                pool.record_queue(len(pending))
+            if len(pending) >= 2 * max_workers:
+                yield from _collect(pending, pool)
+        while pending:
+            yield from _collect(pending, pool)
+        if pool is not None:
+            pool.close()
+
+
+def _collect(pending, pool=None):
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for job in done:
+        chunk = pending.pop(job)
+        results = job.result()
+        if pool is not None:
+            results, timing = results
+            pool.record_chunk(timing)
+        yield _chunk_indices(chunk), results
+
+
+def _chunk_indices(chunk):
+    if isinstance(chunk, tuple):
+        return np.arange(*chunk)
+    return chunk
@@ -0,0 +1,327 @@
+from contextlib import nullcontext
+import numpy as np
+from numpy.lib.format import open_memmap
+import torch
+from tqdm import tqdm
+from utils import FmSynthDataset
+from equivalence import EquivalenceClasses
+
+
+def iter_batches(
+        dataset: FmSynthDataset,
+        batch_size: int = 64,
+        indices: np.ndarray = None,
+):
+    """
+    Iterate over the renders of a dataset in batches, so only one batch of audio is in memory
+    at a time.
+
+    Args:
+        dataset (FmSynthDataset): The dataset.
+        batch_size (int, optional): The number of renders per batch. Defaults to 64.
+        indices (np.ndarray, optional): The items to render, in this order. Defaults to None (all).
+
+    Yields:
+        tuple: The indices of the items of the batch and the (B, samples) float32 renders.
+    """
+    if indices is None:
+        indices = np.arange(len(dataset))
+    for start in range(0, len(indices), batch_size):
+        batch_indices = indices[start:start + batch_size]
+        y = dataset.get_batch(batch_indices)[0]
+        yield batch_indices, np.asarray(y, dtype=np.float32)
+
+
+def _batched_branch(model) -> str:
+    # the batched branch of embed_batch for a model, or None if the frechet_audio_distance
+    # internals it calls are missing (e.g. in another version), to use get_embeddings instead
+    model_name = getattr(model, "model_name", None)
+    network = getattr(model, "model", None)
+    if model_name == "encodec" and hasattr(network, "encoder") and hasattr(network, "sample_rate"):
+        return "encodec"
+    if model_name == "clap" and hasattr(network, "get_audio_embedding_from_data"):
+        return "clap"
+    return None
+
+
+def embed_batch(
+        model,
+        batch: np.ndarray,
+        sr: int,
+        item_shape: tuple,
+) -> np.ndarray:
+    """
+    Compute the embeddings of a batch of renders in as few model calls as possible. EnCodec
+    and CLAP models (from frechet_audio_distance) are called once on the whole batch, any other
+    model (or one without the internals these calls use) through its get_embeddings method,
+    with the whole batch as one list. See check_batch to compare both paths.
+
+    Args:
+        model: A FrechetAudioDistance instance, or any object with a get_embeddings(x, sr)
+            method that returns the concatenated embeddings of a list of renders.
+        batch (np.ndarray): The (B, samples) renders.
+        sr (int): The sample rate.
+        item_shape (tuple): The shape of the embedding of one item (see item_embedding_shape).
+
+    Returns:
+        np.ndarray: The embeddings, shape (B, *item_shape).
+    """
+    branch = _batched_branch(model)
+    with torch.inference_mode():
+        if branch == "encodec":
+            audio = torch.from_numpy(batch).unsqueeze(1).to(model.device)
+            # the 48 kHz model is stereo
+            if model.model.sample_rate == 48000:
+                audio = torch.cat((audio, audio), dim=1)
+            # (B, dim, frames) -> (B, frames, dim), same as get_embeddings
+            embs = model.model.encoder(audio).transpose(1, 2)
+        elif branch == "clap":
+            embs = model.model.get_audio_embedding_from_data(
+                torch.from_numpy(batch), use_tensor=True)
+        else:
+            embs = model.get_embeddings(list(batch), sr)
+        if torch.is_tensor(embs):
+            embs = embs.cpu().numpy()
+    return np.reshape(embs, (len(batch), *item_shape))
+
+
+def check_batch(
+        model,
+        batch: np.ndarray,
+        sr: int,
+        item_shape: tuple,
+        rtol: float = 1e-3,
+        atol: float = 1e-4,
+) -> float:
+    """
+    Check that embed_batch gives the same embeddings as the model's own get_embeddings, called
+    item by item, e.g. on the first batch of a real model, whose preprocessing (resampling,
+    channels) the batched branches have to match.
+
+    Args:
+        model: The model (see embed_batch).
+        batch (np.ndarray): The (B, samples) renders.
+        sr (int): The sample rate.
+        item_shape (tuple): The shape of the embedding of one item (see item_embedding_shape).
+        rtol (float, optional): The relative tolerance. Defaults to 1e-3.
+        atol (float, optional): The absolute tolerance. Defaults to 1e-4.
+
+    Returns:
+        float: The maximum absolute difference.
+
+    Raises:
+        ValueError: If the embeddings differ by more than the tolerances.
+    """
+    embs = embed_batch(model, batch, sr, item_shape)
+    with torch.inference_mode():
+        expected = np.stack([np.reshape(model.get_embeddings([y], sr), item_shape) for y in batch])
+    if not np.allclose(embs, expected, rtol=rtol, atol=atol):
+        raise ValueError(
+            f"the batched {getattr(model, 'model_name', None)} embeddings differ from get_embeddings "
+            f"by up to {np.abs(embs - expected).max()}")
+    return float(np.abs(embs - expected).max())
+
+
+def item_embedding_shape(
+        model,
+        y: np.ndarray,
+        sr: int,
+) -> tuple:
+    """
+    Get the shape of the embedding of one render, as get_embeddings returns it, (frames, dim)
+    for EnCodec (even with one frame) and other models, and (dim,) for CLAP, which has one
+    embedding per render.
+
+    Args:
+        model: The model (see embed_batch).
+        y (np.ndarray): A render.
+        sr (int): The sample rate.
+
+    Returns:
+        tuple: The shape.
+    """
+    with torch.inference_mode():
+        shape = model.get_embeddings([y], sr).shape
+    return shape[1:] if getattr(model, "model_name", None) == "clap" else shape
+
+
+def write_embeddings(
+        model,
+        dataset: FmSynthDataset,
+        path: str,
+        batch_size: int = 64,
+        metrics=None,
+        classes: EquivalenceClasses = None,
+        check: bool = True,
+) -> np.ndarray:
+    """
+    Compute the embeddings of all renders of a dataset and write them to a .npy file batch by
+    batch, so peak memory depends on the batch size, not on the dataset size.
+
+    Args:
+        model: The model (see embed_batch).
+        dataset (FmSynthDataset): The dataset.
+        path (str): The path of the .npy file to write.
+        batch_size (int, optional): The number of renders per model call. Defaults to 64.
+        metrics (StageMetrics, optional): Time reading the renders as render, the model calls
+            as analysis (with item latencies) and the writes as serialization (see
+            instrumentation.py). Defaults to None.
+        classes (EquivalenceClasses, optional): The rows of the dataset that render the same
+            signal, to only embed one row per class and copy its embedding to the others (see
+            equivalence.py). Defaults to None (embed every row).
+        check (bool, optional): Check the first batch against get_embeddings (see
+            check_batch). Defaults to True.
+
+    Returns:
+        np.ndarray: The (N, *item_shape) float32 embeddings, memory-mapped from path.
+    """
+    def phase(name, items=None):
+        return nullcontext() if metrics is None else metrics.phase(name, items)
+
+    if classes is None:
+        classes = EquivalenceClasses.singletons(len(dataset))
+    batches = iter_batches(dataset, batch_size, classes.representatives)
+    if metrics is not None:
+        batches = metrics.iterate(batches, "render")
+    item_shape = item_embedding_shape(model, dataset[0][0], dataset.sr)
+    all_embs = open_memmap(path, mode="w+", dtype=np.float32,
+                           shape=(len(dataset), *item_shape))
+    with tqdm(total=len(dataset)) as pbar:
+        for indices, batch in batches:
+            if check:
+                check_batch(model, batch, dataset.sr, item_shape)
+                check = False
+            with phase("analysis", len(batch)):
+                embs = embed_batch(model, batch, dataset.sr, item_shape)
+            with phase("serialization"):
+                rows, positions = classes.fan_out(indices)
+                all_embs[rows] = embs[positions]
+            pbar.update(len(rows))
+    with phase("serialization"):
+        all_embs.flush()
+    return all_embs
+
+
+class StandInNetwork:
+    """
+    The networks of a StandInModel: a fixed random projection of each frame of hop samples
+    (averaged over channels), with the encoder of EnCodec and the audio embedding of CLAP as
+    frechet_audio_distance calls them.
+    """
+
+    def __init__(self, hop: int = 320, dim: int = 16, seed: int = 0, sample_rate: int = 48000):
+        """
+        Args:
+            hop (int, optional): The frame size in samples. Defaults to 320.
+            dim (int, optional): The embedding size. Defaults to 16.
+            seed (int, optional): The seed of the projection. Defaults to 0.
+            sample_rate (int, optional): The sample rate of the model. Defaults to 48000.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        self.hop = hop
+        self.sample_rate = sample_rate
+        self.projection = torch.randn(hop, dim, generator=generator) / hop ** 0.5
+
+    def encoder(self, audio: torch.Tensor) -> torch.Tensor:
+        """
+        Embed each frame, like the EnCodec encoder.
+
+        Args:
+            audio (torch.Tensor): The (B, channels, samples) audio.
+
+        Returns:
+            torch.Tensor: The (B, dim, frames) embeddings.
+        """
+        audio = audio.to(torch.float32).mean(dim=1)
+        num_frames = audio.shape[-1] // self.hop
+        frames = audio[:, :num_frames * self.hop].reshape(len(audio), num_frames, self.hop)
+        return torch.tanh(frames @ self.projection).transpose(1, 2)
+
+    def get_audio_embedding_from_data(self, x: torch.Tensor, use_tensor: bool = True) -> torch.Tensor:
+        """
+        Embed each render as the mean of its frame embeddings, like the CLAP audio embedding.
+
+        Args:
+            x (torch.Tensor): The (B, samples) audio.
+            use_tensor (bool, optional): Unused, always returns a tensor. Defaults to True.
+
+        Returns:
+            torch.Tensor: The (B, dim) embeddings.
+        """
+        return self.encoder(x.unsqueeze(1)).mean(dim=-1)
+
+
+class StandInModel:
+    """
+    A small local model with the interface of FrechetAudioDistance, to run the embedding
+    pipeline offline. With model_name "encodec" or "clap" it has the attributes that the batched
+    branches of embed_batch call (see StandInNetwork), and its get_embeddings embeds item by item
+    like FrechetAudioDistance.get_embeddings does for that model. Any other name only has
+    get_embeddings, which returns (frames, dim) per render like EnCodec.
+    """
+
+    def __init__(self, model_name: str = "stand-in", hop: int = 320, dim: int = 16, seed: int = 0):
+        """
+        Args:
+            model_name (str, optional): "encodec", "clap" or any other name. Defaults to "stand-in".
+            hop (int, optional): The frame size in samples. Defaults to 320.
+            dim (int, optional): The embedding size. Defaults to 16.
+            seed (int, optional): The seed of the projection. Defaults to 0.
+        """
+        self.model_name = model_name
+        self.device = torch.device("cpu")
+        self.model = StandInNetwork(hop, dim, seed)
+
+    def get_embeddings(self, x, sr):
+        """
+        Get the embeddings of a list of renders, one at a time, concatenated along the first axis.
+
+        Args:
+            x (list): The renders.
+            sr (int): The sample rate (unused).
+
+        Returns:
+            np.ndarray: The embeddings, shape (sum of frames, dim), or (N, dim) for "clap".
+        """
+        embd_lst = []
+        for audio in x:
+            if self.model_name == "clap":
+                audio = torch.tensor(audio).float().unsqueeze(0)
+                embd = self.model.get_audio_embedding_from_data(audio, use_tensor=True)
+            else:
+                audio = torch.tensor(audio).float().unsqueeze(0).unsqueeze(0).to(self.device)
+                # the 48 kHz EnCodec model is stereo
+                if self.model_name == "encodec" and self.model.sample_rate == 48000:
+                    audio = torch.cat((audio, audio), dim=1)
+                # (dim, frames) -> (frames, dim)
+                embd = self.model.encoder(audio).squeeze(0).T
+            embd_lst.append(embd.numpy())
+        return np.concatenate(embd_lst, axis=0)
+
+
+if __name__ == "__main__":
+    # offline check: batched embeddings of a small grid match item by item ones
+    import tempfile
+    from utils import midi2frequency
+    sr = 48000
+    grid = np.stack(np.meshgrid(midi2frequency(np.linspace(38, 86, 5)),
+                                np.linspace(0, 10, 5), np.linspace(0, 10, 5)), -1).reshape(-1, 3)
+    ds = FmSynthDataset.from_arrays(grid[:, 0], grid[:, 1], grid[:, 2], sr=sr, dur=0.25)
+    classes = EquivalenceClasses.from_dataset(ds)
+    # the generic branch, and the batched EnCodec and CLAP branches against their item by item path
+    for model_name in ["stand-in", "encodec", "clap"]:
+        model = StandInModel(model_name)
+        with tempfile.TemporaryDirectory() as tmp:
+            embs = write_embeddings(model, ds, f"{tmp}/embs.npy", batch_size=16)
+            item_shape = item_embedding_shape(model, ds[0][0], sr)
+            expected = np.stack([model.get_embeddings([ds[i][0]], sr).reshape(item_shape)
+                                 for i in range(len(ds))])
+            # embedding one row per class of identical renders gives the same result
+            memoized = write_embeddings(model, ds, f"{tmp}/memoized.npy", batch_size=16,
+                                        classes=classes)
+            print(model_name, embs.shape, "max abs difference:", np.abs(embs - expected).max(),
+                  "memoized:", np.abs(memoized - expected).max())
+            del embs, memoized
+    # a render of one EnCodec frame keeps its frame axis
+    model = StandInModel("encodec", hop=ds.samples)
+    print("one frame:", item_embedding_shape(model, ds[0][0], sr))
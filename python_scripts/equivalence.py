@@ -0,0 +1,260 @@
+import argparse
+import numpy as np
+from utils import FmSynthDataset, fm_synth_gen_batch
+from param_grid import ParamGrid, grid_of
+
+
+def signal_params(
+        freq: np.ndarray,
+        harm_ratio: np.ndarray,
+        mod_index: np.ndarray,
+) -> tuple:
+    """
+    Map parameter triples to the simplest triple that renders the same signal. With a
+    harmonicity ratio of 0 the modulator is at 0 Hz, and with a modulation index of 0 it has no
+    amplitude, so both leave a sine at the carrier: (freq, 0, 0). The renders are identical bit
+    for bit (fm_synth_row adds exactly 0 to the carrier frequency).
+
+    Args:
+        freq (np.ndarray): The carrier frequencies.
+        harm_ratio (np.ndarray): The harmonicity ratios.
+        mod_index (np.ndarray): The modulation indices.
+
+    Returns:
+        tuple: The canonical freq, harm_ratio and mod_index arrays.
+    """
+    freq, harm_ratio, mod_index = (np.asarray(values, dtype=np.float64)
+                                   for values in (freq, harm_ratio, mod_index))
+    sine = (harm_ratio == 0) | (mod_index == 0)
+    return freq, np.where(sine, 0.0, harm_ratio), np.where(sine, 0.0, mod_index)
+
+
+class EquivalenceClasses:
+    """
+    The rows of a parameter table grouped by the signal they render (see signal_params), so
+    renders and analyses only run once per class, on its first row (the representative), and
+    their results are copied to the other members (see fan_out).
+    """
+
+    def __init__(self, representative: np.ndarray):
+        """
+        Args:
+            representative (np.ndarray): The representative row of each row, the first row of
+                its class.
+        """
+        self.representative = np.asarray(representative, dtype=np.int64)
+        # the rows grouped by class, to look up the members of a representative
+        self._order = np.argsort(self.representative, kind="stable")
+        self._sorted = self.representative[self._order]
+
+    @classmethod
+    def from_params(
+            cls,
+            freq: np.ndarray,
+            harm_ratio: np.ndarray,
+            mod_index: np.ndarray,
+    ) -> "EquivalenceClasses":
+        """
+        Group the rows of a parameter table. Rows with equal canonical parameters (including
+        exact duplicates) are one class.
+
+        Args:
+            freq (np.ndarray): The carrier frequencies.
+            harm_ratio (np.ndarray): The harmonicity ratios.
+            mod_index (np.ndarray): The modulation indices.
+
+        Returns:
+            EquivalenceClasses: The classes.
+        """
+        grid = grid_of(freq, harm_ratio, mod_index)
+        if grid is not None:
+            return cls.from_grid(grid)
+        keys = np.stack(signal_params(freq, harm_ratio, mod_index), axis=-1)
+        if len(keys) == 0:
+            return cls(np.zeros(0, dtype=np.int64))
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        return cls(first[inverse.ravel()])
+
+    @classmethod
+    def from_grid(cls, grid: ParamGrid) -> "EquivalenceClasses":
+        """
+        Group the rows of an implicit grid (see param_grid.py) from its axes, without computing
+        the parameters of every row. The classes are the same as those of from_params.
+
+        Args:
+            grid (ParamGrid): The grid.
+
+        Returns:
+            EquivalenceClasses: The classes.
+        """
+        pitch_steps, harm_ratio_steps, mod_idx_steps = (np.arange(steps) for steps in (
+            grid.pitch_steps, grid.harm_ratio_steps, grid.mod_idx_steps))
+        # the values along each axis, and the first step with the same value as each step
+        freq = grid.values("freq", grid.index(pitch_steps, 0, 0))
+        harm_ratio = grid.values("harm_ratio", grid.index(0, harm_ratio_steps, 0))
+        mod_index = grid.values("mod_index", grid.index(0, 0, mod_idx_steps))
+        first_x, first_y, first_z = (np.unique(values, return_index=True, return_inverse=True)
+                                     for values in (freq, harm_ratio, mod_index))
+        first_x, first_y, first_z = (first[inverse.ravel()]
+                                     for _, first, inverse in (first_x, first_y, first_z))
+        sine_y, sine_z = harm_ratio == 0, mod_index == 0
+        # the grid in row order (y, x, z): rows with the same values share the first of them
+        y, x, z = np.ix_(harm_ratio_steps, pitch_steps, mod_idx_steps)
+        representative = grid.index(first_x[x], first_y[y], first_z[z])
+        if sine_y.any() or sine_z.any():
+            # the first sine of a pitch is on the first row (y) that has one, either y = 0 with
+            # the first modulation index of 0, or the first harmonicity ratio of 0 with z = 0
+            sine_row = 0 if sine_z.any() else int(np.argmax(sine_y))
+            sine_z_first = 0 if sine_y[sine_row] else int(np.argmax(sine_z))
+            sine = sine_y[y] | sine_z[z]
+            representative = np.where(
+                sine, grid.index(first_x[x], sine_row, sine_z_first), representative)
+        return cls(representative.ravel())
+
+    @classmethod
+    def from_dataset(cls, dataset: FmSynthDataset) -> "EquivalenceClasses":
+        """
+        Group the items of a dataset.
+
+        Args:
+            dataset (FmSynthDataset): The dataset.
+
+        Returns:
+            EquivalenceClasses: The classes.
+        """
+        if dataset.grid is not None:
+            return cls.from_grid(dataset.grid)
+        return cls.from_params(dataset.freq, dataset.harm_ratio, dataset.mod_index)
+
+    @classmethod
+    def singletons(cls, num_items: int) -> "EquivalenceClasses":
+        """
+        Put every row in a class of its own, to process all rows.
+
+        Args:
+            num_items (int): The number of rows.
+
+        Returns:
+            EquivalenceClasses: The classes.
+        """
+        return cls(np.arange(num_items))
+
+    def __len__(self):
+        return len(self.representative)
+
+    @property
+    def representatives(self) -> np.ndarray:
+        """
+        The representative rows, one per class, sorted.
+        """
+        return np.flatnonzero(self.representative == np.arange(len(self)))
+
+    @property
+    def num_classes(self) -> int:
+        return int(np.count_nonzero(self.representative == np.arange(len(self))))
+
+    def representatives_of(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Get the representatives of the classes of some rows, e.g. of the rows a resumed run
+        still has to process.
+
+        Args:
+            rows (np.ndarray): The rows.
+
+        Returns:
+            np.ndarray: The sorted representative rows.
+        """
+        return np.unique(self.representative[np.asarray(rows, dtype=np.int64)])
+
+    def fan_out(self, rows: np.ndarray) -> tuple:
+        """
+        Get the members of the classes of representative rows.
+
+        Args:
+            rows (np.ndarray): The representative rows.
+
+        Returns:
+            tuple: All member rows (the representatives included), and for each the position of
+                its representative in rows, so results[positions] are the results of the members.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = np.searchsorted(self._sorted, rows, side="left")
+        counts = np.searchsorted(self._sorted, rows, side="right") - starts
+        positions = np.repeat(np.arange(len(rows)), counts)
+        # the offset of each member within its class
+        offsets = np.arange(len(positions)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self._order[np.repeat(starts, counts) + offsets], positions
+
+    def fan_out_records(
+            self,
+            records: list,
+            dataset: FmSynthDataset,
+            pending: np.ndarray = None,
+    ) -> list:
+        """
+        Copy the results of representative rows (dicts with an "index" key) to all members of
+        their classes, with the index and parameters of each member.
+
+        Args:
+            records (list): The results of representatives.
+            dataset (FmSynthDataset): The dataset the classes are from.
+            pending (np.ndarray, optional): A boolean mask of the rows still to process, to only
+                return their results (a resumed run may have some members already). Defaults to None.
+
+        Returns:
+            list: The results of all members.
+        """
+        if len(records) == 0:
+            return []
+        members, positions = self.fan_out([record["index"] for record in records])
+        fanned = []
+        if pending is not None:
+            keep = pending[members]
+            members, positions = members[keep], positions[keep]
+        for member, position in zip(members, positions):
+            record = dict(records[position], index=int(member))
+            for name in ("freq", "harm_ratio", "mod_index"):
+                if name in record:
+                    record[name] = getattr(dataset, name)[member]
+            fanned.append(record)
+        return fanned
+
+
+def check_renders(
+        dataset: FmSynthDataset,
+        classes: EquivalenceClasses,
+        samples: int = 4800,
+) -> bool:
+    """
+    Check that the members of every class with more than one row render the same signal as
+    their representative.
+
+    Args:
+        dataset (FmSynthDataset): The dataset.
+        classes (EquivalenceClasses): Its classes.
+        samples (int, optional): The number of samples to compare. Defaults to 4800.
+
+    Returns:
+        bool: True if all renders are identical.
+    """
+    rows = np.flatnonzero(classes.representative != np.arange(len(classes)))
+    representatives = classes.representative[rows]
+    params = [np.asarray(getattr(dataset, name)[np.concatenate([rows, representatives])])
+              for name in ("freq", "harm_ratio", "mod_index")]
+    renders = fm_synth_gen_batch(samples, dataset.sr, *params)
+    return bool(np.array_equal(renders[:len(rows)], renders[len(rows):]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Count the rows of the parameter grid that render the same signal, and check that they do.")
+    parser.add_argument("--grid", default="../data/fm_synth_params.grid.json",
+                        help="the parameter grid spec (see param_grid.py), read instead of --csv if it exists")
+    parser.add_argument("--csv", default="../data/fm_synth_params.csv", help="the parameter table")
+    args = parser.parse_args()
+    from param_grid import open_dataset
+    ds = open_dataset(args.grid, args.csv)
+    classes = EquivalenceClasses.from_dataset(ds)
+    print(f"{len(classes)} rows, {classes.num_classes} distinct signals "
+          f"({len(classes) - classes.num_classes} renders and analyses saved)")
+    print("members render identically:", check_renders(ds, classes))
@@ -0,0 +1,241 @@
+import argparse
+import time
+import numpy as np
+from numba import jit, float32, float64, void
+from utils import wrap, fm_synth_gen, fm_synth_row
+
+# the parameters of the oscillator, in the order of the rows of its ramp state
+PARAMETERS = ["freq", "harm_ratio", "mod_index"]
+
+# the columns of the ramp state: where the ramp starts and ends, its length in samples and
+# the number of samples of it rendered so far
+_START, _TARGET, _LENGTH, _POSITION = range(4)
+
+
+@jit(float64(float64[:]), nopython=True, cache=True)
+def _ramp_value(ramp):
+    # the value of a ramp at its current position, reaching the target on its last sample
+    if ramp[_POSITION] >= ramp[_LENGTH]:
+        return ramp[_TARGET]
+    return ramp[_START] + (ramp[_TARGET] - ramp[_START]) * ((ramp[_POSITION] + 1) / ramp[_LENGTH])
+
+
+@jit([void(float64[:], float64, float64[:], float64[:, :]),
+      void(float32[:], float64, float64[:], float64[:, :])],
+     nopython=True, cache=True)
+def _render_block(
+    output: np.ndarray,
+    sr: float,
+    phases: np.ndarray,
+    ramps: np.ndarray,
+) -> None:
+    # the per-sample math of fm_synth_row, continuing from the phases and ramps of the
+    # previous block and updating them in place
+    carrier_phase = phases[0]
+    modulator_phase = phases[1]
+    for i in range(output.shape[0]):
+        carrier_frequency = _ramp_value(ramps[0])
+        harmonicity_ratio = _ramp_value(ramps[1])
+        modulation_index = _ramp_value(ramps[2])
+        for p in range(3):
+            if ramps[p, _POSITION] < ramps[p, _LENGTH]:
+                ramps[p, _POSITION] += 1
+        modulator_frequency = carrier_frequency * harmonicity_ratio
+        modulation_amplitude = modulator_frequency * modulation_index
+        output[i] = np.sin(2 * np.pi * carrier_phase)
+        modulator_buf = np.sin(2 * np.pi * modulator_phase)
+        instantaneous_frequency = carrier_frequency + \
+            (modulator_buf * modulation_amplitude)
+        modulator_phase = wrap(modulator_frequency / sr + modulator_phase, 0, 1)
+        carrier_phase = wrap(instantaneous_frequency / sr + carrier_phase, 0, 1)
+    phases[0] = carrier_phase
+    phases[1] = modulator_phase
+
+
+class FmOscillator:
+    """
+    A streaming version of fm_synth_gen for real-time use: it renders a tone block by block,
+    carrying the carrier and modulator phases over from one block to the next, so there are
+    no discontinuities at the block boundaries. Parameter changes are linear ramps that run
+    sample by sample across blocks. Rendering writes into a buffer of the caller and
+    allocates nothing.
+    """
+
+    def __init__(
+            self,
+            sr: int = 48000,
+            freq: float = 440,
+            harm_ratio: float = 1,
+            mod_index: float = 0,
+    ):
+        """
+        Args:
+            sr (int, optional): The sample rate. Defaults to 48000.
+            freq (float, optional): The carrier frequency in Hz. Defaults to 440.
+            harm_ratio (float, optional): The harmonicity ratio. Defaults to 1.
+            mod_index (float, optional): The modulation index. Defaults to 0.
+        """
+        self.sr = sr
+        self.phases = np.zeros(2, dtype=np.float64)
+        self.ramps = np.zeros((len(PARAMETERS), 4), dtype=np.float64)
+        self.ramps[:, _START] = self.ramps[:, _TARGET] = [freq, harm_ratio, mod_index]
+
+    @property
+    def params(self) -> dict:
+        """
+        The parameters the next sample will be rendered with.
+        """
+        return {name: _ramp_value(ramp) for name, ramp in zip(PARAMETERS, self.ramps)}
+
+    def set_targets(
+            self,
+            freq: float = None,
+            harm_ratio: float = None,
+            mod_index: float = None,
+            ramp_samples: int = 0,
+    ) -> None:
+        """
+        Ramp parameters linearly from their current values to new ones. The ramps start
+        with the next rendered sample and reach the targets on their last sample, also if
+        they span several blocks. A parameter that is still ramping starts its new ramp from
+        where it is. Parameters left at None keep their ramps.
+
+        Args:
+            freq (float, optional): The target carrier frequency in Hz. Defaults to None.
+            harm_ratio (float, optional): The target harmonicity ratio. Defaults to None.
+            mod_index (float, optional): The target modulation index. Defaults to None.
+            ramp_samples (int, optional): The length of the ramps in samples, 0 to jump to
+                the targets. Defaults to 0.
+        """
+        for row, target in enumerate([freq, harm_ratio, mod_index]):
+            if target is None:
+                continue
+            ramp = self.ramps[row]
+            # the value of the last rendered sample
+            if ramp[_POSITION] >= ramp[_LENGTH]:
+                ramp[_START] = ramp[_TARGET]
+            else:
+                ramp[_START] += (ramp[_TARGET] - ramp[_START]) * (ramp[_POSITION] / ramp[_LENGTH])
+            ramp[_TARGET] = target
+            ramp[_LENGTH] = ramp_samples
+            ramp[_POSITION] = 0
+
+    def render(self, out: np.ndarray) -> np.ndarray:
+        """
+        Render the next block of samples.
+
+        Args:
+            out (np.ndarray): The 1D float32 or float64 buffer to write into. Its length
+                sets the number of samples.
+
+        Returns:
+            np.ndarray: out.
+        """
+        _render_block(out, self.sr, self.phases, self.ramps)
+        return out
+
+    def reset(self) -> None:
+        """
+        Restart both phasors at 0, as at the start of an fm_synth_gen buffer.
+        """
+        self.phases[:] = 0
+
+
+def check_conformance(
+        sr: int = 48000,
+        samples: int = 48000,
+        block_size: int = 64,
+) -> dict:
+    """
+    Compare block by block rendering with the one-shot renderers: with static parameters
+    against fm_synth_row, and with ramps (changed at odd block offsets) against
+    fm_synth_gen given the same per-sample parameter trajectories.
+
+    Args:
+        sr (int, optional): The sample rate. Defaults to 48000.
+        samples (int, optional): The number of samples to render. Defaults to 48000.
+        block_size (int, optional): The block size. Defaults to 64.
+
+    Returns:
+        dict: The maximum absolute difference of both comparisons.
+    """
+    num_blocks = samples // block_size
+    samples = num_blocks * block_size
+    # static parameters
+    expected = np.zeros(samples)
+    fm_synth_row(expected, sr, 220.0, 3.5, 4.0)
+    osc = FmOscillator(sr, 220.0, 3.5, 4.0)
+    streamed = np.zeros(samples)
+    for b in range(num_blocks):
+        osc.render(streamed[b * block_size:(b + 1) * block_size])
+    static = np.abs(streamed - expected).max()
+
+    # ramps of random lengths, set between blocks, with the trajectories logged
+    rng = np.random.default_rng(0)
+    osc = FmOscillator(sr, 220.0, 1.0, 0.0)
+    trajectories = np.zeros((len(PARAMETERS), samples))
+    block = np.zeros(block_size)
+    for b in range(num_blocks):
+        if b % 7 == 0:
+            osc.set_targets(freq=rng.uniform(50, 1000), harm_ratio=rng.uniform(0, 10),
+                            mod_index=rng.uniform(0, 10),
+                            ramp_samples=int(rng.integers(0, 5 * block_size)))
+        # the trajectories, sample by sample, from a copy of the ramps
+        ramps = osc.ramps.copy()
+        for i in range(block_size):
+            for p in range(len(PARAMETERS)):
+                trajectories[p, b * block_size + i] = _ramp_value(ramps[p])
+                if ramps[p, _POSITION] < ramps[p, _LENGTH]:
+                    ramps[p, _POSITION] += 1
+        streamed[b * block_size:(b + 1) * block_size] = osc.render(block)
+    expected = fm_synth_gen(samples, sr, *trajectories)
+    ramped = np.abs(streamed - expected).max()
+    return {"static": static, "ramped": ramped}
+
+
+def benchmark(
+        block_sizes: list = [32, 64, 128, 256, 512, 1024],
+        seconds: float = 10,
+        sr: int = 48000,
+        dtype: np.dtype = np.float32,
+) -> dict:
+    """
+    Measure the real-time factor (seconds of audio per second of rendering) of an
+    oscillator whose parameters ramp to new targets every block.
+
+    Args:
+        block_sizes (list, optional): The block sizes. Defaults to [32, 64, 128, 256, 512, 1024].
+        seconds (float, optional): The seconds of audio to render per block size. Defaults to 10.
+        sr (int, optional): The sample rate. Defaults to 48000.
+        dtype (np.dtype, optional): The sample type of the buffer. Defaults to np.float32.
+
+    Returns:
+        dict: The block sizes mapped to their real-time factors.
+    """
+    factors = {}
+    rng = np.random.default_rng(0)
+    for block_size in block_sizes:
+        osc = FmOscillator(sr, 220, 2, 3)
+        out = np.zeros(block_size, dtype=dtype)
+        num_blocks = int(seconds * sr / block_size)
+        targets = rng.uniform([50, 0, 0], [1000, 10, 10], (num_blocks, 3))
+        start = time.perf_counter()
+        for freq, harm_ratio, mod_index in targets:
+            osc.set_targets(freq, harm_ratio, mod_index, ramp_samples=block_size)
+            osc.render(out)
+        factors[block_size] = num_blocks * block_size / sr / (time.perf_counter() - start)
+    return factors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the streaming FM oscillator against fm_synth_gen and measure its real-time factor.")
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=[32, 64, 128, 256, 512, 1024],
+                        help="the block sizes to benchmark")
+    parser.add_argument("--seconds", type=float, default=10,
+                        help="the seconds of audio to render per block size")
+    parser.add_argument("--sr", type=int, default=48000, help="the sample rate")
+    args = parser.parse_args()
+    print("max abs difference to the one-shot renderers:", check_conformance(args.sr))
+    for block_size, factor in benchmark(args.block_sizes, args.seconds, args.sr).items():
+        print(f"block size {block_size}: {factor:.0f}x real time")
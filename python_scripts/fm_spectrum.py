@@ -0,0 +1,580 @@
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+from numba import jit, prange
+import pandas as pd
+from scipy.special import jv
+from tqdm import tqdm
+from spectral_features import SPECTRAL_FEATURES, spectral_descriptors, spectrum_frequencies, swipe_kernel
+
+
+def fm_sidebands(
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+        max_order: int = None,
+) -> tuple:
+    """
+    Compute the line spectrum of FM tones with static parameters, as rendered by fm_synth_gen.
+
+    The carrier phase of fm_synth_gen is sum_{m<n} (fc + I * fm * sin(wm * m)) / sr, which in
+    closed form is wc * n + b * cos(wm / 2) - b * cos(wm * n - wm / 2), with the effective
+    modulation index b = I * (wm / 2) / sin(wm / 2) (this is I for low modulator frequencies,
+    but up to 10% more near the top of the grid). Expanding with the Jacobi-Anger identity
+    gives the sideband k at fc + k * fm with the complex amplitude
+    J_k(b) * exp(i * (b * cos(wm / 2) - k * (wm / 2 + pi / 2))).
+
+    Args:
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+        max_order (int, optional): The highest sideband order k to include. Defaults to None,
+            which means 30 above the largest effective modulation index (where J_k is below 1e-16).
+
+    Returns:
+        tuple: The sideband frequencies in Hz and their complex amplitudes, both of shape (N, 2 * max_order + 1).
+    """
+    fc = np.asarray(carrier_frequencies, dtype=np.float64).reshape(-1, 1)
+    fm = fc * np.asarray(harmonicity_ratios, dtype=np.float64).reshape(-1, 1)
+    index = np.asarray(modulation_indices, dtype=np.float64).reshape(-1, 1)
+    half_wm = np.pi * fm / sr
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beta = np.where(fm == 0, 0.0, index * half_wm / np.sin(half_wm))
+    if max_order is None:
+        max_order = int(np.ceil(beta.max(initial=0))) + 30
+    k = np.arange(-max_order, max_order + 1)
+    frequencies = fc + k * fm
+    phases = beta * np.cos(half_wm) - k * (half_wm + np.pi / 2)
+    amplitudes = jv(k, beta) * np.exp(1j * phases)
+    return frequencies, amplitudes
+
+
+def fm_closed_form(
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+        sample_indices: np.ndarray,
+) -> np.ndarray:
+    """
+    Evaluate FM tones (as rendered by fm_synth_gen) at arbitrary sample indices, from the
+    closed form of the carrier phase (see fm_sidebands), without rendering what comes before.
+
+    Args:
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+        sample_indices (np.ndarray): The sample indices, shape (M,).
+
+    Returns:
+        np.ndarray: The samples, shape (N, M).
+    """
+    fc = np.asarray(carrier_frequencies, dtype=np.float64).reshape(-1, 1)
+    fm = fc * np.asarray(harmonicity_ratios, dtype=np.float64).reshape(-1, 1)
+    index = np.asarray(modulation_indices, dtype=np.float64).reshape(-1, 1)
+    n = np.asarray(sample_indices, dtype=np.float64).reshape(1, -1)
+    half_wm = np.pi * fm / sr
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beta = np.where(fm == 0, 0.0, index * half_wm / np.sin(half_wm))
+    phase = 2 * np.pi * np.mod(fc * n / sr, 1) + \
+        beta * (np.cos(half_wm) - np.cos(half_wm * (2 * n - 1)))
+    return np.sin(phase)
+
+
+def sideband_means(
+        sr: int,
+        samples: int,
+        frequencies: np.ndarray,
+        amplitudes: np.ndarray,
+) -> np.ndarray:
+    """
+    Compute the mean of FM tones over their first samples samples from their sidebands.
+
+    Args:
+        sr (int): The sample rate.
+        samples (int): The number of samples.
+        frequencies (np.ndarray): The sideband frequencies, shape (N, L).
+        amplitudes (np.ndarray): The complex sideband amplitudes, shape (N, L).
+
+    Returns:
+        np.ndarray: The means, shape (N,).
+    """
+    half_w = np.pi * frequencies / sr
+    denominator = np.sin(half_w)
+    tiny = np.abs(denominator) < 1e-12
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # sum of exp(i * w * n) over the samples
+        sums = np.where(tiny, samples * np.cos(samples * half_w) / np.cos(half_w),
+                        np.sin(samples * half_w) / denominator)
+    sums = sums * np.exp(1j * half_w * (samples - 1))
+    return np.sum(amplitudes * sums, axis=1).imag / samples
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _fold_lines(frequencies, amplitudes, sr, out_frequencies, out_amplitudes):
+    tolerance = 1e-6
+    for row in prange(frequencies.shape[0]):
+        num_lines = 0
+        for line in range(frequencies.shape[1]):
+            # alias into [-sr/2, sr/2), then fold negative frequencies:
+            # Im(a * exp(-i w n)) = Im(-conj(a) * exp(i w n))
+            f = (frequencies[row, line] + sr / 2) % sr - sr / 2
+            a = amplitudes[row, line]
+            if f < 0:
+                f = -f
+                a = -np.conj(a)
+            # sum coinciding lines as complex amplitudes
+            merged = False
+            for other in range(num_lines):
+                if abs(out_frequencies[row, other] - f) < tolerance:
+                    out_amplitudes[row, other] += a
+                    merged = True
+                    break
+            if not merged:
+                out_frequencies[row, num_lines] = f
+                out_amplitudes[row, num_lines] = a
+                num_lines += 1
+
+
+def fold_sidebands(
+        sr: int,
+        frequencies: np.ndarray,
+        amplitudes: np.ndarray,
+) -> tuple:
+    """
+    Turn a sideband spectrum (from fm_sidebands) into the spectrum of real sinusoids that the
+    sampled signal contains: sidebands beyond Nyquist alias back, negative-frequency sidebands
+    fold onto positive frequencies, and lines that land on the same frequency interfere.
+
+    Args:
+        sr (int): The sample rate.
+        frequencies (np.ndarray): The sideband frequencies, shape (N, L).
+        amplitudes (np.ndarray): The complex sideband amplitudes, shape (N, L).
+
+    Returns:
+        tuple: The line frequencies in [0, sr/2] and their real amplitudes, both of shape
+            (N, L). Unused slots have zero amplitude. A line at 0 Hz holds the DC offset
+            scaled by sqrt(2), so that all lines have power amplitude ** 2 / 2.
+    """
+    out_frequencies = np.zeros(frequencies.shape, dtype=np.float64)
+    out_amplitudes = np.zeros(amplitudes.shape, dtype=np.complex128)
+    _fold_lines(np.ascontiguousarray(frequencies, dtype=np.float64),
+                np.ascontiguousarray(amplitudes, dtype=np.complex128),
+                float(sr), out_frequencies, out_amplitudes)
+    line_amplitudes = np.abs(out_amplitudes)
+    dc = out_frequencies == 0
+    line_amplitudes[dc] = np.sqrt(2) * np.abs(out_amplitudes[dc].imag)
+    return out_frequencies, line_amplitudes
+
+
+@jit(nopython=True, cache=True)
+def _dirichlet(numerator, denominator, half_phase, window_size):
+    # sin(N * phi / 2) / sin(phi / 2), with its limit where sin(phi / 2) is 0
+    if abs(denominator) < 1e-6:
+        # the recurrence is not accurate enough here
+        denominator = np.sin(half_phase)
+        if abs(denominator) < 1e-12:
+            return window_size * np.cos(window_size * half_phase) / np.cos(half_phase)
+    return numerator / denominator
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _line_power_kernel(out, line_frequencies, line_amplitudes, sr, window_size, alpha, min_power):
+    num_bins = out.shape[1]
+    # phase of the shifted cosine terms relative to the main one, 0 for a symmetric window
+    gamma = np.pi - alpha * (window_size - 1) / 2
+    cos_gamma = np.cos(gamma)
+    sin_gamma = np.sin(gamma)
+    # sin(phi / 2) advances by a fixed rotation from bin to bin
+    step = np.pi / window_size
+    cos_step = np.cos(step)
+    sin_step = np.sin(step)
+    shifts = np.array([0.0, -alpha / 2, alpha / 2])
+    for row in prange(out.shape[0]):
+        total = 0.0
+        for line in range(line_frequencies.shape[1]):
+            total += line_amplitudes[row, line] ** 2
+        sines = np.empty(3)
+        cosines = np.empty(3)
+        numerators = np.empty(3)
+        for line in range(line_frequencies.shape[1]):
+            power = 0.25 * line_amplitudes[row, line] ** 2
+            if power == 0 or power < min_power * total:
+                continue
+            for sign in (-1.0, 1.0):
+                # the line and its negative-frequency image
+                f = sign * line_frequencies[row, line]
+                # sin(N * phi / 2) only changes sign from bin to bin
+                base = -np.pi * f / sr
+                for j in range(3):
+                    numerators[j] = np.sin(window_size * (base + shifts[j]))
+                for b in range(num_bins):
+                    if b % 256 == 0:
+                        # reseed the recurrence
+                        for j in range(3):
+                            sines[j] = np.sin(base + b * step + shifts[j])
+                            cosines[j] = np.cos(base + b * step + shifts[j])
+                    parity = 1.0 - 2.0 * (b % 2)
+                    half_phase = base + b * step
+                    d0 = _dirichlet(parity * numerators[0], sines[0],
+                                    half_phase, window_size)
+                    d_minus = _dirichlet(parity * numerators[1], sines[1],
+                                         half_phase + shifts[1], window_size)
+                    d_plus = _dirichlet(parity * numerators[2], sines[2],
+                                        half_phase + shifts[2], window_size)
+                    real = 0.5 * d0 + 0.25 * cos_gamma * (d_minus + d_plus)
+                    imag = 0.25 * sin_gamma * (d_plus - d_minus)
+                    out[row, b] += power * (real * real + imag * imag)
+                    for j in range(3):
+                        sine = sines[j]
+                        sines[j] = sine * cos_step + cosines[j] * sin_step
+                        cosines[j] = cosines[j] * cos_step - sine * sin_step
+
+
+def line_power_spectrum(
+        sr: int,
+        line_frequencies: np.ndarray,
+        line_amplitudes: np.ndarray,
+        window_size: int,
+        num_bins: int,
+        periodic: bool = False,
+        min_power: float = 1e-20,
+) -> np.ndarray:
+    """
+    Compute the expected power spectrum of a sum of sinusoids, as the mean of |FFT|^2 over
+    Hann-windowed frames of window_size samples would be, from the closed-form response of
+    the window. Interference between lines averages out over frames, so the powers of the
+    lines add up.
+
+    Args:
+        sr (int): The sample rate.
+        line_frequencies (np.ndarray): The line frequencies, shape (N, L).
+        line_amplitudes (np.ndarray): The line amplitudes, shape (N, L).
+        window_size (int): The window (and FFT) size.
+        num_bins (int): The number of bins (from 0 Hz, spaced sr / window_size) to compute.
+        periodic (bool, optional): Use a periodic Hann window (like torch.hann_window) instead of a
+            symmetric one (like np.hanning). Defaults to False.
+        min_power (float, optional): Lines below this fraction of the total power are skipped.
+            Defaults to 1e-20.
+
+    Returns:
+        np.ndarray: The power spectra, shape (N, num_bins).
+    """
+    alpha = 2 * np.pi / (window_size if periodic else window_size - 1)
+    out = np.zeros((len(line_frequencies), num_bins), dtype=np.float64)
+    _line_power_kernel(out, np.ascontiguousarray(line_frequencies, dtype=np.float64),
+                       np.ascontiguousarray(line_amplitudes, dtype=np.float64),
+                       float(sr), window_size, alpha, min_power)
+    return out
+
+
+def fm_lines(
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+) -> tuple:
+    """
+    Compute the real line spectrum of FM tones (see fm_sidebands and fold_sidebands).
+
+    Args:
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+
+    Returns:
+        tuple: The line frequencies and amplitudes, both of shape (N, L).
+    """
+    frequencies, amplitudes = fm_sidebands(
+        sr, carrier_frequencies, harmonicity_ratios, modulation_indices)
+    return fold_sidebands(sr, frequencies, amplitudes)
+
+
+def analytic_pressure_spectrum(
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+        dur: float = 1,
+        fft_size: int = 4096,
+) -> np.ndarray:
+    """
+    Compute the spectrum that pytimbre's SpectrumByFFT (pressures_pascals) measures on the
+    rendered FM tones, without rendering them.
+
+    Args:
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+        dur (float, optional): The duration of the tones in seconds. Defaults to 1.
+        fft_size (int, optional): The FFT size. Defaults to 4096.
+
+    Returns:
+        np.ndarray: The pressure spectra at spectrum_frequencies(sr, fft_size), shape (N, fft_size // 2).
+    """
+    samples = int(dur * sr)
+    frequencies, amplitudes = fm_sidebands(
+        sr, carrier_frequencies, harmonicity_ratios, modulation_indices)
+    # pytimbre removes the mean of the signal, which is a line at 0 Hz
+    means = sideband_means(sr, samples, frequencies, amplitudes)
+    frequencies = np.concatenate(
+        [frequencies, np.zeros((len(frequencies), 1))], axis=1)
+    amplitudes = np.concatenate([amplitudes, -1j * means[:, None]], axis=1)
+    line_frequencies, line_amplitudes = fold_sidebands(
+        sr, frequencies, amplitudes)
+    power = line_power_spectrum(sr, line_frequencies, line_amplitudes,
+                                fft_size, fft_size // 2)
+    # same scaling as SpectrumByFFT
+    window = np.hanning(fft_size)
+    scale = 2 * (sr / fft_size) / fft_size / sr / np.mean(window ** 2)
+    return np.sqrt(scale * power)
+
+
+def analytic_mel_spectrum(
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+        dur: float = 1,
+        n_fft: int = 4096,
+        n_mels: int = 200,
+        f_min: float = 20,
+        f_max: float = 10000,
+) -> np.ndarray:
+    """
+    Compute the time-averaged mel spectrogram (in dB) that 04_render_mel_spectrograms.py
+    measures on the rendered FM tones, without rendering them. The frames inside the tone
+    come from the line spectrum, while the first and last frame (which torchaudio pads by
+    reflection, so they see the onset and the cut at the end) are computed from the few
+    samples they cover, using fm_closed_form.
+
+    Args:
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+        dur (float, optional): The duration of the tones in seconds. Defaults to 1.
+        n_fft (int, optional): The FFT size. Defaults to 4096.
+        n_mels (int, optional): The number of mel bands. Defaults to 200.
+        f_min (float, optional): The lowest frequency of the mel filterbank. Defaults to 20.
+        f_max (float, optional): The highest frequency of the mel filterbank. Defaults to 10000.
+
+    Returns:
+        np.ndarray: The mean mel spectra in dB, shape (N, n_mels).
+    """
+    import torch
+    from torchaudio.functional import amplitude_to_DB, melscale_fbanks
+    line_frequencies, line_amplitudes = fm_lines(
+        sr, carrier_frequencies, harmonicity_ratios, modulation_indices)
+    power = line_power_spectrum(sr, line_frequencies, line_amplitudes,
+                                n_fft, n_fft // 2 + 1, periodic=True)
+    # the padded signal of MelSpectrogram(pad=1) has samples + 2 samples, then it is
+    # reflected by hop = n_fft // 2 at both ends
+    samples = int(dur * sr)
+    hop = n_fft // 2
+    num_frames = 1 + (samples + 2) // hop
+    last = (num_frames - 1) * hop - hop + np.arange(n_fft)
+    padded_indices = np.stack([np.arange(n_fft) - hop, last])
+    padded_indices = np.abs(padded_indices)
+    padded_indices = np.where(padded_indices > samples + 1,
+                              2 * (samples + 1) - padded_indices, padded_indices)
+    edges = fm_closed_form(sr, carrier_frequencies, harmonicity_ratios, modulation_indices,
+                           padded_indices.ravel() - 1).reshape(-1, 2, n_fft)
+    # the zero padding
+    edges[:, (padded_indices == 0) | (padded_indices == samples + 1)] = 0
+    window = torch.hann_window(n_fft, dtype=torch.float64).numpy()
+    edge_power = np.abs(np.fft.rfft(edges * window, axis=-1)) ** 2
+    power = ((num_frames - 2) * power + edge_power.sum(axis=1)) / num_frames
+    filterbank = melscale_fbanks(n_fft // 2 + 1, f_min, f_max, n_mels, sr,
+                                 norm="slaney", mel_scale="slaney").numpy().astype(np.float64)
+    mel = torch.from_numpy(power @ filterbank)
+    # same as in 04_render_mel_spectrograms.py, (N, 1, n_mels, 1) so that top_db is applied per item
+    mel_db = amplitude_to_DB(mel[:, None, :, None], multiplier=10,
+                             amin=1e-5, db_multiplier=20, top_db=80)
+    return mel_db[:, 0, :, 0].numpy()
+
+
+def write_analytic_mel_spectra(
+        path: str,
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+        dur: float = 1,
+        n_mels: int = 200,
+        block_rows: int = 1024,
+) -> np.ndarray:
+    """
+    Compute the mean mel spectra of analytic_mel_spectrum for a grid of FM tones in blocks of
+    rows, and write them to a float32 .npy file block by block (like the output of
+    04_render_mel_spectrograms.py), so memory depends on the block size, not on the grid size.
+
+    Args:
+        path (str): The path of the .npy file to write.
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+        dur (float, optional): The duration of the tones in seconds. Defaults to 1.
+        n_mels (int, optional): The number of mel bands. Defaults to 200.
+        block_rows (int, optional): The number of rows computed at once. Defaults to 1024.
+
+    Returns:
+        np.ndarray: The (N, n_mels) mel spectra in dB, memory-mapped from path.
+    """
+    num_rows = len(carrier_frequencies)
+    mel = open_memmap(path, mode="w+", dtype=np.float32, shape=(num_rows, n_mels))
+    for start in tqdm(range(0, num_rows, block_rows), desc="Analytic mel spectra"):
+        stop = min(start + block_rows, num_rows)
+        mel[start:stop] = analytic_mel_spectrum(
+            sr, carrier_frequencies[start:stop], harmonicity_ratios[start:stop],
+            modulation_indices[start:stop], dur, n_mels=n_mels)
+    mel.flush()
+    return mel
+
+
+def analytic_spectral_features(
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+        dur: float = 1,
+        fft_size: int = 4096,
+        block_rows: int = 4096,
+) -> pd.DataFrame:
+    """
+    Compute the spectral descriptors of 03_build_spectral_ds.py for a grid of FM tones from
+    their parameters alone, in blocks of rows.
+
+    Args:
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+        dur (float, optional): The duration of the tones in seconds. Defaults to 1.
+        fft_size (int, optional): The FFT size. Defaults to 4096.
+        block_rows (int, optional): The number of rows computed at once. Defaults to 4096.
+
+    Returns:
+        pd.DataFrame: The parameters and descriptors (same columns as the stage 03 table), indexed by "index".
+    """
+    carrier_frequencies = np.asarray(carrier_frequencies, dtype=np.float64)
+    harmonicity_ratios = np.asarray(harmonicity_ratios, dtype=np.float64)
+    modulation_indices = np.asarray(modulation_indices, dtype=np.float64)
+    frequencies = spectrum_frequencies(sr, fft_size)
+    kernel = swipe_kernel(sr, fft_size)
+    blocks = []
+    for start in tqdm(range(0, len(carrier_frequencies), block_rows), desc="Analytic spectra"):
+        stop = min(start + block_rows, len(carrier_frequencies))
+        pressures = analytic_pressure_spectrum(
+            sr, carrier_frequencies[start:stop], harmonicity_ratios[start:stop],
+            modulation_indices[start:stop], dur, fft_size)
+        blocks.append(spectral_descriptors(frequencies, pressures, kernel))
+    df = pd.DataFrame({
+        "freq": carrier_frequencies,
+        "harm_ratio": harmonicity_ratios,
+        "mod_index": modulation_indices,
+        **{name: np.concatenate([block[name] for block in blocks]) for name in SPECTRAL_FEATURES},
+    })
+    df.index.name = "index"
+    return df
+
+
+def validate_against_renders(
+        sr: int,
+        carrier_frequencies: np.ndarray,
+        harmonicity_ratios: np.ndarray,
+        modulation_indices: np.ndarray,
+        dur: float = 1,
+) -> pd.DataFrame:
+    """
+    Compare the analytic features with the FFT-based path of stages 03 and 04 (pytimbre and
+    torchaudio on rendered tones) for a set of parameters.
+
+    Args:
+        sr (int): The sample rate.
+        carrier_frequencies (np.ndarray): The carrier frequencies, shape (N,).
+        harmonicity_ratios (np.ndarray): The harmonicity ratios, shape (N,).
+        modulation_indices (np.ndarray): The modulation indices, shape (N,).
+        dur (float, optional): The duration of the renders in seconds. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: The median, 95th percentile and max relative error of every descriptor, and
+            the same for the absolute error of the mel bands in dB (as "mel_db").
+    """
+    import torch
+    from torchaudio.functional import amplitude_to_DB
+    from torchaudio.transforms import MelSpectrogram
+    from pytimbre.waveform import Waveform
+    from pytimbre.spectral.spectra import SpectrumByFFT
+    from utils import fm_synth_gen_batch
+    renders = fm_synth_gen_batch(int(dur * sr), sr, carrier_frequencies,
+                                 harmonicity_ratios, modulation_indices)
+    analytic = analytic_spectral_features(
+        sr, carrier_frequencies, harmonicity_ratios, modulation_indices, dur)
+    errors = {}
+    for name in SPECTRAL_FEATURES:
+        measured = np.array([getattr(SpectrumByFFT(Waveform(y, sr, 0.0), 4096), name)
+                             for y in renders])
+        errors[name] = np.abs(analytic[name].to_numpy() - measured) / np.abs(measured)
+    # stage 04
+    mel_spec = MelSpectrogram(sample_rate=sr, n_fft=4096, f_min=20, f_max=10000, pad=1,
+                              n_mels=200, power=2, norm="slaney", mel_scale="slaney")
+    with torch.inference_mode():
+        mel = mel_spec(torch.from_numpy(renders).to(torch.float32))
+        mel_db = amplitude_to_DB(mel.mean(dim=2, keepdim=True).unsqueeze(1),
+                                 multiplier=10, amin=1e-5, db_multiplier=20, top_db=80)
+    analytic_mel = analytic_mel_spectrum(
+        sr, carrier_frequencies, harmonicity_ratios, modulation_indices, dur)
+    errors["mel_db"] = np.abs(analytic_mel - mel_db[:, 0, :, 0].numpy()).ravel()
+    return pd.DataFrame({name: {"median": np.nanmedian(e), "p95": np.nanpercentile(e, 95), "max": np.nanmax(e)}
+                         for name, e in errors.items()}).T
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the spectral features of an FM parameter table analytically, or validate them against renders.")
+    parser.add_argument("--grid", default="../data/fm_synth_params.grid.json",
+                        help="the parameter grid spec (see param_grid.py), read instead of --csv if it exists")
+    parser.add_argument("--csv", default="../data/fm_synth_params.csv",
+                        help="the parameter table")
+    parser.add_argument("--sr", type=int, default=48000, help="the sample rate")
+    parser.add_argument("--dur", type=float, default=1,
+                        help="the duration of the tones in seconds")
+    parser.add_argument("--out", default="../data/fm_synth_spectral_features_analytic.columns",
+                        help="the ColumnStore to write the spectral features to")
+    parser.add_argument("--mel-out", default=None,
+                        help="a .npy file to write the mean mel spectra (in dB) to")
+    parser.add_argument("--validate", type=int, default=0, metavar="N",
+                        help="only compare N random rows with the FFT-based path")
+    args = parser.parse_args()
+    from param_grid import load_parameter_table
+    params = load_parameter_table(args.grid, args.csv, columns=["freq", "harm_ratio", "mod_index"])
+    freq, harm_ratio, mod_index = (params[name].to_numpy(dtype=np.float64)
+                                   for name in ["freq", "harm_ratio", "mod_index"])
+    if args.validate > 0:
+        rows = np.random.default_rng(0).choice(
+            len(params), min(args.validate, len(params)), replace=False)
+        report = validate_against_renders(
+            args.sr, freq[rows], harm_ratio[rows], mod_index[rows], args.dur)
+        print(report.to_string())
+    else:
+        import shutil
+        from columnar import ColumnStore
+        shutil.rmtree(args.out, ignore_errors=True)
+        df = analytic_spectral_features(
+            args.sr, freq, harm_ratio, mod_index, args.dur)
+        store = ColumnStore.create(args.out, len(df), {
+            "index": np.int64, **{name: np.float64 for name in df.columns}})
+        store.write(np.arange(len(df)), {"index": np.arange(len(df)), **{
+            name: df[name].to_numpy() for name in df.columns}})
+        print(f"Features saved to {args.out}")
+        if args.mel_out is not None:
+            write_analytic_mel_spectra(
+                args.mel_out, args.sr, freq, harm_ratio, mod_index, args.dur)
+            print(f"Saved {args.mel_out}")
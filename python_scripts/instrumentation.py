@@ -0,0 +1,316 @@
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import time
+import numpy as np
+
+# the edges of the latency histograms in seconds, 10 bins per decade from 1 us to 1000 s
+LATENCY_EDGES = 10 ** np.arange(-6, 3.05, 0.1)
+
+
+def metrics_path(output_path: str) -> str:
+    """
+    Get the path of the metrics report of a stage output (the same name with
+    .metrics.json instead of its extension).
+
+    Args:
+        output_path (str): The path of the output, e.g. "../data/fm_synth_spectral_features.columns".
+
+    Returns:
+        str: The path of the report.
+    """
+    return os.path.splitext(output_path)[0] + ".metrics.json"
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """
+    Get the peak resident memory of this process (or of its largest finished child).
+
+    Args:
+        who (int, optional): resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN. Defaults to
+            resource.RUSAGE_SELF.
+
+    Returns:
+        float: The peak in MB.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+class LatencyHistogram:
+    """
+    A histogram of item latencies with logarithmic bins (see LATENCY_EDGES), which keeps a
+    fixed size however many items it counts.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(len(LATENCY_EDGES) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = 0.0
+
+    def add(self, seconds) -> None:
+        """
+        Count one or more latencies.
+
+        Args:
+            seconds (float or np.ndarray): The latencies in seconds.
+        """
+        seconds = np.atleast_1d(np.asarray(seconds, dtype=np.float64))
+        if len(seconds) == 0:
+            return
+        # bin 0 is below the first edge, the last bin above the last one
+        np.add.at(self.counts, np.searchsorted(LATENCY_EDGES, seconds, side="right"), 1)
+        self.count += len(seconds)
+        self.total += seconds.sum()
+        self.min = min(self.min, seconds.min())
+        self.max = max(self.max, seconds.max())
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile of the latencies (to within a bin, a factor of 1.26).
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The geometric center of the bin of the quantile, in seconds.
+        """
+        rank = np.searchsorted(np.cumsum(self.counts), q * self.count, side="left")
+        low = LATENCY_EDGES[rank - 1] if rank > 0 else self.min
+        high = LATENCY_EDGES[rank] if rank < len(LATENCY_EDGES) else self.max
+        return float(np.clip(np.sqrt(low * high), self.min, self.max))
+
+    def to_dict(self) -> dict:
+        """
+        Get the summary and the non-empty bins of the histogram.
+
+        Returns:
+            dict: The count, mean, min, max, p50, p90 and p99 in seconds, and the bins as
+                lists of lower edges and counts.
+        """
+        if self.count == 0:
+            return {"count": 0}
+        nonzero = np.flatnonzero(self.counts)
+        lower_edges = np.concatenate([[0.0], LATENCY_EDGES])
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "bins": {"lower_edge": lower_edges[nonzero].tolist(),
+                     "count": self.counts[nonzero].tolist()},
+        }
+
+
+class StageMetrics:
+    """
+    Collects the runtime metrics of a pipeline stage: wall and CPU time per phase (e.g.
+    render, analysis, serialization), item latency histograms, the utilization of pool
+    workers and the queue depth of map_chunks, and peak memory. write saves them as a JSON
+    report, next to the output of the stage (see metrics_path).
+    """
+
+    def __init__(self, stage: str):
+        """
+        Args:
+            stage (str): The name of the stage, e.g. "03".
+        """
+        self.stage = stage
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        self.phases = {}
+        self.latencies = {}
+        self.pools = []
+
+    @contextmanager
+    def phase(self, name: str, items: int = None):
+        """
+        Time a phase of the stage. A phase can be entered many times (e.g. once per batch),
+        its times add up.
+
+        Args:
+            name (str): The name of the phase.
+            items (int, optional): The number of items processed in this call, to also count
+                their latencies under the name of the phase (see record_latency). Defaults to None.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - wall
+            phase = self.phases.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+            phase["wall_seconds"] += seconds
+            phase["cpu_seconds"] += time.process_time() - cpu
+            phase["calls"] += 1
+            if items:
+                self.record_latency(name, seconds, items)
+
+    def iterate(self, iterable, name: str):
+        """
+        Iterate over an iterable, timing the production of each item as a phase (e.g. the
+        batches of a DataLoader as "render").
+
+        Args:
+            iterable: The iterable.
+            name (str): The name of the phase.
+
+        Yields:
+            The items of the iterable.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record_latency(
+            self,
+            name: str,
+            seconds,
+            count: int = 1,
+    ) -> None:
+        """
+        Count item latencies. A batch of count items that took seconds together counts as
+        count items of seconds / count each.
+
+        Args:
+            name (str): The name of the histogram, e.g. "analysis".
+            seconds (float or np.ndarray): The latency of each item, or of the batch.
+            count (int, optional): The number of items of a batch. Defaults to 1.
+        """
+        histogram = self.latencies.setdefault(name, LatencyHistogram())
+        if count > 1:
+            seconds = np.full(count, seconds / count)
+        histogram.add(seconds)
+
+    def pool(self, name: str, num_workers: int) -> "PoolMetrics":
+        """
+        Start recording a worker pool (see map_chunks).
+
+        Args:
+            name (str): The name of the pool, e.g. "analysis".
+            num_workers (int): The number of workers.
+
+        Returns:
+            PoolMetrics: The pool metrics, which map_chunks fills in.
+        """
+        pool = PoolMetrics(self, name, num_workers)
+        self.pools.append(pool)
+        return pool
+
+    def to_dict(self) -> dict:
+        """
+        Get the report.
+
+        Returns:
+            dict: The metrics.
+        """
+        return {
+            "stage": self.stage,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+            "wall_seconds": time.time() - self.start,
+            "cpu_seconds": time.process_time() - self.cpu_start,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_child_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "phases": self.phases,
+            "item_latency": {name: histogram.to_dict() for name, histogram in self.latencies.items()},
+            "pools": [pool.to_dict() for pool in self.pools],
+        }
+
+    def write(self, path: str) -> None:
+        """
+        Write the report as JSON.
+
+        Args:
+            path (str): The path of the report, see metrics_path.
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class PoolMetrics:
+    """
+    The utilization of a pool of worker processes: the busy time and CPU time of each worker
+    against the lifetime of the pool, the number of chunks in flight, and the time results
+    take from a worker to the main process (IPC and waiting to be collected).
+    """
+
+    def __init__(self, stage: StageMetrics, name: str, num_workers: int):
+        self.stage = stage
+        self.name = name
+        self.num_workers = num_workers
+        self.start = time.time()
+        self.end = None
+        self.workers = {}
+        self.in_flight = []
+        self.transfer = LatencyHistogram()
+
+    def record_queue(self, in_flight: int) -> None:
+        """
+        Record the number of chunks submitted and not yet collected.
+
+        Args:
+            in_flight (int): The number of chunks.
+        """
+        self.in_flight.append(in_flight)
+
+    def record_chunk(self, timing: dict) -> None:
+        """
+        Record a chunk a worker finished.
+
+        Args:
+            timing (dict): The pid of the worker, the time.time() it started and finished
+                the chunk, its CPU seconds, the number of items and their latencies
+                (item_seconds, or None for a batched chunk).
+        """
+        worker = self.workers.setdefault(
+            timing["pid"], {"busy_seconds": 0.0, "cpu_seconds": 0.0, "chunks": 0, "items": 0})
+        worker["busy_seconds"] += timing["end"] - timing["start"]
+        worker["cpu_seconds"] += timing["cpu_seconds"]
+        worker["chunks"] += 1
+        worker["items"] += timing["items"]
+        self.transfer.add(max(time.time() - timing["end"], 0))
+        if timing["item_seconds"] is not None:
+            self.stage.record_latency(self.name, timing["item_seconds"])
+        else:
+            self.stage.record_latency(self.name, timing["end"] - timing["start"], timing["items"])
+
+    def close(self) -> None:
+        """
+        Mark the end of the pool.
+        """
+        self.end = time.time()
+
+    def to_dict(self) -> dict:
+        """
+        Get the report of the pool.
+
+        Returns:
+            dict: The metrics.
+        """
+        wall = (self.end or time.time()) - self.start
+        busy = sum(worker["busy_seconds"] for worker in self.workers.values())
+        in_flight = np.asarray(self.in_flight or [0])
+        return {
+            "name": self.name,
+            "num_workers": self.num_workers,
+            "wall_seconds": wall,
+            # the share of the pool's lifetime its workers were running chunks
+            "busy_ratio": busy / (wall * self.num_workers) if wall > 0 else 0.0,
+            "idle_ratio": 1 - busy / (wall * self.num_workers) if wall > 0 else 0.0,
+            "in_flight_mean": float(in_flight.mean()),
+            "in_flight_max": int(in_flight.max()),
+            "result_transfer": self.transfer.to_dict(),
+            "workers": {str(pid): worker for pid, worker in self.workers.items()},
+        }
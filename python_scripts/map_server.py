@@ -0,0 +1,398 @@
+import argparse
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from fluid_dataset import read_fluid_dataset
+
+# the largest payload of a UDP datagram over IPv4
+MAX_DATAGRAM = 65507
+
+
+def _pad(data: bytes) -> bytes:
+    # OSC strings are null-terminated and padded to a multiple of 4 bytes
+    return data + b"\0" * (4 - len(data) % 4)
+
+
+def encode_message(
+        address: str,
+        *args,
+) -> bytes:
+    """
+    Encode an OSC message, with ints as int32, floats as float32 and the rest as strings,
+    the types Max's udpsend and udpreceive use.
+
+    Args:
+        address (str): The OSC address, e.g. "/nearest".
+        *args: The arguments.
+
+    Returns:
+        bytes: The message.
+    """
+    tags, payload = ",", []
+    for arg in args:
+        if isinstance(arg, (int, np.integer)):
+            tags += "i"
+            payload.append(struct.pack(">i", arg))
+        elif isinstance(arg, (float, np.floating)):
+            tags += "f"
+            payload.append(struct.pack(">f", arg))
+        else:
+            tags += "s"
+            payload.append(_pad(str(arg).encode()))
+    return _pad(address.encode()) + _pad(tags.encode()) + b"".join(payload)
+
+
+def _read_string(data: bytes, offset: int) -> tuple:
+    end = data.index(b"\0", offset)
+    return data[offset:end].decode(), (end // 4 + 1) * 4
+
+
+def decode_message(data: bytes) -> tuple:
+    """
+    Decode an OSC message with int32, float32, float64 and string arguments.
+
+    Args:
+        data (bytes): The message.
+
+    Returns:
+        tuple: The address and the list of arguments.
+    """
+    address, offset = _read_string(data, 0)
+    tags, offset = _read_string(data, offset)
+    args = []
+    for tag in tags[1:]:
+        if tag == "i":
+            args.append(struct.unpack_from(">i", data, offset)[0])
+            offset += 4
+        elif tag == "f":
+            args.append(struct.unpack_from(">f", data, offset)[0])
+            offset += 4
+        elif tag == "d":
+            args.append(struct.unpack_from(">d", data, offset)[0])
+            offset += 8
+        elif tag == "s":
+            value, offset = _read_string(data, offset)
+            args.append(value)
+        else:
+            raise ValueError(f"unsupported OSC type tag: {tag}")
+    return address, args
+
+
+class MapIndex:
+    """
+    A spatial index over a 2D map (e.g. one of the pca_*.json datasets of stage 06) that
+    looks up the synth parameters of the points nearest to map coordinates. Like the Max
+    patch, the map is normalized to [0.01, 0.99] per axis (as fluid.normalize~ does) before
+    it is indexed, so it takes the same coordinates as the plotter.
+    """
+
+    def __init__(
+            self,
+            map_path: str,
+            params_path: str = "../data/fm_params.json",
+            normalize_range: tuple = (0.01, 0.99),
+    ):
+        """
+        Args:
+            map_path (str): The fluid.dataset~ JSON file of the map.
+            params_path (str, optional): The fluid.dataset~ JSON file of the synth parameters,
+                with the same rows as the map. Defaults to "../data/fm_params.json".
+            normalize_range (tuple, optional): The range the map is normalized to, or None to
+                query in the original map coordinates. Defaults to (0.01, 0.99).
+        """
+        self.params = np.asarray(read_fluid_dataset(params_path), dtype=np.float64)
+        self.load_map(map_path, normalize_range)
+
+    def load_map(
+            self,
+            map_path: str,
+            normalize_range: tuple = (0.01, 0.99),
+    ) -> None:
+        """
+        Load (another) map and index it.
+
+        Args:
+            map_path (str): The fluid.dataset~ JSON file of the map.
+            normalize_range (tuple, optional): The range the map is normalized to, or None to
+                query in the original map coordinates. Defaults to (0.01, 0.99).
+        """
+        points = np.asarray(read_fluid_dataset(map_path), dtype=np.float64)
+        if len(points) != len(self.params):
+            raise ValueError(
+                f"{map_path} has {len(points)} points, but there are {len(self.params)} synth parameters")
+        if normalize_range is not None:
+            low, high = normalize_range
+            span = np.ptp(points, axis=0)
+            span[span == 0] = 1
+            points = low + (points - points.min(axis=0)) / span * (high - low)
+        self.map_path = map_path
+        self.tree = cKDTree(points)
+
+    def knn(
+            self,
+            coords: np.ndarray,
+            k: int = 1,
+    ) -> tuple:
+        """
+        Find the k nearest points of a batch of map coordinates.
+
+        Args:
+            coords (np.ndarray): The (Q, 2) map coordinates.
+            k (int, optional): The number of neighbours. Defaults to 1.
+
+        Returns:
+            tuple: The (Q, k) point indices, their (Q, k) distances and their (Q, k, 3)
+                synth parameters (freq, harm_ratio, mod_index).
+        """
+        distances, indices = self.tree.query(np.reshape(coords, (-1, 2)), k=[*range(1, k + 1)])
+        return indices, distances, self.params[indices]
+
+    def radius(
+            self,
+            coords: np.ndarray,
+            r: float,
+    ) -> tuple:
+        """
+        Find all points within a radius of a map coordinate, nearest first.
+
+        Args:
+            coords (np.ndarray): The map coordinate (2,).
+            r (float): The radius.
+
+        Returns:
+            tuple: The point indices, their distances and their (M, 3) synth parameters.
+        """
+        indices = np.asarray(self.tree.query_ball_point(np.ravel(coords), r), dtype=np.int64)
+        distances = np.linalg.norm(self.tree.data[indices] - np.ravel(coords), axis=1)
+        order = np.argsort(distances, kind="stable")
+        return indices[order], distances[order], self.params[indices[order]]
+
+
+class MapServer:
+    """
+    Serves the lookups of a MapIndex over OSC on a local UDP socket. It understands:
+
+    - /nearest x y: replies /nearest index freq harm_ratio mod_index
+    - /knn k x1 y1 [x2 y2 ...]: replies /knn with index freq harm_ratio mod_index for each
+      neighbour of each query, nearest first
+    - /radius r x y: replies /radius with index freq harm_ratio mod_index for each point
+      within r, nearest first
+    - /load path: indexes another map, replies /load path
+
+    Replies are cut to the first max_points points, so they fit in one datagram. A reply that
+    still does not fit is answered with /error.
+    """
+
+    def __init__(
+            self,
+            index: MapIndex,
+            host: str = "127.0.0.1",
+            port: int = 7400,
+            reply_port: int = None,
+            max_points: int = 2048,
+    ):
+        """
+        Args:
+            index (MapIndex): The index.
+            host (str, optional): The address to listen on. Defaults to "127.0.0.1".
+            port (int, optional): The port to listen on, 0 for any free port. Defaults to 7400.
+            reply_port (int, optional): The port to send the replies to (on the host of the
+                sender), e.g. the port of a udpreceive object. Defaults to None, which replies
+                to the port the query came from.
+            max_points (int, optional): The most points per reply, nearest first (for /knn,
+                in the order of the queries). Each takes 20 bytes. Defaults to 2048.
+        """
+        self.index = index
+        self.reply_port = reply_port
+        self.max_points = max_points
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.address = self.socket.getsockname()
+        self.running = False
+
+    def handle(self, data: bytes) -> bytes:
+        """
+        Answer one OSC message.
+
+        Args:
+            data (bytes): The message.
+
+        Returns:
+            bytes: The reply.
+        """
+        address, args = decode_message(data)
+        if address == "/nearest":
+            indices, _, params = self.index.knn(args[:2], k=1)
+            return encode_points(address, indices[0], params[0])
+        if address == "/knn":
+            indices, _, params = self.index.knn(args[1:], k=int(args[0]))
+            return encode_points(address, indices.ravel()[:self.max_points],
+                                 params.reshape(-1, 3)[:self.max_points])
+        if address == "/radius":
+            indices, _, params = self.index.radius(args[1:3], args[0])
+            return encode_points(address, indices[:self.max_points], params[:self.max_points])
+        if address == "/load":
+            self.index.load_map(args[0])
+            return encode_message(address, args[0])
+        return encode_message("/error", f"unknown address {address}")
+
+    def serve_forever(self) -> None:
+        """
+        Answer messages until stop is called.
+        """
+        self.running = True
+        while self.running:
+            try:
+                data, sender = self.socket.recvfrom(65536)
+            except OSError:
+                break
+            try:
+                reply = self.handle(data)
+            except Exception as error:
+                reply = encode_message("/error", str(error))
+            if len(reply) > MAX_DATAGRAM:
+                reply = encode_message(
+                    "/error", f"reply of {len(reply)} bytes does not fit in a datagram, lower max_points")
+            if self.reply_port is not None:
+                sender = (sender[0], self.reply_port)
+            try:
+                self.socket.sendto(reply, sender)
+            except OSError as error:
+                if not self.running:
+                    break
+                # one reply that cannot be sent must not stop the server
+                try:
+                    self.socket.sendto(encode_message("/error", str(error)), sender)
+                except OSError:
+                    pass
+
+    def stop(self) -> None:
+        """
+        Stop serving and close the socket.
+        """
+        self.running = False
+        self.socket.close()
+
+
+# an int32 index and three float32 parameters per point, big-endian as in OSC
+_POINT = np.dtype([("index", ">i4"), ("params", ">f4", (3,))])
+
+
+def encode_points(
+        address: str,
+        indices: np.ndarray,
+        params: np.ndarray,
+) -> bytes:
+    """
+    Encode a list of points as an OSC message of index freq harm_ratio mod_index for each
+    point, in one vectorized step instead of argument by argument.
+
+    Args:
+        address (str): The OSC address.
+        indices (np.ndarray): The point indices (M,).
+        params (np.ndarray): Their (M, 3) synth parameters.
+
+    Returns:
+        bytes: The message.
+    """
+    points = np.zeros(len(indices), dtype=_POINT)
+    points["index"] = indices
+    points["params"] = params
+    tags = "," + "ifff" * len(indices)
+    return _pad(address.encode()) + _pad(tags.encode()) + points.tobytes()
+
+
+def benchmark(
+        index: MapIndex,
+        num_queries: int = 10000,
+        k: int = 1,
+        batch: int = 1,
+        seed: int = 0,
+) -> dict:
+    """
+    Measure the round trip latency of the server on a local socket, with a client that sends
+    a query and waits for its reply before sending the next one, as a control-rate stream
+    from Max would.
+
+    Args:
+        index (MapIndex): The index.
+        num_queries (int, optional): The number of messages to send. Defaults to 10000.
+        k (int, optional): The number of neighbours per query (1 uses /nearest, more /knn).
+            Defaults to 1.
+        batch (int, optional): The number of coordinates per /knn message. Defaults to 1.
+        seed (int, optional): The seed of the random coordinates. Defaults to 0.
+
+    Returns:
+        dict: The median, 99th percentile and maximum round trip time in milliseconds, and
+            the number of messages per second.
+    """
+    server = MapServer(index, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(5)
+    low, high = index.tree.mins, index.tree.maxes
+    coords = np.random.default_rng(seed).uniform(low, high, (num_queries, batch, 2))
+    if k == 1 and batch == 1:
+        messages = [encode_message("/nearest", *c[0].tolist()) for c in coords]
+    else:
+        messages = [encode_message("/knn", k, *c.ravel().tolist()) for c in coords]
+    latencies = np.zeros(num_queries)
+    try:
+        start = time.perf_counter()
+        for i, message in enumerate(messages):
+            sent = time.perf_counter()
+            client.sendto(message, server.address)
+            client.recvfrom(65536)
+            latencies[i] = time.perf_counter() - sent
+        total = time.perf_counter() - start
+    finally:
+        server.stop()
+        client.close()
+    return {
+        "median_ms": np.median(latencies) * 1000,
+        "p99_ms": np.percentile(latencies, 99) * 1000,
+        "max_ms": latencies.max() * 1000,
+        "messages_per_second": num_queries / total,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve nearest neighbour lookups from a map to the synth parameters over OSC.")
+    parser.add_argument("--map", default="../data/pca_mels_mean.json",
+                        help="the map to index (a pca_*.json dataset)")
+    parser.add_argument("--params", default="../data/fm_params.json",
+                        help="the synth parameters of the points of the map")
+    parser.add_argument("--raw", action="store_true",
+                        help="query in the original map coordinates instead of the normalized ones of the Max patch")
+    parser.add_argument("--host", default="127.0.0.1", help="the address to listen on")
+    parser.add_argument("--port", type=int, default=7400, help="the port to listen on")
+    parser.add_argument("--reply-port", type=int, default=None,
+                        help="the port to send the replies to (default: the port of the sender)")
+    parser.add_argument("--max-points", type=int, default=2048,
+                        help="the most points per reply, so replies fit in one datagram")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="N",
+                        help="instead of serving, time N queries from a local client")
+    parser.add_argument("--k", type=int, default=1,
+                        help="the number of neighbours per benchmark query")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="the number of coordinates per benchmark message")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    index = MapIndex(args.map, args.params, None if args.raw else (0.01, 0.99))
+    print(f"Indexed {len(index.params)} points of {args.map} in {time.perf_counter() - start:.2f} s")
+    if args.benchmark is not None:
+        report = benchmark(index, args.benchmark, args.k, args.batch)
+        for key, value in report.items():
+            print(f"{key}: {value:.4f}")
+    else:
+        server = MapServer(index, args.host, args.port, args.reply_port, args.max_points)
+        print(f"Listening on {server.address[0]}:{server.address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
@@ -0,0 +1,379 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from utils import midi2frequency, FmSynthDataset
+
+# the parameter ranges of 01_build_fm_synth_params.py
+PITCH_RANGE = (38, 86)  # midi
+HARM_RATIO_RANGE = (0, 10)
+MOD_INDEX_RANGE = (0, 10)
+
+# where 01_build_fm_synth_params.py saves the grid, and the table it writes instead when it
+# samples the parameter space adaptively
+GRID_PATH = "../data/fm_synth_params.grid.json"
+CSV_PATH = "../data/fm_synth_params.csv"
+
+# the columns of the parameter table, in the order of fm_synth_params.csv
+COLUMNS = ["x", "y", "z", "freq", "harm_ratio", "mod_index"]
+
+
+def _linspace_at(
+        start: float,
+        stop: float,
+        num: int,
+        k: np.ndarray,
+) -> np.ndarray:
+    # element k of np.linspace(start, stop, num), computed the same way, so bit for bit equal
+    k = np.asarray(k)
+    if num == 1:
+        return np.full(k.shape, float(start))
+    step = (stop - start) / (num - 1)
+    return np.where(k == num - 1, float(stop), k * step + start)
+
+
+class ParamGrid:
+    """
+    The dense parameter grid of 01_build_fm_synth_params.py as an implicit table. Row i is the
+    grid point with the mixed-radix digits y, x, z of i (i = y * X * Z + x * Z + z, where X,
+    Y and Z are the numbers of pitch, harmonicity ratio and modulation index steps), so its
+    values are computed from its index in constant memory instead of being read from a CSV.
+    The values are the same as those of the materialized grid, bit for bit.
+    """
+
+    def __init__(
+            self,
+            pitch_steps: int = 51,
+            harm_ratio_steps: int = 51,
+            mod_idx_steps: int = 51,
+            pitch_range: tuple = PITCH_RANGE,
+            harm_ratio_range: tuple = HARM_RATIO_RANGE,
+            mod_index_range: tuple = MOD_INDEX_RANGE,
+    ):
+        """
+        Args:
+            pitch_steps (int, optional): The number of pitches (x). Defaults to 51.
+            harm_ratio_steps (int, optional): The number of harmonicity ratios (y). Defaults to 51.
+            mod_idx_steps (int, optional): The number of modulation indices (z). Defaults to 51.
+            pitch_range (tuple, optional): The lowest and highest pitch in MIDI. Defaults to PITCH_RANGE.
+            harm_ratio_range (tuple, optional): The lowest and highest harmonicity ratio.
+                Defaults to HARM_RATIO_RANGE.
+            mod_index_range (tuple, optional): The lowest and highest modulation index.
+                Defaults to MOD_INDEX_RANGE.
+        """
+        self.pitch_steps = int(pitch_steps)
+        self.harm_ratio_steps = int(harm_ratio_steps)
+        self.mod_idx_steps = int(mod_idx_steps)
+        self.pitch_range = tuple(pitch_range)
+        self.harm_ratio_range = tuple(harm_ratio_range)
+        self.mod_index_range = tuple(mod_index_range)
+
+    @property
+    def shape(self) -> tuple:
+        """
+        The shape of the grid in row order, (Y, X, Z).
+        """
+        return self.harm_ratio_steps, self.pitch_steps, self.mod_idx_steps
+
+    def __len__(self):
+        return self.harm_ratio_steps * self.pitch_steps * self.mod_idx_steps
+
+    def _check(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError(f"grid index out of range for {len(self)} rows")
+        return indices
+
+    def coords(self, indices) -> tuple:
+        """
+        Get the grid coordinates of rows.
+
+        Args:
+            indices (array-like): The row indices.
+
+        Returns:
+            tuple: The x (pitch), y (harmonicity ratio) and z (modulation index) steps.
+        """
+        y, rest = np.divmod(self._check(indices), self.pitch_steps * self.mod_idx_steps)
+        x, z = np.divmod(rest, self.mod_idx_steps)
+        return x, y, z
+
+    def index(self, x, y, z) -> np.ndarray:
+        """
+        Get the rows of grid coordinates.
+
+        Args:
+            x (array-like): The pitch steps.
+            y (array-like): The harmonicity ratio steps.
+            z (array-like): The modulation index steps.
+
+        Returns:
+            np.ndarray: The row indices.
+        """
+        x, y, z = (np.asarray(c, dtype=np.int64) for c in (x, y, z))
+        return (y * self.pitch_steps + x) * self.mod_idx_steps + z
+
+    def params(self, indices) -> tuple:
+        """
+        Get the synth parameters of rows.
+
+        Args:
+            indices (array-like): The row indices.
+
+        Returns:
+            tuple: The freq, harm_ratio and mod_index arrays.
+        """
+        x, y, z = self.coords(indices)
+        pitch = _linspace_at(*self.pitch_range, self.pitch_steps, x)
+        # as np.linspace(0, 1, steps) * 10 in the original grid
+        low, high = self.harm_ratio_range
+        harm_ratio = _linspace_at(0, 1, self.harm_ratio_steps, y) * (high - low) + low
+        low, high = self.mod_index_range
+        mod_index = _linspace_at(0, 1, self.mod_idx_steps, z) * (high - low) + low
+        return midi2frequency(pitch), harm_ratio, mod_index
+
+    def values(self, name: str, indices) -> np.ndarray:
+        """
+        Get one column of rows.
+
+        Args:
+            name (str): The column, one of COLUMNS.
+            indices (array-like): The row indices.
+
+        Returns:
+            np.ndarray: The values.
+        """
+        if name in ("x", "y", "z"):
+            return self.coords(indices)["xyz".index(name)]
+        if name in ("freq", "harm_ratio", "mod_index"):
+            return self.params(indices)[["freq", "harm_ratio", "mod_index"].index(name)]
+        raise KeyError(name)
+
+    def column(self, name: str) -> "GridColumn":
+        """
+        Get a lazy column, which computes the values of the rows it is indexed with.
+
+        Args:
+            name (str): The column, one of COLUMNS.
+
+        Returns:
+            GridColumn: The column.
+        """
+        return GridColumn(self, name)
+
+    def table(self, start: int = 0, stop: int = None) -> pd.DataFrame:
+        """
+        Get (a range of rows of) the grid as a table, as fm_synth_params.csv holds it.
+
+        Args:
+            start (int, optional): The first row. Defaults to 0.
+            stop (int, optional): The row after the last one. Defaults to None, which means len(self).
+
+        Returns:
+            pd.DataFrame: The x, y, z, freq, harm_ratio and mod_index columns, indexed by row.
+        """
+        indices = np.arange(start, len(self) if stop is None else stop)
+        x, y, z = self.coords(indices)
+        freq, harm_ratio, mod_index = self.params(indices)
+        return pd.DataFrame({"x": x, "y": y, "z": z, "freq": freq, "harm_ratio": harm_ratio,
+                             "mod_index": mod_index}, index=indices)
+
+    def export_csv(self, path: str, chunk_rows: int = 65536) -> None:
+        """
+        Write the grid as a CSV table (the format of fm_synth_params.csv), a chunk at a time.
+
+        Args:
+            path (str): The path of the CSV file.
+            chunk_rows (int, optional): The number of rows per chunk. Defaults to 65536.
+        """
+        for start in range(0, len(self), chunk_rows):
+            self.table(start, min(start + chunk_rows, len(self))).to_csv(
+                path, mode="w" if start == 0 else "a", header=start == 0)
+
+    def to_spec(self) -> dict:
+        """
+        Get the spec of the grid, which is all it takes to recreate it.
+
+        Returns:
+            dict: The steps and ranges.
+        """
+        return {"steps": [self.pitch_steps, self.harm_ratio_steps, self.mod_idx_steps],
+                "pitch_range": list(self.pitch_range),
+                "harm_ratio_range": list(self.harm_ratio_range),
+                "mod_index_range": list(self.mod_index_range)}
+
+    @classmethod
+    def from_spec(cls, spec: dict) -> "ParamGrid":
+        """
+        Recreate a grid from its spec.
+
+        Args:
+            spec (dict): The spec (see to_spec).
+
+        Returns:
+            ParamGrid: The grid.
+        """
+        return cls(*spec["steps"], spec["pitch_range"], spec["harm_ratio_range"],
+                   spec["mod_index_range"])
+
+    def save(self, path: str) -> None:
+        """
+        Save the spec of the grid as JSON.
+
+        Args:
+            path (str): The path of the file.
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_spec(), f)
+
+    @classmethod
+    def load(cls, path: str) -> "ParamGrid":
+        """
+        Load a grid saved with save.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            ParamGrid: The grid.
+        """
+        with open(path, "r") as f:
+            return cls.from_spec(json.load(f))
+
+
+class GridColumn:
+    """
+    A column of a ParamGrid that can stand in for a NumPy array of its values: indexing it with
+    an integer, a slice or an array of indices computes those values, and np.asarray computes
+    all of them.
+    """
+
+    def __init__(self, grid: ParamGrid, name: str):
+        """
+        Args:
+            grid (ParamGrid): The grid.
+            name (str): The column, one of COLUMNS.
+        """
+        self.grid = grid
+        self.name = name
+
+    def __len__(self):
+        return len(self.grid)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.grid.values(self.name, np.arange(*key.indices(len(self))))
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        # negative indices count from the end, as for arrays
+        indices = np.where(key < 0, key + len(self), key)
+        values = self.grid.values(self.name, np.atleast_1d(indices))
+        return values[0] if key.ndim == 0 else values.reshape(key.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+
+def grid_of(freq, harm_ratio, mod_index) -> ParamGrid:
+    """
+    Get the grid that parameter columns come from, to work on its spec instead of its values.
+
+    Args:
+        freq (array-like): The carrier frequencies.
+        harm_ratio (array-like): The harmonicity ratios.
+        mod_index (array-like): The modulation indices.
+
+    Returns:
+        ParamGrid: The grid, or None if the columns are not the freq, harm_ratio and mod_index
+            columns of one grid.
+    """
+    columns = (freq, harm_ratio, mod_index)
+    if not all(isinstance(column, GridColumn) for column in columns):
+        return None
+    if [column.name for column in columns] != ["freq", "harm_ratio", "mod_index"]:
+        return None
+    if any(column.grid is not freq.grid for column in columns):
+        return None
+    return freq.grid
+
+
+def open_dataset(
+        grid_path: str = GRID_PATH,
+        fallback_csv: str = CSV_PATH,
+        sr: int = 48000,
+        dur: float = 1,
+        cache_dir: str = None,
+) -> FmSynthDataset:
+    """
+    Open the parameters written by 01_build_fm_synth_params.py as a dataset: the implicit grid
+    if there is a grid spec, otherwise (after adaptive sampling) the CSV table.
+
+    Args:
+        grid_path (str, optional): The path of the grid spec. Defaults to GRID_PATH.
+        fallback_csv (str, optional): The CSV table to read if there is no grid spec. Defaults to CSV_PATH.
+        sr (int, optional): The sample rate. Defaults to 48000.
+        dur (float, optional): The duration of each render in seconds. Defaults to 1.
+        cache_dir (str, optional): The RenderCache directory to read renders from. Defaults to None.
+
+    Returns:
+        FmSynthDataset: The dataset.
+    """
+    if os.path.exists(grid_path):
+        return FmSynthDataset.from_grid(ParamGrid.load(grid_path), sr=sr, dur=dur, cache_dir=cache_dir)
+    return FmSynthDataset(fallback_csv, sr=sr, dur=dur, cache_dir=cache_dir)
+
+
+def load_parameter_table(
+        grid_path: str = GRID_PATH,
+        fallback_csv: str = CSV_PATH,
+        columns: list = None,
+) -> pd.DataFrame:
+    """
+    Load the parameters written by 01_build_fm_synth_params.py as a table, from the grid spec if
+    there is one, otherwise from the CSV table.
+
+    Args:
+        grid_path (str, optional): The path of the grid spec. Defaults to GRID_PATH.
+        fallback_csv (str, optional): The CSV table to read if there is no grid spec. Defaults to CSV_PATH.
+        columns (list, optional): The columns to load. Defaults to None, which means all of them.
+
+    Returns:
+        pd.DataFrame: The table, indexed by row.
+    """
+    if os.path.exists(grid_path):
+        df = ParamGrid.load(grid_path).table()
+    else:
+        df = pd.read_csv(fallback_csv, index_col=0)
+    return df if columns is None else df[columns]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check an implicit parameter grid against the materialized one, or export it as CSV.")
+    parser.add_argument("--steps", type=int, nargs=3, default=[51, 51, 51],
+                        metavar=("PITCH", "HARM_RATIO", "MOD_INDEX"), help="the steps per axis")
+    parser.add_argument("--csv", default=None, help="export the grid to this CSV file")
+    args = parser.parse_args()
+    grid = ParamGrid(*args.steps)
+    if args.csv is not None:
+        grid.export_csv(args.csv)
+        print(f"Saved {args.csv}")
+    else:
+        # the meshgrid 01_build_fm_synth_params.py used to write to the CSV
+        pitch_steps, harm_ratio_steps, mod_idx_steps = args.steps
+        freqs, ratios, indices = np.meshgrid(
+            midi2frequency(np.linspace(*PITCH_RANGE, pitch_steps)),
+            np.linspace(0, 1, harm_ratio_steps) * HARM_RATIO_RANGE[1],
+            np.linspace(0, 1, mod_idx_steps) * MOD_INDEX_RANGE[1])
+        expected = {
+            "x": np.tile(np.repeat(np.arange(pitch_steps), mod_idx_steps), harm_ratio_steps),
+            "y": np.repeat(np.arange(harm_ratio_steps), pitch_steps * mod_idx_steps),
+            "z": np.tile(np.arange(mod_idx_steps), harm_ratio_steps * pitch_steps),
+            "freq": freqs.flatten(), "harm_ratio": ratios.flatten(), "mod_index": indices.flatten()}
+        table = grid.table()
+        for name in COLUMNS:
+            print(f"{name}: {'equal' if np.array_equal(table[name].values, expected[name]) else 'DIFFERENT'}")
+        print("spec:", json.dumps(grid.to_spec()))
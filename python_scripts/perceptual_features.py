@@ -0,0 +1,238 @@
+import argparse
+from contextlib import contextmanager
+import hashlib
+import inspect
+import time
+import numpy as np
+from numba import jit
+import pandas as pd
+import timbral_models
+from timbral_models import timbral_util
+
+
+# the timbral_models descriptors, in the order stage 02 reports them
+PERCEPTUAL_FEATURES = {
+    "hardness": timbral_models.timbral_hardness,
+    "depth": timbral_models.timbral_depth,
+    "brightness": timbral_models.timbral_brightness,
+    "roughness": timbral_models.timbral_roughness,
+    "warmth": timbral_models.timbral_warmth,
+    "sharpness": timbral_models.timbral_sharpness,
+    "boominess": timbral_models.timbral_booming,
+}
+
+# the timbral_util analyses that several descriptors repeat on identical inputs:
+# loudness normalisation (all seven), the specific loudness of each 4096-sample window
+# (hardness, warmth, sharpness and booming, which runs it twice), the 20 Hz highpass
+# (depth and brightness) and the third-octave filters that specific loudness designs
+# again for every window
+SHARED_ANALYSES = ["file_read", "specific_loudness", "filter_audio_highpass", "filter_design2"]
+
+
+@jit(nopython=True, cache=True)
+def _sample_and_hold(abs_samples, decay, hold_samples):
+    # same loop as timbral_util.sample_and_hold_envelope_calculation
+    envelope = np.zeros(len(abs_samples))
+    decayed = False
+    hold_counter = 0
+    previous_sample = 0.0
+    for i in range(len(abs_samples)):
+        sample = abs_samples[i]
+        if sample >= previous_sample:
+            envelope[i] = sample
+            previous_sample = sample
+            hold_counter = 0
+        elif hold_counter < hold_samples:
+            hold_counter += 1
+            envelope[i] = previous_sample
+        else:
+            out = previous_sample - decay
+            if out > sample:
+                envelope[i] = out
+                previous_sample = out
+                decayed = True
+            else:
+                envelope[i] = sample
+                previous_sample = sample
+    return envelope, decayed
+
+
+def sample_and_hold_envelope(
+        audio_samples: np.ndarray,
+        fs: int,
+        decay_time: float = 0.2,
+        hold_time: float = 0.01,
+) -> np.ndarray:
+    """
+    Compiled drop-in for timbral_util.sample_and_hold_envelope_calculation, which hardness,
+    depth and warmth run as a Python loop over every sample.
+
+    Args:
+        audio_samples (np.ndarray): The audio.
+        fs (int): The sample rate.
+        decay_time (float, optional): The decay time after the hold. Defaults to 0.2.
+        hold_time (float, optional): The hold time in seconds. Defaults to 0.01.
+
+    Returns:
+        np.ndarray: The envelope, with the same values and dtype as the original.
+    """
+    abs_samples = np.abs(audio_samples)
+    decay = np.max(abs_samples) / (decay_time * fs)
+    envelope, decayed = _sample_and_hold(abs_samples, np.float64(decay), hold_time * fs)
+    # the original collects samples and decayed (float64) values in a list, so the
+    # envelope only keeps the dtype of the audio if it never decays
+    if not decayed:
+        envelope = envelope.astype(abs_samples.dtype)
+    return envelope
+
+
+class SharedAnalysis:
+    """
+    Memoizes the shared timbral_util analyses (see SHARED_ANALYSES) by the content of their
+    inputs, so running all seven descriptors on a signal computes each of them only once.
+    Callers always get a copy of the cached result, since some descriptors scale their
+    filtered audio in place.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.originals = {name: getattr(timbral_util, name) for name in SHARED_ANALYSES}
+
+    def _key(self, name, *args, **kwargs):
+        bound = inspect.signature(self.originals[name]).bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = [name]
+        for value in bound.arguments.values():
+            if isinstance(value, np.ndarray):
+                value = np.ascontiguousarray(value)
+                value = (value.dtype.str, value.shape, hashlib.sha1(value).digest())
+            key.append(value)
+        return tuple(key)
+
+    def memoized(self, name: str):
+        """
+        Get the memoizing version of a timbral_util analysis.
+
+        Args:
+            name (str): The name of the analysis, one of SHARED_ANALYSES.
+
+        Returns:
+            callable: A function with the signature of the original.
+        """
+        def analysis(*args, **kwargs):
+            key = self._key(name, *args, **kwargs)
+            if key in self.cache:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.cache[key] = self.originals[name](*args, **kwargs)
+            return _copy_result(self.cache[key])
+        return analysis
+
+
+def _copy_result(result):
+    if isinstance(result, tuple):
+        return tuple(_copy_result(value) for value in result)
+    if isinstance(result, np.ndarray):
+        return result.copy()
+    return result
+
+
+@contextmanager
+def shared_analysis():
+    """
+    Within this context, the timbral_models descriptors share their intermediate analyses
+    (see SharedAnalysis) and use the compiled sample-and-hold envelope. The cache lives as
+    long as the context, so open one per signal (or per batch of signals).
+
+    Yields:
+        SharedAnalysis: The cache, e.g. to inspect its hits and misses.
+    """
+    analysis = SharedAnalysis()
+    envelope = timbral_util.sample_and_hold_envelope_calculation
+    try:
+        for name in SHARED_ANALYSES:
+            setattr(timbral_util, name, analysis.memoized(name))
+        timbral_util.sample_and_hold_envelope_calculation = sample_and_hold_envelope
+        yield analysis
+    finally:
+        for name, original in analysis.originals.items():
+            setattr(timbral_util, name, original)
+        timbral_util.sample_and_hold_envelope_calculation = envelope
+
+
+def perceptual_descriptors(
+        y: np.ndarray,
+        sr: int,
+) -> dict:
+    """
+    Compute all seven timbral_models descriptors of a signal, sharing the analyses they
+    have in common. The results are the same as calling each timbral_models function.
+
+    Args:
+        y (np.ndarray): The audio.
+        sr (int): The sample rate.
+
+    Returns:
+        dict: The descriptor names (see PERCEPTUAL_FEATURES) mapped to their values.
+    """
+    with shared_analysis():
+        return {name: fn(y, fs=sr) for name, fn in PERCEPTUAL_FEATURES.items()}
+
+
+def check_conformance(
+        dataset,
+        indices: np.ndarray,
+) -> pd.DataFrame:
+    """
+    Compare perceptual_descriptors with the separate timbral_models calls on some items of
+    a dataset, and time both.
+
+    Args:
+        dataset (FmSynthDataset): The dataset.
+        indices (np.ndarray): The items to compare.
+
+    Returns:
+        pd.DataFrame: The maximum absolute difference of each descriptor. The time per item
+            of both paths is in its attrs["seconds_per_item"].
+    """
+    differences = {name: [] for name in PERCEPTUAL_FEATURES}
+    separate_time, shared_time = 0.0, 0.0
+    for i in indices:
+        y = dataset[int(i)][0]
+        start = time.perf_counter()
+        expected = {name: fn(y, fs=dataset.sr) for name, fn in PERCEPTUAL_FEATURES.items()}
+        separate_time += time.perf_counter() - start
+        start = time.perf_counter()
+        shared = perceptual_descriptors(y, dataset.sr)
+        shared_time += time.perf_counter() - start
+        for name in PERCEPTUAL_FEATURES:
+            differences[name].append(abs(shared[name] - expected[name]))
+    report = pd.DataFrame({"max_abs_difference": {
+        name: np.max(values) for name, values in differences.items()}})
+    report.attrs["seconds_per_item"] = {"separate": separate_time / len(indices),
+                                        "shared": shared_time / len(indices)}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the shared-analysis descriptors match timbral_models on random rows of a parameter table.")
+    parser.add_argument("--grid", default="../data/fm_synth_params.grid.json",
+                        help="the parameter grid spec (see param_grid.py), read instead of --csv if it exists")
+    parser.add_argument("--csv", default="../data/fm_synth_params.csv",
+                        help="the parameter table")
+    parser.add_argument("--sr", type=int, default=48000, help="the sample rate")
+    parser.add_argument("--dur", type=float, default=1,
+                        help="the duration of the tones in seconds")
+    parser.add_argument("--num", type=int, default=20,
+                        help="the number of random rows to compare")
+    args = parser.parse_args()
+    from param_grid import open_dataset
+    ds = open_dataset(args.grid, args.csv, sr=args.sr, dur=args.dur)
+    rows = np.random.default_rng(0).choice(len(ds), min(args.num, len(ds)), replace=False)
+    report = check_conformance(ds, rows)
+    print(report.to_string())
+    print("seconds per item:", report.attrs["seconds_per_item"])
@@ -0,0 +1,183 @@
+import argparse
+import time
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from scipy.signal import fftconvolve
+
+
+def marker_kernel(
+        face_diameter: float,
+        edge_width: float = 0,
+        supersampling: int = 4,
+) -> np.ndarray:
+    """
+    Get the pixel footprint of a round marker the way Agg draws it: the face, with the edge
+    line stroked over it, both anti-aliased. Where the edge overlaps the face, a pixel is
+    covered twice, as plt.scatter draws it.
+
+    Args:
+        face_diameter (float): The diameter of the face in pixels.
+        edge_width (float, optional): The width of the edge line in pixels. Defaults to 0.
+        supersampling (int, optional): The number of samples per pixel along each axis.
+            Defaults to 4.
+
+    Returns:
+        np.ndarray: A square array with the number of times each pixel is covered.
+    """
+    radius = face_diameter / 2
+    outer, inner = radius + edge_width / 2, max(radius - edge_width / 2, 0)
+    reach = int(np.ceil(max(outer, 0.5) - 0.5))
+    # sample positions within each pixel, relative to the center of the middle pixel
+    samples = (np.arange(supersampling) + 0.5) / supersampling - 0.5
+    offsets = (np.arange(-reach, reach + 1)[:, None] + samples[None, :]).ravel()
+    distance = np.sqrt(offsets[:, None] ** 2 + offsets[None, :] ** 2)
+    layers = (distance <= radius).astype(np.float64)
+    if edge_width > 0:
+        layers += (distance <= outer) & (distance >= inner)
+    size = 2 * reach + 1
+    layers = layers.reshape(size, supersampling, size, supersampling).mean(axis=(1, 3))
+    # a marker smaller than a pixel still covers the pixel it is in
+    if layers.sum() == 0:
+        layers[reach, reach] = 1
+    return layers
+
+
+def rasterize_points(
+        x: np.ndarray,
+        y: np.ndarray,
+        colors: np.ndarray,
+        extent: tuple,
+        shape: tuple,
+        kernel: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Draw a scatter plot as an RGBA image in a fixed number of vectorized operations. The
+    points are binned into the pixels they fall in, then the binned sums are spread over the
+    marker's footprint with one convolution, so apart from the binning the time depends on
+    the image size, not on the number of points. Overlapping points are blended per pixel:
+    the alpha is exactly what drawing them one over the other would give (1 minus the
+    product of their transparencies), and the color is their alpha-weighted mean, which does
+    not depend on the drawing order (unlike plt.scatter, where the last point is on top).
+
+    Args:
+        x (np.ndarray): The x coordinates of the points (N,).
+        y (np.ndarray): The y coordinates of the points (N,).
+        colors (np.ndarray): The (N, 4) RGBA (or (N, 3) RGB) colors of the points, in [0, 1].
+        extent (tuple): The data range (x_min, x_max, y_min, y_max) of the image.
+        shape (tuple): The (height, width) of the image in pixels.
+        kernel (np.ndarray, optional): The footprint of a marker, see marker_kernel. Defaults
+            to one pixel.
+
+    Returns:
+        np.ndarray: The (height, width, 4) image, with the first row at the top (y_max), can
+            be saved with plt.imsave or drawn with imshow.
+    """
+    height, width = shape
+    x_min, x_max, y_min, y_max = extent
+    colors = np.asarray(colors, dtype=np.float64)
+    if colors.shape[1] == 3:
+        colors = np.concatenate([colors, np.ones((len(colors), 1))], axis=1)
+    column = np.floor((np.asarray(x) - x_min) / (x_max - x_min) * width).astype(np.int64)
+    row = np.floor((y_max - np.asarray(y)) / (y_max - y_min) * height).astype(np.int64)
+    inside = (column >= 0) & (column < width) & (row >= 0) & (row < height)
+    pixel = row[inside] * width + column[inside]
+    alpha = np.clip(colors[inside, 3], 0, 1)
+
+    # all blended quantities are sums over points, so they can be binned first: the
+    # alpha-weighted colors, the alpha and the log transparency
+    weights = [alpha * colors[inside, 0], alpha * colors[inside, 1], alpha * colors[inside, 2],
+               alpha, np.log1p(-np.minimum(alpha, 1 - 1e-12))]
+    binned = np.stack([np.bincount(pixel, weights=w, minlength=height * width)
+                       for w in weights]).reshape(len(weights), height, width)
+    if kernel is not None and kernel.size > 1:
+        binned = fftconvolve(binned, kernel[None], mode="same", axes=(1, 2))
+
+    image = np.zeros((height, width, 4))
+    covered = binned[3] > 1e-9
+    image[covered, :3] = np.clip(binned[:3, covered] / binned[3, covered], 0, 1).T
+    image[..., 3] = np.where(covered, 1 - np.exp(np.minimum(binned[4], 0)), 0)
+    return image
+
+
+def raster_scatter(
+        x: np.ndarray,
+        y: np.ndarray,
+        s: float = None,
+        c: np.ndarray = None,
+        linewidths: float = None,
+        ax: matplotlib.axes.Axes = None,
+) -> matplotlib.image.AxesImage:
+    """
+    A drop-in for plt.scatter with round markers that draws the points as one image (see
+    rasterize_points) in the axes, so the axes, labels and title stay vector graphics. The
+    markers get the same size in pixels as plt.scatter draws them (the face plus the edge
+    line), and the axes limits get the same margins. The image has the resolution of the
+    axes at the figure dpi, so set the figure size, dpi and layout before calling this.
+
+    Args:
+        x (np.ndarray): The x coordinates of the points (N,).
+        y (np.ndarray): The y coordinates of the points (N,).
+        s (float, optional): The marker size in points ** 2. Defaults to rcParams["lines.markersize"] ** 2.
+        c (np.ndarray, optional): The (N, 4) RGBA or (N, 3) RGB colors. Defaults to the first
+            color of the color cycle.
+        linewidths (float, optional): The width of the marker edges in points. Defaults to
+            rcParams["lines.linewidth"].
+        ax (matplotlib.axes.Axes, optional): The axes to draw in. Defaults to the current axes.
+
+    Returns:
+        matplotlib.image.AxesImage: The image.
+    """
+    ax = plt.gca() if ax is None else ax
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    s = matplotlib.rcParams["lines.markersize"] ** 2 if s is None else s
+    linewidths = matplotlib.rcParams["lines.linewidth"] if linewidths is None else linewidths
+    if c is None:
+        c = matplotlib.colors.to_rgba(matplotlib.rcParams["axes.prop_cycle"].by_key()["color"][0])
+    c = np.asarray(c, dtype=np.float64)
+    if c.ndim == 1:
+        c = np.broadcast_to(c, (len(x), len(c)))
+
+    # the limits plt.scatter would autoscale to
+    margin_x, margin_y = ax.margins()
+    x_min, x_max = np.nanmin(x), np.nanmax(x)
+    y_min, y_max = np.nanmin(y), np.nanmax(y)
+    pad_x, pad_y = (x_max - x_min) * margin_x or 0.5, (y_max - y_min) * margin_y or 0.5
+    extent = (x_min - pad_x, x_max + pad_x, y_min - pad_y, y_max + pad_y)
+
+    dpi = ax.figure.dpi
+    bbox = ax.get_window_extent()
+    shape = (max(int(round(bbox.height)), 1), max(int(round(bbox.width)), 1))
+    kernel = marker_kernel(np.sqrt(s) * dpi / 72, linewidths * dpi / 72)
+    image = rasterize_points(x, y, c, extent, shape, kernel)
+    artist = ax.imshow(image, extent=extent, origin="upper", aspect="auto",
+                       interpolation="nearest")
+    ax.set_xlim(extent[:2])
+    ax.set_ylim(extent[2:])
+    return artist
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time plt.scatter and raster_scatter on random points, like the figures of stage 06.")
+    parser.add_argument("--num", type=int, nargs="+", default=[132651, 1000000],
+                        help="the numbers of points to time")
+    parser.add_argument("--out", default=None,
+                        help="save both figures of the first number of points with this prefix")
+    args = parser.parse_args()
+    matplotlib.use("Agg")
+    rng = np.random.default_rng(0)
+    for i, num in enumerate(args.num):
+        points = rng.normal(size=(num, 2)) * [1, 0.5]
+        colors = np.concatenate([rng.uniform(0, 0.9, (num, 3)), np.full((num, 1), 0.2)], axis=1)
+        for name, scatter in [("plt.scatter", plt.scatter), ("raster_scatter", raster_scatter)]:
+            start = time.perf_counter()
+            plt.figure(dpi=300)
+            scatter(points[:, 0], points[:, 1], s=1, c=colors)
+            plt.title(f"{num} points")
+            if args.out is not None and i == 0:
+                plt.savefig(f"{args.out}_{name}.png", format="png")
+            else:
+                plt.gcf().canvas.draw()
+            plt.close()
+            print(f"{name}: {num} points in {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,195 @@
+import fcntl
+import hashlib
+import json
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+from utils import fm_synth_gen_batch
+from equivalence import EquivalenceClasses
+from param_grid import grid_of
+
+
+def params_key(
+        freq: np.ndarray,
+        harm_ratio: np.ndarray,
+        mod_index: np.ndarray,
+        sr: int,
+) -> str:
+    """
+    Compute the content address of a parameter table. The key depends on the exact float64
+    values (and order) of the parameters and the sample rate, but not on the duration, since
+    shorter renders are prefixes of longer ones. The columns of an implicit grid (see
+    param_grid.py) are keyed by the spec of the grid instead, so the key takes the same time at
+    any resolution.
+
+    Args:
+        freq (np.ndarray): The carrier frequencies.
+        harm_ratio (np.ndarray): The harmonicity ratios.
+        mod_index (np.ndarray): The modulation indices.
+        sr (int): The sample rate.
+
+    Returns:
+        str: The hex digest identifying the table.
+    """
+    h = hashlib.sha1()
+    grid = grid_of(freq, harm_ratio, mod_index)
+    if grid is not None:
+        spec = grid.to_spec()
+        # (38, 86) and (38.0, 86.0) are the same grid
+        for name in ("pitch_range", "harm_ratio_range", "mod_index_range"):
+            spec[name] = [float(value) for value in spec[name]]
+        h.update(b"grid" + json.dumps(spec, sort_keys=True).encode())
+    else:
+        for column in (freq, harm_ratio, mod_index):
+            h.update(np.ascontiguousarray(column, dtype=np.float64).tobytes())
+    h.update(str(int(sr)).encode())
+    return h.hexdigest()
+
+
+class RenderCache:
+    """
+    Content-addressed store of rendered FM tones. Each parameter table is rendered once into a
+    float32 .npy file of shape (N, samples) under cache_dir/<params_key>/<samples>.npy, and read
+    back as a read-only memory map, so any stage or worker process shares its pages.
+    Since the phasors always start at 0, a shorter duration is served as a prefix view of a
+    longer cached render.
+    """
+
+    def __init__(self, cache_dir: str, block_rows: int = 1024):
+        """
+        Args:
+            cache_dir (str): The directory to hold the cache.
+            block_rows (int, optional): The number of rows rendered per batch when building. Defaults to 1024.
+        """
+        self.cache_dir = cache_dir
+        self.block_rows = block_rows
+
+    def find(self, key: str, samples: int) -> str:
+        """
+        Find the shortest cached render that is at least samples long.
+
+        Args:
+            key (str): The params_key of the table.
+            samples (int): The number of samples needed.
+
+        Returns:
+            str: The path of the .npy file, or None if there is no such render.
+        """
+        folder = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(folder):
+            return None
+        lengths = [int(name[:-4]) for name in os.listdir(folder)
+                   if name.endswith(".npy") and name[:-4].isdigit()]
+        lengths = [length for length in lengths if length >= samples]
+        if len(lengths) == 0:
+            return None
+        return os.path.join(folder, f"{min(lengths)}.npy")
+
+    def get(
+            self,
+            freq: np.ndarray,
+            harm_ratio: np.ndarray,
+            mod_index: np.ndarray,
+            sr: int,
+            dur: float,
+    ) -> np.ndarray:
+        """
+        Get the renders of a parameter table, rendering them first if they are not cached yet.
+
+        Args:
+            freq (np.ndarray): The carrier frequencies.
+            harm_ratio (np.ndarray): The harmonicity ratios.
+            mod_index (np.ndarray): The modulation indices.
+            sr (int): The sample rate.
+            dur (float): The duration in seconds.
+
+        Returns:
+            np.ndarray: A read-only float32 memory-mapped view of shape (N, int(dur * sr)).
+        """
+        samples = int(dur * sr)
+        key = params_key(freq, harm_ratio, mod_index, sr)
+        path = self.find(key, samples)
+        if path is None:
+            path = self.build(key, freq, harm_ratio, mod_index, sr, samples)
+        return open_render(path, samples)
+
+    def build(
+            self,
+            key: str,
+            freq: np.ndarray,
+            harm_ratio: np.ndarray,
+            mod_index: np.ndarray,
+            sr: int,
+            samples: int,
+    ) -> str:
+        """
+        Render a parameter table into the cache. Only one process renders a given table and
+        length at a time (guarded by an flock on a lock file, which the kernel releases if the
+        process dies), the others wait for its result. The file only appears under its final
+        name once it is complete. Rows that render the same
+        signal as an earlier row (see equivalence.py) are copied instead of rendered.
+
+        Args:
+            key (str): The params_key of the table.
+            freq (np.ndarray): The carrier frequencies.
+            harm_ratio (np.ndarray): The harmonicity ratios.
+            mod_index (np.ndarray): The modulation indices.
+            sr (int): The sample rate.
+            samples (int): The number of samples to render.
+
+        Returns:
+            str: The path of the rendered .npy file.
+        """
+        folder = os.path.join(self.cache_dir, key)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{samples}.npy")
+        lock_path = path + ".lock"
+        with open(lock_path, "a") as lock:
+            # blocks while another process renders the same table, then use its result
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            found = self.find(key, samples)
+            if found is not None:
+                return found
+            tmp_path = path[:-4] + ".tmp.npy"
+            num_rows = len(freq)
+            renders = open_memmap(tmp_path, mode="w+",
+                                  dtype=np.float32, shape=(num_rows, samples))
+            classes = EquivalenceClasses.from_params(freq, harm_ratio, mod_index)
+            for start in tqdm(range(0, num_rows, self.block_rows), desc="Rendering cache"):
+                stop = min(start + self.block_rows, num_rows)
+                rows = np.arange(start, stop)
+                own = classes.representative[start:stop] == rows
+                if own.all():
+                    fm_synth_gen_batch(samples, sr, freq[start:stop], harm_ratio[start:stop],
+                                       mod_index[start:stop], out=renders[start:stop])
+                    continue
+                # representatives always come first, so the rows to copy are rendered already
+                rendered = rows[own]
+                if len(rendered) > 0:
+                    block = np.empty((len(rendered), samples), dtype=np.float32)
+                    fm_synth_gen_batch(samples, sr, freq[rendered], harm_ratio[rendered],
+                                       mod_index[rendered], out=block)
+                    renders[rendered] = block
+                copies = rows[~own]
+                renders[copies] = renders[classes.representative[copies]]
+            renders.flush()
+            del renders
+            os.replace(tmp_path, path)
+        return path
+
+
+def open_render(path: str, samples: int) -> np.ndarray:
+    """
+    Open a cached render as a read-only memory map, cropped to the first samples of each row.
+    Consumers that modify their input in place get copies of the rows they read (see
+    FmSynthDataset), so long-lived workers do not accumulate private copies of cache pages.
+
+    Args:
+        path (str): The path of the .npy file.
+        samples (int): The number of samples to keep.
+
+    Returns:
+        np.ndarray: The (N, samples) float32 view.
+    """
+    return np.load(path, mmap_mode="r")[:, :samples]
@@ -0,0 +1,433 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+
+# the parameters written by stage 01 (see param_grid.py): one input, the grid spec or, after
+# adaptive sampling, the table, read from whichever exists (in this order, like open_dataset)
+PARAMS = ("../data/fm_synth_params.grid.json", "../data/fm_synth_params.csv")
+
+# the stages, with the stages they depend on, the files they read and write (relative to
+# python_scripts, like in the scripts), and their checkpoints, which are only valid for
+# the code and inputs they were written with. A tuple of paths is one input, which can be
+# any of those files
+STAGES = {
+    "01": {
+        "script": "01_build_fm_synth_params.py",
+        "deps": [],
+        "inputs": [],
+        # the parameters are in fm_synth_params.grid.json, or after adaptive sampling in
+        # fm_synth_params.csv, so neither is a required output, PARAMS is an input of the others
+        "outputs": ["../data/fm_params.json",
+                    "../data/colors.json", "../data/colors.npy"],
+        "checkpoints": [],
+    },
+    "02": {
+        "script": "02_build_perceptual_ds.py",
+        "deps": ["01"],
+        "inputs": [PARAMS],
+        "outputs": ["../data/fm_synth_perceptual_features.columns"],
+        "checkpoints": ["../data/fm_synth_perceptual_features.shards"],
+    },
+    "03": {
+        "script": "03_build_spectral_ds.py",
+        "deps": ["01"],
+        "inputs": [PARAMS],
+        "outputs": ["../data/fm_synth_spectral_features.columns"],
+        "checkpoints": ["../data/fm_synth_spectral_features.shards"],
+    },
+    "04": {
+        "script": "04_render_mel_spectrograms.py",
+        "deps": ["01"],
+        "inputs": [PARAMS],
+        "outputs": ["../data/fm_synth_mel_spectrograms_mean.npy"],
+        "checkpoints": [],
+    },
+    "05": {
+        "script": "05_render_embeddings.py",
+        "deps": ["01"],
+        "inputs": [PARAMS],
+        "outputs": ["../data/fm_synth_encodec_embeddings.npy",
+                    "../data/fm_synth_clap_embeddings.npy"],
+        "checkpoints": [],
+    },
+    "06": {
+        "script": "06_render_pca_plots.py",
+        "deps": ["01", "02", "03", "04", "05"],
+        "inputs": [PARAMS,
+                   "../data/fm_synth_perceptual_features.columns",
+                   "../data/fm_synth_spectral_features.columns",
+                   "../data/fm_synth_mel_spectrograms_mean.npy",
+                   "../data/fm_synth_encodec_embeddings.npy",
+                   "../data/fm_synth_clap_embeddings.npy"],
+        "outputs": ["../data/pca_params.json", "../data/pca_perceptual.json",
+                    "../data/pca_spectral.json", "../data/pca_encodec.json",
+                    "../data/pca_clap.json", "../data/pca_mels_mean.json",
+                    "../figures/pca_params.png", "../figures/pca_perceptual.png",
+                    "../figures/pca_spectral.png", "../figures/pca_encodec.png",
+                    "../figures/pca_clap.png", "../figures/pca_mels_mean.png"],
+        "checkpoints": [],
+    },
+}
+
+STATE_PATH = "../data/pipeline_state.json"
+LOG_DIR = "../data/logs"
+
+
+def local_modules(script: str) -> list:
+    """
+    Find a script and the modules of this folder it imports, directly or through other
+    local modules.
+
+    Args:
+        script (str): The path of the script.
+
+    Returns:
+        list: The sorted paths of the script and its local modules.
+    """
+    folder = os.path.dirname(os.path.abspath(script))
+    found = set()
+    todo = [os.path.abspath(script)]
+    while todo:
+        path = todo.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(path, "r") as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module_path = os.path.join(folder, name.split(".")[0] + ".py")
+                if os.path.exists(module_path):
+                    todo.append(module_path)
+    return sorted(found)
+
+
+def code_digest(script: str) -> str:
+    """
+    Fingerprint the code of a stage: the syntax trees of its script and local modules, so
+    changing a comment or the formatting does not invalidate the stage, while changing any
+    setting (e.g. sr, dur, n_mels or the grid steps) or any code does.
+
+    Args:
+        script (str): The path of the script.
+
+    Returns:
+        str: The hex digest.
+    """
+    h = hashlib.sha256()
+    for path in local_modules(script):
+        with open(path, "r") as f:
+            h.update(os.path.basename(path).encode())
+            h.update(ast.dump(ast.parse(f.read())).encode())
+    return h.hexdigest()
+
+
+def stage_parameters(script: str) -> dict:
+    """
+    Read the settings of a stage, i.e. the top-level assignments of constants in its script.
+
+    Args:
+        script (str): The path of the script.
+
+    Returns:
+        dict: The setting names mapped to their values.
+    """
+    with open(script, "r") as f:
+        tree = ast.parse(f.read())
+    parameters = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                isinstance(node.targets[0], ast.Name):
+            try:
+                parameters[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return parameters
+
+
+class FileDigests:
+    """
+    Content hashes of files and directories, cached by size and modification time, so a
+    file is only read again when it changed.
+    """
+
+    def __init__(self, cache: dict = None):
+        """
+        Args:
+            cache (dict, optional): A cache from a previous run (see the cache attribute).
+                Defaults to None.
+        """
+        self.cache = {} if cache is None else cache
+
+    def file_digest(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.cache.get(key)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                h.update(block)
+        self.cache[key] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def digest(self, path: str) -> str:
+        """
+        Hash a file, or all files of a directory with their relative paths.
+
+        Args:
+            path (str): The path.
+
+        Returns:
+            str: The hex digest, or None if the path does not exist.
+        """
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, path).encode())
+                h.update(self.file_digest(file_path).encode())
+        return h.hexdigest()
+
+
+class Pipeline:
+    """
+    Runs the stages whose code or inputs changed since their last successful run, and
+    stages that depend on each other in order. Stages whose dependencies are done run side
+    by side, sharing a budget of CPUs (passed to them as SYNTHMAPS_CPUS, see
+    dispatch.available_cpus, and as the thread counts of OpenMP, MKL and numba).
+    """
+
+    def __init__(self, stages: dict = STAGES, state_path: str = STATE_PATH):
+        """
+        Args:
+            stages (dict, optional): The stage definitions. Defaults to STAGES.
+            state_path (str, optional): The file recording the fingerprints of the last
+                successful runs. Defaults to STATE_PATH.
+        """
+        self.stages = stages
+        self.state_path = state_path
+        self.state = {"stages": {}, "started": {}, "files": {}}
+        if os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                self.state.update(json.load(f))
+        self.digests = FileDigests(self.state["files"])
+
+    def save_state(self) -> None:
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    def fingerprint(self, name: str) -> str:
+        """
+        Fingerprint a stage by its code and the content of its inputs.
+
+        Args:
+            name (str): The stage.
+
+        Returns:
+            str: The hex digest, or None if an input is missing.
+        """
+        stage = self.stages[name]
+        h = hashlib.sha256(code_digest(stage["script"]).encode())
+        for path in stage["inputs"]:
+            if isinstance(path, tuple):
+                # one input that can be any of these files, the first that exists
+                path = next((option for option in path if os.path.exists(option)), path[0])
+            digest = self.digests.digest(path)
+            if digest is None:
+                return None
+            h.update(path.encode())
+            h.update(digest.encode())
+        return h.hexdigest()
+
+    def is_current(self, name: str, fingerprint: str) -> bool:
+        """
+        Check if a stage's last successful run had this fingerprint and its outputs are there.
+        A stage with a missing input (no fingerprint) is never current.
+        """
+        outputs = self.stages[name]["outputs"]
+        return fingerprint is not None and self.state["stages"].get(name) == fingerprint and \
+            all(os.path.exists(path) for path in outputs)
+
+    def selection(self, targets: list) -> list:
+        """
+        Get the targets and all stages they depend on, in order.
+
+        Args:
+            targets (list): The stage names, or None for all stages.
+
+        Returns:
+            list: The selected stage names.
+        """
+        if targets is None:
+            return list(self.stages)
+        selected = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in selected:
+                selected.add(name)
+                todo.extend(self.stages[name]["deps"])
+        return [name for name in self.stages if name in selected]
+
+    def status(self, targets: list = None) -> dict:
+        """
+        Get what a run would do, without running anything. Stages after a stage that has to
+        run are "pending", since whether their inputs change is only known after it ran.
+
+        Args:
+            targets (list, optional): The stages to check. Defaults to None, which means all.
+
+        Returns:
+            dict: The stage names mapped to "current", "stale" or "pending".
+        """
+        status = {}
+        for name in self.selection(targets):
+            if any(status.get(dep) in ("stale", "pending") for dep in self.stages[name]["deps"]):
+                status[name] = "pending"
+            elif self.is_current(name, self.fingerprint(name)):
+                status[name] = "current"
+            else:
+                status[name] = "stale"
+        return status
+
+    def _start(self, name, fingerprint, cpus):
+        stage = self.stages[name]
+        # checkpoints of a run with other code or inputs (or with a missing input, whose
+        # content is unknown) are not valid for this one
+        if fingerprint is None or self.state["started"].get(name) != fingerprint:
+            for path in stage["checkpoints"]:
+                shutil.rmtree(path, ignore_errors=True)
+        self.state["started"][name] = fingerprint
+        self.save_state()
+        os.makedirs(LOG_DIR, exist_ok=True)
+        log = open(os.path.join(LOG_DIR, f"{name}.log"), "w")
+        env = dict(os.environ, SYNTHMAPS_CPUS=str(cpus), OMP_NUM_THREADS=str(cpus),
+                   MKL_NUM_THREADS=str(cpus), NUMBA_NUM_THREADS=str(cpus))
+        process = subprocess.Popen([sys.executable, stage["script"]], stdout=log,
+                                   stderr=subprocess.STDOUT, env=env)
+        print(f"[{name}] started with {cpus} CPUs, log in {log.name}")
+        return process, log
+
+    def run(self, targets: list = None, cpus: int = None, force: list = ()) -> dict:
+        """
+        Run the selected stages that are not current.
+
+        Args:
+            targets (list, optional): The stages to bring up to date (with the stages they
+                depend on). Defaults to None, which means all.
+            cpus (int, optional): The CPU budget. Defaults to None, which means os.cpu_count().
+            force (list, optional): Stages to run even if they are current. Defaults to ().
+
+        Returns:
+            dict: The stage names mapped to "current", "done", "failed" or "blocked".
+        """
+        budget = os.cpu_count() if cpus is None else cpus
+        free = budget
+        pending = self.selection(targets)
+        result = {}
+        running = {}
+        while pending or running:
+            # decide on the stages whose dependencies are finished, until nothing changes
+            # (a current stage can make the stages after it ready)
+            changed = True
+            while changed:
+                changed = False
+                ready = []
+                for name in list(pending):
+                    deps = [dep for dep in self.stages[name]["deps"]
+                            if dep in result or dep in pending or dep in running]
+                    if any(result.get(dep) in ("failed", "blocked") for dep in deps):
+                        result[name] = "blocked"
+                        pending.remove(name)
+                        changed = True
+                    elif all(result.get(dep) in ("current", "done") for dep in deps):
+                        fingerprint = self.fingerprint(name)
+                        if name not in force and self.is_current(name, fingerprint):
+                            result[name] = "current"
+                            print(f"[{name}] current")
+                            pending.remove(name)
+                            changed = True
+                        else:
+                            ready.append((name, fingerprint))
+            # share the free CPUs among the ready stages
+            for count, (name, fingerprint) in enumerate(ready):
+                if free == 0:
+                    break
+                share = max(1, free // (len(ready) - count))
+                running[name] = (*self._start(name, fingerprint, share), fingerprint, share)
+                pending.remove(name)
+                free -= share
+            if not running:
+                break
+            # wait for a stage to finish
+            finished = []
+            while not finished:
+                time.sleep(0.5)
+                finished = [name for name, (process, *_) in running.items()
+                            if process.poll() is not None]
+            for name in finished:
+                process, log, fingerprint, share = running.pop(name)
+                log.close()
+                free += share
+                if process.returncode == 0:
+                    self.state["stages"][name] = fingerprint
+                    result[name] = "done"
+                    print(f"[{name}] done")
+                else:
+                    self.state["stages"].pop(name, None)
+                    result[name] = "failed"
+                    print(f"[{name}] failed with exit code {process.returncode}, see {log.name}")
+                self.save_state()
+        self.save_state()
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the stages of the pipeline whose code or inputs changed since their last run.")
+    parser.add_argument("stages", nargs="*",
+                        help="the stages to bring up to date, with what they depend on (default: all)")
+    parser.add_argument("--cpus", type=int, default=None,
+                        help="the number of CPUs the stages share (default: all)")
+    parser.add_argument("--force", nargs="*", default=[], choices=list(STAGES),
+                        help="stages to run even if they are up to date")
+    parser.add_argument("--status", action="store_true",
+                        help="only show which stages would run")
+    args = parser.parse_args()
+    for name in args.stages:
+        if name not in STAGES:
+            parser.error(f"unknown stage {name}, choose from {', '.join(STAGES)}")
+    targets = args.stages if args.stages else None
+    pipeline = Pipeline()
+    if args.status:
+        for name, status in pipeline.status(targets).items():
+            parameters = stage_parameters(STAGES[name]["script"])
+            print(f"{name} {status:8s} {STAGES[name]['script']} {parameters}")
+        pipeline.save_state()
+    else:
+        result = pipeline.run(targets, args.cpus, args.force)
+        if any(status in ("failed", "blocked") for status in result.values()):
+            sys.exit(1)
@@ -0,0 +1,428 @@
+import argparse
+import json
+import os
+import re
+import sys
+import numpy as np
+from numpy.lib.format import open_memmap
+from param_grid import MOD_INDEX_RANGE, load_parameter_table
+from checkpoint import ResultShards
+from columnar import ColumnStore
+from render_cache import params_key
+from utils import FmSynthDataset
+
+# the directory of shard i of n inside the shards directory of a stage
+SHARD_NAME = "shard_{:03d}_of_{:03d}"
+_SHARD_NAME_PATTERN = re.compile(r"^shard_(\d+)_of_(\d+)$")
+
+
+def parse_shard(spec: str) -> tuple:
+    """
+    Parse a shard specification of the form "i/n", with i counted from 0.
+
+    Args:
+        spec (str): The specification, e.g. "2/8".
+
+    Returns:
+        tuple: The shard number i and the number of shards n.
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", spec)
+    if match is None:
+        raise ValueError(f"invalid shard {spec!r}, expected i/n")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        raise ValueError(f"invalid shard {spec!r}, i must be in 0..n-1")
+    return index, count
+
+
+def current_shard(argv: list = None) -> tuple:
+    """
+    Get the shard a stage should process: the --shard i/n command line argument, or the
+    SYNTHMAPS_SHARD environment variable if it is not given. Other arguments are ignored, so
+    this also works in the interactive cells of a stage.
+
+    Args:
+        argv (list, optional): The arguments to parse. Defaults to None, which means sys.argv.
+
+    Returns:
+        tuple: The shard number and the number of shards, or None to process all items.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--shard", default=os.environ.get("SYNTHMAPS_SHARD"))
+    args, _ = parser.parse_known_args(argv)
+    if args.shard is None:
+        return None
+    return parse_shard(args.shard)
+
+
+def item_costs(
+        freq: np.ndarray,
+        harm_ratio: np.ndarray,
+        mod_index: np.ndarray,
+        sr: int = 48000,
+) -> np.ndarray:
+    """
+    Estimate the relative cost of analysing each item with stage 02. It grows with the number
+    of spectral peaks, here the sideband pairs below Nyquist by Carson's rule (mod_index + 2
+    pairs, spaced by the modulator frequency), from 1 for a sine to 2 for the densest spectra.
+    Only exact arithmetic is used, so every node gets the same costs.
+
+    Args:
+        freq (np.ndarray): The carrier frequencies.
+        harm_ratio (np.ndarray): The harmonicity ratios.
+        mod_index (np.ndarray): The modulation indices.
+        sr (int, optional): The sample rate. Defaults to 48000.
+
+    Returns:
+        np.ndarray: The costs.
+    """
+    modulator = np.asarray(freq, dtype=np.float64) * harm_ratio
+    pairs = np.asarray(mod_index, dtype=np.float64) + 2
+    # a modulator at 0 Hz leaves a single line
+    in_band = np.divide(sr / 2, modulator, out=np.zeros_like(modulator), where=modulator > 0)
+    return 1 + np.minimum(pairs, in_band) / (MOD_INDEX_RANGE[1] + 2)
+
+
+def assign_shards(
+        costs: np.ndarray,
+        count: int,
+) -> np.ndarray:
+    """
+    Split items into shards of about equal total cost: the items are dealt out to the shards
+    from the most to the least expensive, in snake order (0..n-1, then n-1..0, ...). Ties keep
+    the item order, so the assignment only depends on the costs.
+
+    Args:
+        costs (np.ndarray): The cost of each item (e.g. item_costs, or all ones).
+        count (int): The number of shards.
+
+    Returns:
+        np.ndarray: The shard number of each item.
+    """
+    order = np.argsort(-np.asarray(costs), kind="stable")
+    rounds, position = np.divmod(np.arange(len(order)), count)
+    shards = np.empty(len(order), dtype=np.int64)
+    shards[order] = np.where(rounds % 2 == 0, position, count - 1 - position)
+    return shards
+
+
+def dataset_key(dataset: FmSynthDataset) -> str:
+    """
+    Identify the parameter table and render settings of a dataset, so shards of different runs
+    are never merged.
+
+    Args:
+        dataset (FmSynthDataset): The dataset.
+
+    Returns:
+        str: The key.
+    """
+    return f"{params_key(dataset.freq, dataset.harm_ratio, dataset.mod_index, dataset.sr)}-{dataset.samples}"
+
+
+class ShardRun:
+    """
+    The part of a stage one node runs with --shard i/n: its rows of the parameter table, in
+    the directory shards_dir/shard_<i>_of_<n>, along with a manifest. Merging them is the job
+    of ShardSet.
+    """
+
+    def __init__(
+            self,
+            shards_dir: str,
+            dataset: FmSynthDataset,
+            shard: tuple,
+            kind: str,
+            costs: np.ndarray = None,
+    ):
+        """
+        Args:
+            shards_dir (str): The shards directory of the stage.
+            dataset (FmSynthDataset): The dataset of the full table (without a render cache,
+                see dataset).
+            shard (tuple): The shard number and the number of shards (see current_shard).
+            kind (str): "table" for results checkpointed as ResultShards, with global "index"
+                values, or "array" for one row of values.npy per row of the shard.
+            costs (np.ndarray, optional): The item costs to balance. Defaults to None, which
+                means the same for all items.
+        """
+        self.index, self.count = shard
+        if costs is None:
+            costs = np.ones(len(dataset))
+        self.rows = np.flatnonzero(assign_shards(costs, self.count) == self.index)
+        self.full_dataset = dataset
+        self.directory = os.path.join(shards_dir, SHARD_NAME.format(self.index, self.count))
+        self.manifest = {
+            "kind": kind,
+            "shard": self.index,
+            "count": self.count,
+            "num_items": len(dataset),
+            "dataset": dataset_key(dataset),
+            "complete": False,
+        }
+        manifest_path = os.path.join(self.directory, "manifest.json")
+        if os.path.exists(manifest_path):
+            # resuming: the shard must be the one started before
+            with open(manifest_path) as f:
+                previous = json.load(f)
+            previous_rows = np.load(os.path.join(self.directory, "rows.npy"))
+            if ({k: v for k, v in previous.items() if k != "complete"} !=
+                    {k: v for k, v in self.manifest.items() if k != "complete"} or
+                    not np.array_equal(previous_rows, self.rows)):
+                raise ValueError(
+                    f"{self.directory} holds a different shard, remove it to start over")
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            np.save(os.path.join(self.directory, "rows.npy"), self.rows)
+            self._write_manifest()
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, "manifest.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def dataset(self, cache_dir: str = None) -> FmSynthDataset:
+        """
+        Get the dataset of the rows of this shard, in row order. Its render cache (if any) only
+        holds these rows, so no node renders the full table.
+
+        Args:
+            cache_dir (str, optional): The RenderCache directory. Defaults to None.
+
+        Returns:
+            FmSynthDataset: The dataset, whose item k is row rows[k] of the full table.
+        """
+        ds = self.full_dataset
+        return FmSynthDataset.from_arrays(
+            ds.freq[self.rows], ds.harm_ratio[self.rows], ds.mod_index[self.rows],
+            sr=ds.sr, dur=ds.dur, cache_dir=cache_dir)
+
+    def remaining(self, shards: ResultShards) -> np.ndarray:
+        """
+        Get the items of the shard dataset whose results are not checkpointed yet.
+
+        Args:
+            shards (ResultShards): The checkpoint of this shard (in its directory).
+
+        Returns:
+            np.ndarray: The positions in the shard dataset still to process.
+        """
+        return np.flatnonzero(~np.isin(self.rows, shards.completed()))
+
+    def to_table_rows(self, results: list) -> list:
+        """
+        Replace the "index" of results computed on the shard dataset by the row of the full
+        table.
+
+        Args:
+            results (list): The result dicts.
+
+        Returns:
+            list: The same results.
+        """
+        for result in results:
+            result["index"] = int(self.rows[result["index"]])
+        return results
+
+    def finish(self) -> None:
+        """
+        Mark the shard as complete.
+        """
+        self.manifest["complete"] = True
+        self._write_manifest()
+
+
+class ShardSet:
+    """
+    The shards all nodes wrote for a stage, as found in its shards directory (copy the
+    shard_<i>_of_<n> directories of all nodes into one). check reports what is missing or
+    duplicated, merge assembles the final output in row order. A shard found in more than one
+    directory (e.g. shard_2_of_4 next to shard_002_of_004) is only used once, and only if all
+    its directories hold the same manifest and results.
+    """
+
+    def __init__(self, shards_dir: str):
+        """
+        Args:
+            shards_dir (str): The shards directory of the stage.
+        """
+        self.directory = shards_dir
+        # all directories of each shard, and the first of them, which is the one used
+        self.runs = {}
+        for name in sorted(os.listdir(shards_dir)):
+            if _SHARD_NAME_PATTERN.match(name) is None:
+                continue
+            path = os.path.join(shards_dir, name)
+            with open(os.path.join(path, "manifest.json")) as f:
+                manifest = json.load(f)
+            self.runs.setdefault(manifest["shard"], []).append((path, manifest))
+        if len(self.runs) == 0:
+            raise ValueError(f"no shards in {shards_dir}")
+        self.shards = {i: runs[0] for i, runs in self.runs.items()}
+        manifests = [manifest for runs in self.runs.values() for _, manifest in runs]
+        for key in ("kind", "count", "num_items", "dataset"):
+            values = {manifest[key] for manifest in manifests}
+            if len(values) > 1:
+                raise ValueError(f"the shards in {shards_dir} are from different runs ({key}: {sorted(values)})")
+        self.kind = manifests[0]["kind"]
+        self.count = manifests[0]["count"]
+        self.num_items = manifests[0]["num_items"]
+
+    def iter_shards(self):
+        """
+        Iterate over the checkpointed results of all shards, like ResultShards.iter_shards
+        (so ColumnStore.from_shards can assemble them).
+
+        Yields:
+            dict: The column arrays of the next checkpoint shard.
+        """
+        for path, _ in self.shards.values():
+            yield from ResultShards(path).iter_shards()
+
+    def _results(self, path):
+        # the rows of a shard directory and its results, in row order
+        if self.kind == "table":
+            return ResultShards(path).to_frame()
+        return (np.load(os.path.join(path, "rows.npy")),
+                np.load(os.path.join(path, "values.npy"), mmap_mode="r"))
+
+    def _same_run(self, run, other):
+        (path, manifest), (other_path, other_manifest) = run, other
+        if manifest != other_manifest:
+            return False
+        results, other_results = self._results(path), self._results(other_path)
+        if self.kind == "table":
+            return results.equals(other_results)
+        return all(np.array_equal(a, b) for a, b in zip(results, other_results))
+
+    def _done_rows(self):
+        # the rows with results, once per result
+        rows = []
+        for path, manifest in self.shards.values():
+            if self.kind == "table":
+                rows.extend(np.asarray(columns["index"]) for columns in ResultShards(path).iter_shards())
+            elif manifest["complete"]:
+                rows.append(np.load(os.path.join(path, "rows.npy")))
+        return np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    def check(self) -> dict:
+        """
+        Check that the shards cover every row exactly once.
+
+        Returns:
+            dict: The shard numbers that are missing, not marked complete and found in several
+                directories that differ (conflicting), the rows without a result (gaps) and
+                the rows with more than one (duplicates), and ok if all but the incomplete
+                shards are empty.
+        """
+        counts = np.bincount(self._done_rows(), minlength=self.num_items)
+        report = {
+            "missing_shards": sorted(set(range(self.count)) - set(self.shards)),
+            "conflicting_shards": [i for i, runs in sorted(self.runs.items()) if not all(
+                self._same_run(runs[0], run) for run in runs[1:])],
+            "incomplete_shards": [i for i, (_, manifest) in self.shards.items()
+                                  if not manifest["complete"]],
+            "gaps": np.flatnonzero(counts == 0),
+            "duplicates": np.flatnonzero(counts > 1),
+        }
+        report["ok"] = (not report["missing_shards"] and not report["conflicting_shards"]
+                        and len(report["gaps"]) == 0 and len(report["duplicates"]) == 0)
+        return report
+
+    def merge(self, path: str, block_rows: int = 4096):
+        """
+        Assemble the shards into the output of a single-node run: a ColumnStore for tables, a
+        .npy file for arrays.
+
+        Args:
+            path (str): The output path, e.g. "../data/fm_synth_spectral_features.columns".
+            block_rows (int, optional): The number of array rows copied at a time. Defaults to 4096.
+
+        Returns:
+            ColumnStore or np.ndarray: The store, or the memory-mapped array.
+        """
+        report = self.check()
+        if not report["ok"]:
+            raise ValueError(f"cannot merge {self.directory}: {describe(report)}")
+        if self.kind == "table":
+            return ColumnStore.from_shards(self, path, self.num_items)
+        out = None
+        tmp_path = path[:-4] + ".tmp.npy"
+        for shard_path, _ in self.shards.values():
+            rows = np.load(os.path.join(shard_path, "rows.npy"))
+            values = np.load(os.path.join(shard_path, "values.npy"), mmap_mode="r")
+            if out is None:
+                out = open_memmap(tmp_path, mode="w+", dtype=values.dtype,
+                                  shape=(self.num_items, *values.shape[1:]))
+            for start in range(0, len(rows), block_rows):
+                out[rows[start:start + block_rows]] = values[start:start + block_rows]
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r")
+
+
+def describe(report: dict, limit: int = 10) -> str:
+    """
+    Summarize a ShardSet.check report.
+
+    Args:
+        report (dict): The report.
+        limit (int, optional): The number of rows to list per problem. Defaults to 10.
+
+    Returns:
+        str: The summary.
+    """
+    if report["ok"]:
+        return "complete"
+    problems = []
+    if report["missing_shards"]:
+        problems.append(f"missing shards {report['missing_shards']}")
+    if report["conflicting_shards"]:
+        problems.append(f"shards in several differing directories {report['conflicting_shards']}")
+    for name in ("gaps", "duplicates"):
+        rows = report[name]
+        if len(rows) > 0:
+            listed = ", ".join(str(row) for row in rows[:limit])
+            problems.append(f"{len(rows)} {name} (rows {listed}{', ...' if len(rows) > limit else ''})")
+    if report["incomplete_shards"]:
+        problems.append(f"unfinished shards {report['incomplete_shards']}")
+    return "; ".join(problems)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Plan, check and merge the shards of a stage run on several nodes with --shard i/n.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan = commands.add_parser("plan", help="show the estimated cost of each shard")
+    plan.add_argument("count", type=int, help="the number of shards")
+    plan.add_argument("--grid", default="../data/fm_synth_params.grid.json",
+                      help="the parameter grid spec, read instead of --csv if it exists")
+    plan.add_argument("--csv", default="../data/fm_synth_params.csv", help="the parameter table")
+    plan.add_argument("--sr", type=int, default=48000, help="the sample rate")
+    check = commands.add_parser("check", help="report missing shards, gaps and duplicates")
+    check.add_argument("shards_dir", help="the shards directory of the stage")
+    merge = commands.add_parser("merge", help="check the shards and assemble the output")
+    merge.add_argument("shards_dir", help="the shards directory of the stage")
+    merge.add_argument("out", help="the output .columns directory (tables) or .npy file (arrays)")
+    merge.add_argument("--csv", default=None, help="also export a merged table as CSV")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        df = load_parameter_table(args.grid, args.csv, columns=["freq", "harm_ratio", "mod_index"])
+        costs = item_costs(df.freq.values, df.harm_ratio.values, df.mod_index.values, args.sr)
+        loads = np.bincount(assign_shards(costs, args.count), weights=costs, minlength=args.count)
+        items = np.bincount(assign_shards(costs, args.count), minlength=args.count)
+        for i in range(args.count):
+            print(f"shard {i}/{args.count}: {items[i]} items, relative cost {loads[i] / loads.mean():.4f}")
+    elif args.command == "check":
+        report = ShardSet(args.shards_dir).check()
+        print(describe(report))
+        sys.exit(0 if report["ok"] else 1)
+    else:
+        merged = ShardSet(args.shards_dir).merge(args.out)
+        print(f"Merged {args.shards_dir} into {args.out}")
+        if args.csv is not None:
+            merged.export_csv(args.csv)
+            print(f"Saved {args.csv}")
@@ -0,0 +1,364 @@
+import argparse
+import sys
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import scipy.fft
+from scipy.signal import find_peaks
+
+
+# the descriptors of pytimbre's Spectrum, in the order stage 03 reports them
+SPECTRAL_FEATURES = [
+    "spectral_centroid",
+    "spectral_crest",
+    "spectral_decrease",
+    "spectral_energy",
+    "spectral_flatness",
+    "spectral_kurtosis",
+    "spectral_roll_off",
+    "spectral_skewness",
+    "spectral_slope",
+    "spectral_spread",
+    "inharmonicity",
+]
+
+# primes used by the SWIPE pitch strength kernel (same table as pytimbre)
+SMALL_PRIMES = np.array(
+    [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89,
+     97, 101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151, 157, 163, 167, 173, 179, 181,
+     191, 193, 197, 199, 211, 223, 227, 229, 233, 239, 241, 251, 257, 263, 269, 271, 277, 281,
+     283, 293, 307, 311, 313, 317, 331, 337, 347, 349, 353, 359, 367, 373, 379, 383, 389, 397,
+     401, 409, 419, 421, 431, 433, 439, 443, 449, 457, 461, 463, 467, 479, 487, 491, 499, 503,
+     509, 521, 523, 541, 547, 557, 563, 569, 571, 577, 587, 593, 599, 601, 607, 613, 617, 619,
+     631, 641, 643, 647, 653, 659, 661, 673, 677, 683, 691, 701, 709, 719, 727, 733, 739, 743,
+     751, 757, 761, 769, 773, 787, 797, 809, 811, 821, 823, 827, 829, 839, 853, 857, 859, 863,
+     877, 881, 883, 887, 907, 911, 919, 929, 937, 941, 947, 953, 967, 971, 977, 983, 991, 997])
+
+
+def spectrum_frequencies(
+        sr: int,
+        fft_size: int,
+) -> np.ndarray:
+    """
+    Get the single-sided frequency bins of pytimbre's SpectrumByFFT.
+
+    Args:
+        sr (int): The sample rate.
+        fft_size (int): The FFT size.
+
+    Returns:
+        np.ndarray: The fft_size // 2 bin frequencies in Hz.
+    """
+    return (sr * np.arange(0, fft_size) / fft_size)[:int(fft_size / 2)]
+
+
+def welch_pressures(
+        y: np.ndarray,
+        fft_size: int = 4096,
+) -> np.ndarray:
+    """
+    Compute the pressure spectra of pytimbre's SpectrumByFFT for a batch of signals with one
+    rFFT: the mean is removed (twice, like Waveform and SpectrumByFFT both do), then the
+    power of Hann-windowed blocks with 50% overlap is averaged.
+
+    Args:
+        y (np.ndarray): The signals (N, samples).
+        fft_size (int, optional): The FFT size. Defaults to 4096.
+
+    Returns:
+        np.ndarray: The (N, fft_size // 2) single-sided pressure spectra.
+    """
+    y = np.atleast_2d(y)
+    x = y - np.mean(y, axis=1, keepdims=True)
+    x = x - np.mean(x, axis=1, keepdims=True)
+    window = np.hanning(fft_size)
+    num_blocks = int(np.floor(2 * x.shape[1] / fft_size - 1))
+    blocks = np.lib.stride_tricks.sliding_window_view(x, fft_size, axis=1)[
+        :, :num_blocks * (fft_size // 2):fft_size // 2]
+    spectra = scipy.fft.rfft(blocks * window, n=fft_size, axis=-1)[..., :fft_size // 2]
+    # same scaling as pytimbre, where the frequency increment is sr / fft_size
+    scale = 2 / fft_size / fft_size / np.mean(window ** 2)
+    power = np.mean(spectra.real ** 2 + spectra.imag ** 2, axis=1)
+    return np.sqrt(scale * power)
+
+
+@lru_cache(maxsize=4)
+def swipe_kernel(
+        sr: int,
+        fft_size: int,
+) -> np.ndarray:
+    """
+    Build the SWIPE pitch strength kernel that pytimbre evaluates for every pitch candidate of
+    every spectrum. The kernel only depends on the frequency bins, so it is computed once and
+    the pitch strengths of a whole batch become one matrix product.
+
+    Args:
+        sr (int): The sample rate.
+        fft_size (int): The FFT size.
+
+    Returns:
+        np.ndarray: The (F, F) kernel, row j is the kernel of the pitch candidate at bin j.
+    """
+    frequencies = spectrum_frequencies(sr, fft_size)
+    kernel = np.zeros((len(frequencies), len(frequencies)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        envelope = np.sqrt(1.0 / frequencies)
+        # the candidate at 0 Hz has an all-zero kernel
+        for j in range(1, len(frequencies)):
+            pitch_candidate = frequencies[j]
+            number_of_harmonics = int(
+                np.floor(frequencies[-1] / pitch_candidate - 0.75))
+            k = np.zeros(frequencies.shape)
+            q = frequencies / pitch_candidate
+            harmonics = np.concatenate(
+                ([1], SMALL_PRIMES[SMALL_PRIMES <= number_of_harmonics]))
+            for i in harmonics:
+                a = np.abs(q - i)
+                p = a < 0.25
+                k[p] = np.cos(2 * np.pi * q[p])
+                v = np.logical_and(0.25 < a, a < 0.75)
+                k[v] = k[v] + np.cos(2 * np.pi * q[v]) / 2
+            # apply envelope and K+-normalize
+            k = k * envelope
+            k = k / np.linalg.norm(k[k > 0])
+            kernel[j] = np.nan_to_num(k, nan=0)
+    return kernel
+
+
+def _swipe_parabolic_interpolation(pitch_strength, pc):
+    # same as pytimbre's FundamentalFrequencyCalculator.swipe_parabolic_interpolation
+    # with a strength threshold of 0
+    i = np.argmax(pitch_strength)
+    if not pitch_strength[i] >= 0:
+        return np.nan
+    if i == 0:
+        return pc[0]
+    if i == len(pc) - 1:
+        return pc[-1]
+    I = np.arange(i - 1, i + 2)
+    tc = 1 / pc[I]
+    ntc = (tc / tc[1] - 1) * 2 * np.pi
+    if np.any(np.isnan(pitch_strength[I])) or np.any(np.isinf(ntc)):
+        return np.nan
+    c = np.polyfit(ntc, pitch_strength[I], 2)
+    ftc = 1 / 2 ** np.arange(np.log2(pc[I[0]]), np.log2(pc[I[2]]), 1 / 12 / 64)
+    nftc = (ftc / tc[1] - 1) * 2 * np.pi
+    k = np.argmax(np.polyval(c, nftc))
+    return 2 ** (np.log2(pc[I[0]]) + k / 12 / 64)
+
+
+def _fundamental_by_peaks(frequencies, pressures):
+    # same as pytimbre's FundamentalFrequencyCalculator.fundamental_by_peaks
+    peak_indices = find_peaks(pressures, threshold=np.median(pressures), distance=2)[0]
+    if len(peak_indices) == 0:
+        return np.nan
+    if len(peak_indices) < 5:
+        return frequencies[peak_indices[np.argmax(pressures[peak_indices])]]
+    top = np.argpartition(pressures[peak_indices], -5)[-5:]
+    candidates = frequencies[peak_indices[top]]
+    similarity = np.zeros(5)
+    for f_index, f in enumerate(candidates):
+        ratio = candidates / f
+        ratio = np.where(ratio < 1.0, 1 / ratio, ratio)
+        similarity[f_index] = np.mean(np.abs(np.round(ratio, 0) - ratio))
+    return candidates[np.argmin(similarity)]
+
+
+def fundamental_frequency(
+        frequencies: np.ndarray,
+        pressures: np.ndarray,
+        kernel: np.ndarray,
+) -> np.ndarray:
+    """
+    Estimate the fundamental frequency of a batch of spectra like pytimbre does: SWIPE pitch
+    strength with parabolic interpolation, falling back to the peak-picking estimate if that
+    fails.
+
+    Args:
+        frequencies (np.ndarray): The bin frequencies (F,).
+        pressures (np.ndarray): The pressure spectra (N, F).
+        kernel (np.ndarray): The SWIPE kernel from swipe_kernel (F, F).
+
+    Returns:
+        np.ndarray: The fundamental frequencies (N,), NaN where no estimate was found.
+    """
+    loudness = pressures ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        loudness = loudness / np.sqrt(np.sum(loudness * loudness, axis=1, keepdims=True))
+    strengths = loudness @ kernel.T
+    f0 = np.zeros(len(pressures))
+    for row in range(len(pressures)):
+        f0[row] = _swipe_parabolic_interpolation(strengths[row], frequencies)
+        if np.isnan(f0[row]):
+            f0[row] = _fundamental_by_peaks(frequencies, pressures[row])
+    return f0
+
+
+def _inharmonicity(frequencies, pressures, f0):
+    # same as pytimbre's Spectrum.inharmonicity for one spectrum
+    if np.isnan(f0):
+        return np.nan
+    f_ratio = frequencies / f0
+    max_power = int(np.floor(np.log(np.floor(f_ratio[-1])) / np.log(2)))
+    partial_indices = np.array([np.argmax(f_ratio >= i)
+                                for i in 2 ** np.arange(max_power + 1)])
+    departure = 0
+    for i in range(1, len(partial_indices)):
+        departure += (frequencies[partial_indices[i]] - (2 ** i) * f0) * \
+            pressures[partial_indices[i]]
+    return (2 / f0) * departure / np.sum(pressures[partial_indices] ** 2)
+
+
+def spectral_descriptors(
+        frequencies: np.ndarray,
+        pressures: np.ndarray,
+        kernel: np.ndarray = None,
+) -> dict:
+    """
+    Compute the spectral descriptors of pytimbre's Spectrum for a batch of pressure spectra,
+    as array reductions over the frequency axis.
+
+    Args:
+        frequencies (np.ndarray): The bin frequencies (F,), as from spectrum_frequencies.
+        pressures (np.ndarray): The pressure spectra (N, F), as pytimbre's pressures_pascals.
+        kernel (np.ndarray, optional): The SWIPE kernel for inharmonicity. Defaults to None,
+            which means inharmonicity is not computed.
+
+    Returns:
+        dict: The descriptor names (see SPECTRAL_FEATURES) mapped to arrays of shape (N,).
+    """
+    pressures = np.atleast_2d(pressures)
+    num_bins = len(frequencies)
+    total = np.sum(pressures, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distribution = pressures / total
+        # an all-zero spectrum is uniform
+        distribution[total[:, 0] == 0] = 1 / num_bins
+        centroid = distribution @ frequencies
+        mean_center = frequencies[None, :] - centroid[:, None]
+        spread = np.sqrt(np.sum(mean_center ** 2 * distribution, axis=1))
+        skewness = np.sum(mean_center ** 3 * distribution,
+                          axis=1) / spread ** 3
+        kurtosis = np.sum(mean_center ** 4 * distribution,
+                          axis=1) / spread ** 4
+        slope = num_bins * (distribution @ frequencies) - \
+            np.sum(frequencies) * np.sum(distribution, axis=1)
+        slope /= num_bins * np.sum(frequencies ** 2) - \
+            np.sum(frequencies) ** 2
+        decrease = (distribution[:, 1:] - distribution[:, :1]) @ (
+            1 / np.arange(1, num_bins))
+        decrease /= np.sum(distribution[:, 1:], axis=1)
+        # first bin where the cumulative sum exceeds 95% of the total
+        cum_sum = np.cumsum(pressures, axis=1)
+        roll_off = frequencies[np.argmax(cum_sum > 0.95 * total, axis=1)]
+        energy = np.sum(pressures ** 2, axis=1)
+        arithmetic_mean = np.mean(pressures, axis=1)
+        geometric_mean = np.exp(np.sum(np.log(pressures), axis=1) / num_bins)
+        flatness = geometric_mean / arithmetic_mean
+        crest = np.max(pressures, axis=1) / arithmetic_mean
+    descriptors = {
+        "spectral_centroid": centroid,
+        "spectral_crest": crest,
+        "spectral_decrease": decrease,
+        "spectral_energy": energy,
+        "spectral_flatness": flatness,
+        "spectral_kurtosis": kurtosis,
+        "spectral_roll_off": roll_off,
+        "spectral_skewness": skewness,
+        "spectral_slope": slope,
+        "spectral_spread": spread,
+    }
+    if kernel is not None:
+        f0 = fundamental_frequency(frequencies, pressures, kernel)
+        descriptors["inharmonicity"] = np.array([
+            _inharmonicity(frequencies, pressures[row], f0[row]) for row in range(len(pressures))])
+    return descriptors
+
+
+def batch_spectral_descriptors(
+        y: np.ndarray,
+        sr: int,
+        fft_size: int = 4096,
+) -> dict:
+    """
+    Compute all descriptors of SPECTRAL_FEATURES for a batch of signals, as pytimbre's
+    SpectrumByFFT(Waveform(y, sr, 0.0), fft_size) would for each of them.
+
+    Args:
+        y (np.ndarray): The signals (N, samples).
+        sr (int): The sample rate.
+        fft_size (int, optional): The FFT size. Defaults to 4096.
+
+    Returns:
+        dict: The descriptor names mapped to arrays of shape (N,).
+    """
+    return spectral_descriptors(spectrum_frequencies(sr, fft_size), welch_pressures(y, fft_size),
+                                swipe_kernel(sr, fft_size))
+
+
+def check_against_pytimbre(
+        dataset,
+        indices: np.ndarray,
+        fft_size: int = 4096,
+        tolerance: float = 1e-12,
+) -> pd.DataFrame:
+    """
+    Compare batch_spectral_descriptors with pytimbre on some items of a dataset.
+
+    Args:
+        dataset (FmSynthDataset): The dataset.
+        indices (np.ndarray): The items to compare.
+        fft_size (int, optional): The FFT size. Defaults to 4096.
+        tolerance (float, optional): The largest relative difference that counts as equal.
+            Defaults to 1e-12.
+
+    Returns:
+        pd.DataFrame: The median and maximum relative difference of each descriptor, and
+            whether the maximum is within the tolerance (ok). attrs["ok"] is True if all are.
+    """
+    from pytimbre.waveform import Waveform
+    from pytimbre.spectral.spectra import SpectrumByFFT
+    y = dataset.get_batch(indices)[0]
+    batch = batch_spectral_descriptors(y, dataset.sr, fft_size)
+    expected = {name: [] for name in SPECTRAL_FEATURES}
+    for row in y:
+        # Waveform removes the mean in place
+        spectrum = SpectrumByFFT(Waveform(np.array(row), dataset.sr, 0.0), fft_size)
+        for name in SPECTRAL_FEATURES:
+            expected[name].append(getattr(spectrum, name))
+    report = {}
+    for name in SPECTRAL_FEATURES:
+        reference = np.array(expected[name], dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            difference = np.abs(batch[name] - reference) / np.abs(reference)
+        # equal values (e.g. both 0) and both NaN (no inharmonicity estimate) count as a match
+        difference[(batch[name] == reference) | (np.isnan(batch[name]) & np.isnan(reference))] = 0
+        report[name] = {"median": np.median(difference), "max": np.max(difference),
+                        "ok": bool(np.max(difference) <= tolerance)}
+    report = pd.DataFrame(report).T
+    report.attrs["ok"] = bool(report["ok"].all())
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the batched spectral descriptors with pytimbre on random rows of a parameter table.")
+    parser.add_argument("--grid", default="../data/fm_synth_params.grid.json",
+                        help="the parameter grid spec (see param_grid.py), read instead of --csv if it exists")
+    parser.add_argument("--csv", default="../data/fm_synth_params.csv",
+                        help="the parameter table")
+    parser.add_argument("--sr", type=int, default=48000, help="the sample rate")
+    parser.add_argument("--dur", type=float, default=1,
+                        help="the duration of the tones in seconds")
+    parser.add_argument("--num", type=int, default=100,
+                        help="the number of random rows to compare")
+    parser.add_argument("--tolerance", type=float, default=1e-12,
+                        help="the largest relative difference that counts as equal")
+    args = parser.parse_args()
+    from param_grid import open_dataset
+    ds = open_dataset(args.grid, args.csv, sr=args.sr, dur=args.dur)
+    rows = np.random.default_rng(0).choice(len(ds), min(args.num, len(ds)), replace=False)
+    report = check_against_pytimbre(ds, np.sort(rows), tolerance=args.tolerance)
+    print(report.to_string())
+    print("all within", args.tolerance, ":", report.attrs["ok"])
+    sys.exit(0 if report.attrs["ok"] else 1)
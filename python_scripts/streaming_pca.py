@@ -0,0 +1,213 @@
+import argparse
+import time
+import numpy as np
+from sklearn.decomposition import PCA
+
+
+def iter_row_blocks(
+        X: np.ndarray,
+        block_rows: int = 4096,
+):
+    """
+    Iterate over a matrix in blocks of rows, as float64, so only one block is ever converted
+    (a memory-mapped .npy stays on disk otherwise).
+
+    Args:
+        X (np.ndarray): The (num_samples, num_features) matrix, can be a memory map.
+        block_rows (int, optional): The number of rows per block. Defaults to 4096.
+
+    Yields:
+        tuple: The index of the first row of the block and the block.
+    """
+    for start in range(0, X.shape[0], block_rows):
+        yield start, np.asarray(X[start:start + block_rows], dtype=np.float64)
+
+
+class StreamingPCA:
+    """
+    PCA of a matrix that does not need to fit in memory, with the fit/transform interface
+    and fitted attributes of sklearn's PCA. It is fitted with a randomized SVD (Halko et al.
+    2011) in which every product with the centered matrix is accumulated over blocks of
+    rows, so besides one block it only holds (num_samples + num_features) x
+    (n_components + oversamples) values. The matrix can be float32 or float64, the
+    products are computed in float64.
+    """
+
+    def __init__(
+            self,
+            n_components: int = 2,
+            whiten: bool = False,
+            oversamples: int = 10,
+            n_iter: int = 5,
+            block_rows: int = 4096,
+            random_state: int = None,
+    ):
+        """
+        Args:
+            n_components (int, optional): The number of components. Defaults to 2.
+            whiten (bool, optional): Scale the projections to unit variance, like PCA(whiten=True).
+                Defaults to False.
+            oversamples (int, optional): The number of extra random vectors of the range
+                finder. Defaults to 10.
+            n_iter (int, optional): The number of power iterations, each takes two passes
+                over the matrix. Defaults to 5.
+            block_rows (int, optional): The number of rows read at a time. Defaults to 4096.
+            random_state (int, optional): The seed of the random vectors. Defaults to None.
+        """
+        self.n_components = n_components
+        self.whiten = whiten
+        self.oversamples = oversamples
+        self.n_iter = n_iter
+        self.block_rows = block_rows
+        self.random_state = random_state
+
+    def _times(self, X, right):
+        # (X - mean) @ right, block by block
+        out = np.zeros((X.shape[0], right.shape[1]))
+        shift = self.mean_ @ right
+        for start, block in iter_row_blocks(X, self.block_rows):
+            out[start:start + len(block)] = block @ right - shift
+        return out
+
+    def _transposed_times(self, X, left):
+        # (X - mean).T @ left, block by block
+        out = np.zeros((X.shape[1], left.shape[1]))
+        for start, block in iter_row_blocks(X, self.block_rows):
+            out += block.T @ left[start:start + len(block)]
+        return out - np.outer(self.mean_, left.sum(axis=0))
+
+    def fit(self, X: np.ndarray):
+        """
+        Fit the components to a matrix.
+
+        Args:
+            X (np.ndarray): The (num_samples, num_features) matrix, can be a memory map.
+
+        Returns:
+            StreamingPCA: The fitted instance.
+        """
+        num_samples, num_features = X.shape
+        num_vectors = min(self.n_components + self.oversamples, num_samples, num_features)
+
+        # the mean and the total variance in one pass (shifted by the first row, which
+        # keeps the sums of squares accurate when the mean is large)
+        shift = np.asarray(X[0], dtype=np.float64)
+        total, total_sq = np.zeros(num_features), np.zeros(num_features)
+        for _, block in iter_row_blocks(X, self.block_rows):
+            block = block - shift
+            total += block.sum(axis=0)
+            total_sq += (block ** 2).sum(axis=0)
+        self.mean_ = shift + total / num_samples
+        total_var = np.sum(total_sq - total ** 2 / num_samples) / (num_samples - 1)
+
+        # range finder with power iterations, orthonormalized after every product
+        rng = np.random.default_rng(self.random_state)
+        Q = self._times(X, rng.normal(size=(num_features, num_vectors)))
+        Q = np.linalg.qr(Q)[0]
+        for _ in range(self.n_iter):
+            Z = np.linalg.qr(self._transposed_times(X, Q))[0]
+            Q = np.linalg.qr(self._times(X, Z))[0]
+
+        # the SVD of the small projected matrix
+        B = self._transposed_times(X, Q).T
+        U_b, S, Vt = np.linalg.svd(B, full_matrices=False)
+        # the same sign convention as sklearn's PCA: the largest loading of each component
+        # is positive
+        signs = np.sign(Vt[np.arange(len(Vt)), np.argmax(np.abs(Vt), axis=1)])
+        Vt *= signs[:, None]
+
+        self.n_samples_ = num_samples
+        self.n_features_in_ = num_features
+        self.components_ = Vt[:self.n_components]
+        self.singular_values_ = S[:self.n_components]
+        self.explained_variance_ = self.singular_values_ ** 2 / (num_samples - 1)
+        self.explained_variance_ratio_ = self.explained_variance_ / total_var
+        return self
+
+    def transform(
+            self,
+            X: np.ndarray,
+            out: np.ndarray = None,
+    ) -> np.ndarray:
+        """
+        Project a matrix on the components, block by block.
+
+        Args:
+            X (np.ndarray): The (num_samples, num_features) matrix, can be a memory map.
+            out (np.ndarray, optional): A (num_samples, n_components) array (or memory map)
+                to write the projections to. Defaults to None.
+
+        Returns:
+            np.ndarray: The projections.
+        """
+        if out is None:
+            out = np.zeros((X.shape[0], self.n_components))
+        scale = np.sqrt(self.explained_variance_) if self.whiten else 1
+        for start, block in iter_row_blocks(X, self.block_rows):
+            out[start:start + len(block)] = \
+                (block - self.mean_) @ self.components_.T / scale
+        return out
+
+    def fit_transform(self, X: np.ndarray) -> np.ndarray:
+        """
+        Fit the components to a matrix and project it on them.
+
+        Args:
+            X (np.ndarray): The (num_samples, num_features) matrix, can be a memory map.
+
+        Returns:
+            np.ndarray: The projections.
+        """
+        return self.fit(X).transform(X)
+
+
+def check_against_pca(
+        X: np.ndarray,
+        n_components: int = 2,
+        whiten: bool = True,
+        **kwargs,
+) -> dict:
+    """
+    Compare the projections of StreamingPCA with those of sklearn's exact (full SVD) PCA,
+    and time both.
+
+    Args:
+        X (np.ndarray): The matrix, small enough for the exact PCA.
+        n_components (int, optional): The number of components. Defaults to 2.
+        whiten (bool, optional): Whiten the projections. Defaults to True.
+        **kwargs: Passed on to StreamingPCA.
+
+    Returns:
+        dict: The largest absolute difference of the projections (relative to the largest
+            projection), of the explained variance ratios, and the seconds each took.
+    """
+    start = time.perf_counter()
+    exact = PCA(n_components=n_components, whiten=whiten, svd_solver="full")
+    expected = exact.fit_transform(np.asarray(X, dtype=np.float64))
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    streaming = StreamingPCA(n_components=n_components, whiten=whiten, **kwargs)
+    projected = streaming.fit_transform(X)
+    streaming_time = time.perf_counter() - start
+    return {
+        "max_abs_difference": np.abs(projected - expected).max() / np.abs(expected).max(),
+        "explained_variance_ratio_difference": np.abs(
+            streaming.explained_variance_ratio_ - exact.explained_variance_ratio_).max(),
+        "seconds": {"exact": exact_time, "streaming": streaming_time},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that StreamingPCA matches the exact PCA on a feature matrix.")
+    parser.add_argument("npy", nargs="?", default="../data/fm_synth_mel_spectrograms_mean.npy",
+                        help="a .npy matrix, its rows are flattened like the EnCodec embeddings in stage 06")
+    parser.add_argument("--num", type=int, default=20000,
+                        help="the number of random rows to compare on")
+    args = parser.parse_args()
+    X = np.load(args.npy, mmap_mode="r")
+    X = X.reshape((X.shape[0], -1))
+    rows = np.sort(np.random.default_rng(0).choice(len(X), min(args.num, len(X)), replace=False))
+    report = check_against_pca(X[rows], random_state=42)
+    for key, value in report.items():
+        print(f"{key}: {value}")